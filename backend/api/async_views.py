@@ -0,0 +1,194 @@
+from itertools import islice
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import JsonResponse
+from rest_framework.exceptions import APIException
+from rest_framework.request import Request
+from rest_framework.settings import api_settings
+
+from recipes.indexes import ingredient_index
+from recipes.models import ShoppingCartIngredient
+from .cache import aget_versions, entry_response, response_key
+from .metrics import count_cache
+from .renderers import (
+    ShoppingListCSVRenderer,
+    ShoppingListPDFRenderer,
+    ShoppingListTextRenderer
+)
+from .views import (
+    SHOPPING_LIST_CHUNK_SIZE,
+    IngredientViewSet,
+    RecipeViewSet,
+    TagViewSet
+)
+
+SHOPPING_LIST_RENDERERS = {
+    renderer.format: renderer
+    for renderer in (
+        ShoppingListTextRenderer,
+        ShoppingListCSVRenderer,
+        ShoppingListPDFRenderer
+    )
+}
+
+
+def is_plain_json(request):
+    """
+    Запрос без токена и без выбора формата: его ответ
+    не зависит от пользователя и совпадает с закэшированным.
+    """
+
+    return (
+        request.method == 'GET'
+        and 'HTTP_AUTHORIZATION' not in request.META
+        and api_settings.URL_FORMAT_OVERRIDE not in request.GET
+        and 'text/html' not in request.headers.get('Accept', '')
+    )
+
+
+def viewset_view(viewset, actions, detail=False, action=None):
+    """Представление из ViewSet с теми же параметрами, что даёт роутер."""
+
+    initkwargs = {
+        'basename': viewset.queryset.model._meta.model_name,
+        'detail': detail,
+    }
+    if action is not None:
+        initkwargs.update(getattr(viewset, action).kwargs)
+    return viewset.as_view(actions, **initkwargs)
+
+
+def async_view(sync_view):
+    """
+    Асинхронное представление для режима ASGI (ASYNC_VIEWS).
+    Быстрый путь обслуживается в цикле событий без занятого потока;
+    если он вернул None, запрос передаётся синхронному представлению
+    DRF в пуле потоков. CSRF проверяет сам DRF, как и обычно.
+    """
+
+    fallback = sync_to_async(sync_view)
+
+    def decorator(handler):
+        async def view(request, *args, **kwargs):
+            response = await handler(request, *args, **kwargs)
+            if response is None:
+                response = await fallback(request, *args, **kwargs)
+            return response
+
+        view.csrf_exempt = True
+        view.cls = sync_view.cls
+        view.initkwargs = sync_view.initkwargs
+        view.actions = sync_view.actions
+        return view
+
+    return decorator
+
+
+async def cached_entry(request, viewset):
+    if not is_plain_json(request):
+        return None
+    versions = await aget_versions(viewset.cache_models)
+    entry = await cache.aget(response_key(versions, request))
+    if entry is None:
+        # Промах учтёт синхронное представление.
+        return None
+    count_cache('response', True)
+    return entry_response(request, entry)
+
+
+@async_view(viewset_view(
+    RecipeViewSet, {'get': 'list', 'post': 'create'}
+))
+async def recipe_list(request):
+    return await cached_entry(request, RecipeViewSet)
+
+
+@async_view(viewset_view(
+    RecipeViewSet,
+    {
+        'get': 'retrieve',
+        'put': 'update',
+        'patch': 'partial_update',
+        'delete': 'destroy'
+    },
+    detail=True
+))
+async def recipe_detail(request, pk):
+    return await cached_entry(request, RecipeViewSet)
+
+
+@async_view(viewset_view(TagViewSet, {'get': 'list'}))
+async def tag_list(request):
+    return await cached_entry(request, TagViewSet)
+
+
+@async_view(viewset_view(IngredientViewSet, {'get': 'list'}))
+async def ingredient_list(request):
+    """Автодополнение по параметру name - из индекса в памяти."""
+
+    name = request.GET.get('name')
+    if name is None or not is_plain_json(request):
+        return await cached_entry(request, IngredientViewSet)
+    return JsonResponse(
+        await ingredient_index.asearch(
+            name, IngredientViewSet.autocomplete_limit
+        ),
+        safe=False,
+        json_dumps_params={'ensure_ascii': False, 'separators': (',', ':')}
+    )
+
+
+async def aiterate(queryset, chunk_size):
+    """
+    Строки запроса пачками через серверный курсор. Пачки читаются
+    в синхронном потоке запроса: values_list().aiterator() в Django 4.2
+    выполняет запрос прямо в цикле событий и падает.
+    """
+
+    rows = await sync_to_async(iter)(queryset.iterator(chunk_size=chunk_size))
+    while True:
+        chunk = await sync_to_async(list)(islice(rows, chunk_size))
+        if not chunk:
+            return
+        for row in chunk:
+            yield row
+
+
+def authenticate(request):
+    return Request(
+        request,
+        authenticators=[
+            authentication()
+            for authentication in api_settings.DEFAULT_AUTHENTICATION_CLASSES
+        ]
+    ).user
+
+
+@async_view(viewset_view(
+    RecipeViewSet,
+    {'get': 'download_shopping_cart'},
+    action='download_shopping_cart'
+))
+async def download_shopping_cart(request):
+    """
+    Список покупок строками из асинхронного итератора.
+    Ошибки аутентификации и неизвестный формат отдаёт DRF.
+    """
+
+    renderer = SHOPPING_LIST_RENDERERS.get(
+        request.GET.get(api_settings.URL_FORMAT_OVERRIDE, 'txt')
+    )
+    if renderer is None or 'HTTP_AUTHORIZATION' not in request.META:
+        return None
+    try:
+        user = await sync_to_async(authenticate)(request)
+    except APIException:
+        return None
+    if user.is_anonymous:
+        return None
+    renderer = renderer()
+    return renderer.streaming_response(renderer.arender_rows(aiterate(
+        ShoppingCartIngredient.objects.shopping_list(user),
+        SHOPPING_LIST_CHUNK_SIZE
+    )))
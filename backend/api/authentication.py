@@ -0,0 +1,122 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+from rest_framework import exceptions
+from rest_framework.authentication import TokenAuthentication
+
+from .metrics import count_cache
+
+VERSION_KEY = 'auth-token-version'
+
+
+def token_key(key, version):
+    """
+    Версия входит в ключ: запрос, прочитавший токен из базы до выхода,
+    запишет пользователя под старой версией, и его уже никто не прочтёт.
+    """
+
+    return 'auth-token:{0}:{1}'.format(version, key)
+
+
+def token_version():
+    """Версия токенов; пропавшая из кэша заменяется новой, а не нулём."""
+
+    return cache.get_or_set(VERSION_KEY, time.time_ns, timeout=None)
+
+
+class TokenCache:
+    """
+    Токен -> пользователь в памяти процесса: не больше
+    AUTH_TOKEN_CACHE_SIZE записей (вытесняются давно не нужные),
+    каждая живёт AUTH_TOKEN_CACHE_TTL секунд. Версия в общем кэше
+    сбрасывает память всех процессов после выхода или смены пароля.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._version = None
+        self._lock = threading.Lock()
+
+    def get(self, key, version):
+        now = time.monotonic()
+        with self._lock:
+            if self._version != version:
+                self._entries.clear()
+                self._version = version
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            user, expires = entry
+            if expires < now:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return user
+
+    def set(self, key, user, version):
+        with self._lock:
+            if self._version != version:
+                return
+            self._entries[key] = (
+                user, time.monotonic() + settings.AUTH_TOKEN_CACHE_TTL
+            )
+            self._entries.move_to_end(key)
+            while len(self._entries) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self._entries.popitem(last=False)
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """
+    TokenAuthentication без запроса к базе на каждый запрос:
+    пользователь ищется в памяти процесса, затем в общем кэше
+    и только потом в таблице токенов. Каждый запрос получает свою
+    копию пользователя; счётчики при её сохранении не пишутся
+    (CounterFieldsMixin), так что устаревшие значения их не затрут.
+    """
+
+    def authenticate_credentials(self, key):
+        version = token_version()
+        user = token_cache.get(key, version)
+        count_cache('auth_token_local', user is not None)
+        if user is None:
+            user = cache.get(token_key(key, version))
+            count_cache('auth_token_shared', user is not None)
+            if user is None:
+                user, token = super().authenticate_credentials(key)
+                cache.set(
+                    token_key(key, version), user,
+                    settings.AUTH_TOKEN_CACHE_TIMEOUT
+                )
+            token_cache.set(key, user, version)
+        user = copy.copy(user)
+        if not user.is_active:
+            raise exceptions.AuthenticationFailed(
+                _('User inactive or deleted.')
+            )
+        return user, self.get_model()(key=key, user=user)
+
+
+def invalidate_tokens(*keys):
+    """
+    После коммита меняем версию токенов: записи общего кэша и памяти
+    процессов со старой версией больше не читаются, так что выход
+    и смена пароля действуют сразу.
+    """
+
+    def invalidate():
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.set(VERSION_KEY, time.time_ns(), timeout=None)
+
+    if keys:
+        transaction.on_commit(invalidate)
@@ -0,0 +1,122 @@
+import hashlib
+import math
+import time
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import http_date
+
+from .metrics import count_cache
+from .profiling import timed
+
+
+def version_key(model):
+    return 'response-version:{0}'.format(model._meta.label_lower)
+
+
+def bump_version(*models):
+    """
+    Сбрасываем закэшированные ответы, зависящие от моделей.
+    Версия - время изменения, она же идёт в Last-Modified.
+    """
+
+    now = time.time()
+    cache.set_many(
+        {version_key(model): now for model in models}, timeout=None
+    )
+
+
+def get_versions(models):
+    keys = [version_key(model) for model in models]
+    versions = cache.get_many(keys)
+    missing = [key for key in keys if key not in versions]
+    if missing:
+        now = time.time()
+        for key in missing:
+            cache.add(key, now, timeout=None)
+        versions.update(cache.get_many(missing))
+    return [versions.get(key, 0) for key in keys]
+
+
+async def aget_versions(models):
+    keys = [version_key(model) for model in models]
+    versions = await cache.aget_many(keys)
+    if len(versions) < len(keys):
+        return await sync_to_async(get_versions)(models)
+    return [versions[key] for key in keys]
+
+
+def response_key(versions, request):
+    return 'response:{0}'.format(hashlib.md5('{0}:{1}'.format(
+        versions, request.get_full_path()
+    ).encode()).hexdigest())
+
+
+def entry_response(request, entry):
+    """
+    Ответ из записи кэша, 304 - если у клиента она уже есть.
+    Сверяем только ETag: в Last-Modified секунды, и изменение в ту же
+    секунду If-Modified-Since не заметил бы.
+    """
+
+    response = HttpResponse(
+        entry['content'], content_type=entry['content_type']
+    )
+    response['ETag'] = entry['etag']
+    response['Last-Modified'] = http_date(entry['last_modified'])
+    return get_conditional_response(
+        request, etag=entry['etag'], response=response
+    )
+
+
+class CachedResponseMixin:
+    """
+    Кэширует готовые байты JSON-ответов list и retrieve.
+    Ключ включает версии моделей из cache_models, поэтому
+    изменение любой из них делает старые записи недоступными.
+    Отдаёт ETag и Last-Modified и отвечает 304 на If-None-Match.
+    """
+
+    cache_models = ()
+    cache_timeout = 60 * 60
+
+    def is_cacheable(self, request):
+        return request.accepted_renderer.format == 'json'
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().list, request, *args, **kwargs
+        )
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs
+        )
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        if not self.is_cacheable(request):
+            return handler(request, *args, **kwargs)
+
+        versions = get_versions(self.cache_models)
+        key = response_key(versions, request)
+        entry = cache.get(key)
+        count_cache('response', entry is not None)
+        if entry is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != 200:
+                return response
+            response.accepted_renderer = request.accepted_renderer
+            response.accepted_media_type = request.accepted_media_type
+            response.renderer_context = self.get_renderer_context()
+            with timed('render_time'):
+                content = response.render().content
+            entry = {
+                'content': content,
+                'content_type': response['Content-Type'],
+                'etag': '"{0}"'.format(hashlib.md5(content).hexdigest()),
+                'last_modified': math.ceil(max(versions)),
+            }
+            cache.set(key, entry, self.cache_timeout)
+        return entry_response(request, entry)
@@ -0,0 +1,35 @@
+from rest_framework import serializers
+
+from recipes.models import RecipeImage
+
+
+class RecipeImageField(serializers.ImageField):
+    """
+    Ссылка на подходящий вариант изображения рецепта в формате
+    image_format (WebP, для клиентов без WebP - JPEG).
+    Пока варианты не готовы, отдаём исходное изображение.
+    Без явного kind: в списках - карточка, для одного рецепта - полный.
+    """
+
+    def __init__(self, kind=None, image_format=RecipeImage.WEBP, **kwargs):
+        self.kind = kind
+        self.image_format = image_format
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def get_attribute(self, instance):
+        return instance
+
+    def get_kind(self):
+        if self.kind:
+            return self.kind
+        if isinstance(self.parent.parent, serializers.ListSerializer):
+            return RecipeImage.CARD
+        return RecipeImage.FULL
+
+    def to_representation(self, recipe):
+        kind = self.get_kind()
+        for variant in recipe.images.all():
+            if variant.kind == kind and variant.format == self.image_format:
+                return super().to_representation(variant.image)
+        return super().to_representation(recipe.image)
@@ -1,6 +1,14 @@
 from django_filters import rest_framework as filters
 
-from recipes.models import Ingredient, Recipe, Tag
+from recipes.models import (
+    Favorite,
+    Ingredient,
+    Recipe,
+    RecipeTag,
+    ShoppingCart,
+    Tag
+)
+from recipes.search import search_recipes
 from users.models import CustomUser
 
 
@@ -17,7 +25,10 @@ class IngredientFilter(filters.FilterSet):
 class RecipeFilter(filters.FilterSet):
     """
     Фильтрация рецепта по
-    автору, тегу, избранному и корзине покупок.
+    автору, тегу, избранному, корзине покупок и тексту,
+    ordering=popular - по числу добавлений в избранное.
+    Связанные таблицы проверяются подзапросами (pk IN ...),
+    а не JOIN, поэтому рецепты в выдаче не повторяются.
     """
 
     author = filters.ModelChoiceFilter(
@@ -26,7 +37,8 @@ class RecipeFilter(filters.FilterSet):
     tags = filters.ModelMultipleChoiceFilter(
         field_name='tags__slug',
         to_field_name='slug',
-        queryset=Tag.objects.all()
+        queryset=Tag.objects.all(),
+        method='filter_tags'
     )
     is_favorited = filters.BooleanFilter(
         method='filter_is_favorited'
@@ -34,6 +46,13 @@ class RecipeFilter(filters.FilterSet):
     is_in_shopping_cart = filters.BooleanFilter(
         method='filter_is_in_shopping_cart'
     )
+    search = filters.CharFilter(
+        method='filter_search'
+    )
+    ordering = filters.ChoiceFilter(
+        choices=(('popular', 'По популярности'),),
+        method='filter_ordering'
+    )
 
     class Meta:
         model = Recipe
@@ -41,15 +60,39 @@ class RecipeFilter(filters.FilterSet):
             'author',
             'tags',
             'is_favorited',
-            'is_in_shopping_cart'
+            'is_in_shopping_cart',
+            'search',
+            'ordering'
+        )
+
+    def filter_related(self, queryset, related):
+        return queryset.filter(pk__in=related.values('recipe_id'))
+
+    def filter_user_related(self, queryset, model):
+        user = self.request.user
+        if user.is_anonymous:
+            return queryset.none()
+        return self.filter_related(queryset, model.objects.filter(user=user))
+
+    def filter_tags(self, queryset, name, value):
+        if not value:
+            return queryset
+        return self.filter_related(
+            queryset, RecipeTag.objects.filter(tag__in=value)
         )
 
     def filter_is_favorited(self, queryset, name, value):
         if value:
-            return queryset.filter(in_favorite__user=self.request.user)
+            return self.filter_user_related(queryset, Favorite)
         return queryset
 
     def filter_is_in_shopping_cart(self, queryset, name, value):
         if value:
-            return queryset.filter(in_shopping_cart__user=self.request.user)
+            return self.filter_user_related(queryset, ShoppingCart)
         return queryset
+
+    def filter_search(self, queryset, name, value):
+        return search_recipes(queryset, value)
+
+    def filter_ordering(self, queryset, name, value):
+        return queryset.order_by('-favorites_count', '-pub_date', '-id')
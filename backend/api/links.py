@@ -0,0 +1,92 @@
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+
+
+def build_links(model, user_id, field_name, rows):
+    opts = model._meta
+    target = opts.get_field(field_name)
+    links = []
+    for pk, target_id in rows:
+        link = model(**{
+            opts.pk.attname: pk,
+            'user_id': user_id,
+            target.attname: target_id,
+        })
+        link._state.adding = False
+        link._state.db = connection.alias
+        links.append(link)
+    return links
+
+
+def execute_links(model, field_name, sql, params):
+    qn = connection.ops.quote_name
+    opts = model._meta
+    sql = sql.format(
+        table=qn(opts.db_table),
+        user=qn(opts.get_field('user').column),
+        target=qn(opts.get_field(field_name).column),
+        pk=qn(opts.pk.column)
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+
+def insert_links(model, user_id, field_name, target_ids):
+    """
+    Связываем пользователя с объектами (избранное, корзина, подписка)
+    одним INSERT ... ON CONFLICT DO NOTHING RETURNING.
+    Возвращаем только новые связи и отправляем для них post_save,
+    как при обычном save(): уже существующие пропускаются без ошибки,
+    поэтому одновременные запросы не падают на уникальности.
+    """
+
+    target_ids = list(target_ids)
+    if not target_ids:
+        return []
+    rows = execute_links(
+        model,
+        field_name,
+        'INSERT INTO {table} ({user}, {target}) VALUES '
+        + ', '.join(['(%s, %s)'] * len(target_ids))
+        + ' ON CONFLICT DO NOTHING RETURNING {pk}, {target}',
+        [value for target_id in target_ids for value in (user_id, target_id)]
+    )
+    links = build_links(model, user_id, field_name, rows)
+    for link in links:
+        post_save.send(
+            sender=model,
+            instance=link,
+            created=True,
+            update_fields=None,
+            raw=False,
+            using=connection.alias
+        )
+    return links
+
+
+def delete_links(model, user_id, field_name, target_ids):
+    """
+    Удаляем связи одним DELETE ... RETURNING и отправляем
+    post_delete для действительно удалённых строк.
+    """
+
+    target_ids = list(target_ids)
+    if not target_ids:
+        return []
+    rows = execute_links(
+        model,
+        field_name,
+        'DELETE FROM {table} WHERE {user} = %s AND {target} IN ('
+        + ', '.join(['%s'] * len(target_ids))
+        + ') RETURNING {pk}, {target}',
+        [user_id, *target_ids]
+    )
+    links = build_links(model, user_id, field_name, rows)
+    for link in links:
+        post_delete.send(
+            sender=model,
+            instance=link,
+            using=connection.alias
+        )
+    return links
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand
+
+from recipes import feed
+from users.models import Subscribe
+
+
+class Command(BaseCommand):
+    help = (
+        'Раскладка рецептов по лентам подписчиков вне запросов: авторы, '
+        'выпавшие из популярных (очередь в общем кэше), или все авторы '
+        'после загрузки данных в обход сигналов. Запускать по расписанию.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Разложить рецепты всех непопулярных авторов.'
+        )
+
+    def handle(self, *args, **options):
+        popular = feed.popular_author_ids()
+        if options['all']:
+            author_ids = Subscribe.objects.exclude(
+                author_id__in=popular
+            ).values_list('author_id', flat=True).distinct().order_by()
+            count = 0
+            for author_id in author_ids.iterator():
+                feed.backfill_followers(author_id)
+                count += 1
+        else:
+            count = feed.backfill_pending()
+        self.stdout.write(self.style.SUCCESS(
+            'Разложены рецепты авторов: {0}.'.format(count)
+        ))
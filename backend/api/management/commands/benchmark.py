@@ -0,0 +1,437 @@
+import base64
+import io
+import json
+import random
+import statistics
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count, F, FloatField, Q
+from django.db.models.functions import Cast
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api.cache import bump_version
+from recipes.indexes import recipe_ingredient_index
+from recipes.models import (
+    Ingredient,
+    IngredientRecipe,
+    Recipe,
+    Tag
+)
+from users.models import CustomUser, Subscribe
+from .loadtest import percentile
+
+COOKABLE_LIMIT = 20
+
+
+class QueryRecorder:
+    """Обёртка execute_wrapper: число запросов и самый долгий из них."""
+
+    def __init__(self):
+        self.count = 0
+        self.slowest = (0, None, None)
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            self.count += 1
+            if elapsed > self.slowest[0] and not many:
+                self.slowest = (elapsed, sql, params)
+
+
+def image_data():
+    buffer = io.BytesIO()
+    Image.new('RGB', (64, 64), (200, 120, 40)).save(buffer, 'PNG')
+    return 'data:image/png;base64,{0}'.format(
+        base64.b64encode(buffer.getvalue()).decode()
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Замеры основных сценариев API в процессе, без сервера: '
+        'p50/p95/p99 и SQL-запросы на ответ. Данные - из generate_dataset. '
+        'С --baseline сравнивает с прошлым прогоном и падает, если p95 '
+        'вырос больше --tolerance или запросов стало больше. '
+        'Конкурентную нагрузку на сервер даёт loadtest.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            default='bench0',
+            help='Имя пользователя, от которого идут запросы.'
+        )
+        parser.add_argument(
+            '--iterations',
+            type=int,
+            default=50,
+            help='Замеров на сценарий.'
+        )
+        parser.add_argument(
+            '--warmup',
+            type=int,
+            default=3,
+            help='Прогонов сценария перед замерами.'
+        )
+        parser.add_argument(
+            '--scenario',
+            action='append',
+            dest='scenarios',
+            help='Запустить только этот сценарий, можно несколько раз.'
+        )
+        parser.add_argument(
+            '--list',
+            action='store_true',
+            help='Показать сценарии и выйти.'
+        )
+        parser.add_argument(
+            '--warm',
+            action='store_true',
+            help=(
+                'Не сбрасывать кэш ответов перед замером: '
+                'по умолчанию меряется работа с базой.'
+            )
+        )
+        parser.add_argument(
+            '--explain',
+            action='store_true',
+            help='Показать план самого долгого SQL-запроса сценария.'
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=42,
+            help='Зерно выбора рецептов и ингредиентов.'
+        )
+        parser.add_argument(
+            '--output',
+            help='Сохранить результаты в JSON.'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='JSON прошлого прогона для сравнения.'
+        )
+        parser.add_argument(
+            '--tolerance',
+            type=float,
+            default=0.25,
+            help='Допустимый рост p95 относительно базового, доля.'
+        )
+        parser.add_argument(
+            '--min-delta',
+            type=float,
+            default=5,
+            help=(
+                'Рост p95 меньше этого числа миллисекунд не считается '
+                'регрессией: у быстрых сценариев это шум.'
+            )
+        )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        user = CustomUser.objects.filter(username=options['user']).first()
+        if user is None:
+            raise CommandError(
+                'Пользователь {0} не найден, сначала запустите '
+                'generate_dataset.'.format(options['user'])
+            )
+        self.prepare(user)
+        scenarios = self.scenarios()
+        if options['list']:
+            for name in scenarios:
+                self.stdout.write(name)
+            return
+        names = options['scenarios'] or list(scenarios)
+        unknown = set(names) - set(scenarios)
+        if unknown:
+            raise CommandError(
+                'Нет сценариев: {0}.'.format(', '.join(sorted(unknown)))
+            )
+
+        results = {}
+        try:
+            for name in names:
+                results[name] = self.run(name, scenarios[name], options)
+        finally:
+            self.cleanup()
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='UTF-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            self.compare(results, options)
+
+    def prepare(self, user):
+        """Клиенты и данные сценариев: всё выбирается заранее."""
+
+        token, _ = Token.objects.get_or_create(user=user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.anonymous = APIClient()
+        self.user = user
+        self.created = []
+
+        recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+        if not recipe_ids:
+            raise CommandError('В базе нет рецептов.')
+        self.recipe_ids = self.rng.sample(
+            recipe_ids, min(len(recipe_ids), 200)
+        )
+        self.author_id = CustomUser.objects.order_by(
+            '-recipes_count'
+        ).values_list('id', flat=True).first()
+        self.tag_slugs = list(Tag.objects.values_list('slug', flat=True)[:2])
+        self.tag_ids = list(Tag.objects.values_list('id', flat=True)[:2])
+        self.ingredient_ids = list(dict.fromkeys(
+            IngredientRecipe.objects.filter(
+                recipe_id__in=self.recipe_ids[:3]
+            ).order_by('id').values_list('ingredient_id', flat=True)
+        ))
+        self.ingredient_prefix = Ingredient.objects.values_list(
+            'name', flat=True
+        ).order_by('id').first()[:2]
+        self.search_word = Recipe.objects.values_list(
+            'name', flat=True
+        ).order_by('id').first().split()[0]
+        self.image = image_data()
+        self.favorite_recipe_id = Recipe.objects.exclude(
+            in_favorite__user=user
+        ).values_list('id', flat=True).first()
+        subscribed = Subscribe.objects.filter(
+            user=user
+        ).values_list('author_id', flat=True)
+        self.unfollowed_author_id = CustomUser.objects.exclude(
+            pk__in=subscribed
+        ).exclude(pk=user.pk).values_list('id', flat=True).first()
+        # При --heavy-follows не меньше числа пользователей свободных
+        # авторов нет: тогда отписываемся от автора и подписываемся снова.
+        self.subscribed = self.unfollowed_author_id is None
+        if self.subscribed:
+            self.unfollowed_author_id = subscribed.first()
+
+    def recipe_payload(self, iteration):
+        return {
+            'name': 'Benchmark {0}'.format(iteration),
+            'text': 'Рецепт из benchmark.',
+            'cooking_time': 10 + iteration % 50,
+            'tags': self.tag_ids,
+            'ingredients': [
+                {'id': ingredient_id, 'amount': 10 + iteration}
+                for ingredient_id in self.ingredient_ids[:8]
+            ],
+        }
+
+    def scenarios(self):
+        """
+        Сценарий - функция от номера замера, возвращающая ответ
+        (или None для сценариев без HTTP).
+        """
+
+        get = self.client.get
+
+        def recipe_filter(query):
+            return lambda i: get('/api/recipes/?' + query)
+
+        def create(i):
+            response = self.client.post(
+                '/api/recipes/',
+                {**self.recipe_payload(i), 'image': self.image},
+                format='json'
+            )
+            if response.status_code == 201:
+                self.created.append(response.data['id'])
+            return response
+
+        def update(i):
+            if not self.created:
+                create(-1)
+            return self.client.patch(
+                '/api/recipes/{0}/'.format(self.created[-1]),
+                self.recipe_payload(i),
+                format='json'
+            )
+
+        def toggle(url, subscribed=False):
+            first, second = self.client.post, self.client.delete
+            if subscribed:
+                first, second = second, first
+
+            def run(i):
+                response = first(url)
+                if response.status_code >= 400:
+                    return response
+                return second(url)
+            return run
+
+        ingredients = ','.join(map(str, self.ingredient_ids))
+        return {
+            'recipes_list': recipe_filter('limit=6'),
+            'recipes_list_anonymous': lambda i: self.anonymous.get(
+                '/api/recipes/?limit=6'
+            ),
+            'recipes_filter_author': recipe_filter(
+                'author={0}'.format(self.author_id)
+            ),
+            'recipes_filter_tags': recipe_filter('&'.join(
+                'tags={0}'.format(slug) for slug in self.tag_slugs
+            )),
+            'recipes_filter_favorited': recipe_filter('is_favorited=1'),
+            'recipes_filter_shopping_cart': recipe_filter(
+                'is_in_shopping_cart=1'
+            ),
+            'recipes_filter_search': recipe_filter(
+                'search={0}'.format(self.search_word)
+            ),
+            'recipes_ordering_popular': recipe_filter('ordering=popular'),
+            'recipes_cursor': recipe_filter('pagination=cursor'),
+            'recipes_feed': lambda i: get('/api/recipes/feed/'),
+            'recipe_detail': lambda i: get('/api/recipes/{0}/'.format(
+                self.recipe_ids[i % len(self.recipe_ids)]
+            )),
+            'recipes_cookable': lambda i: get(
+                '/api/recipes/cookable/?ingredients=' + ingredients
+            ),
+            'cookable_index': lambda i: self.cookable_index(),
+            'cookable_group_by': lambda i: self.cookable_group_by(),
+            'subscriptions': lambda i: get(
+                '/api/users/subscriptions/?recipes_limit=3'
+            ),
+            'ingredient_search': lambda i: get(
+                '/api/ingredients/?name=' + self.ingredient_prefix
+            ),
+            'shopping_list': lambda i: get(
+                '/api/recipes/download_shopping_cart/'
+            ),
+            'recipe_create': create,
+            'recipe_update': update,
+            'favorite_toggle': toggle('/api/recipes/{0}/favorite/'.format(
+                self.favorite_recipe_id
+            )),
+            'subscribe_toggle': toggle(
+                '/api/users/{0}/subscribe/'.format(self.unfollowed_author_id),
+                self.subscribed
+            ),
+        }
+
+    def cookable_index(self):
+        list(recipe_ingredient_index.search(
+            self.ingredient_ids
+        )[:COOKABLE_LIMIT])
+
+    def cookable_group_by(self):
+        """Тот же отбор одним GROUP BY по связям рецептов и ингредиентов."""
+
+        list(Recipe.objects.annotate(
+            matched=Count(
+                'ingredient_recipe',
+                filter=Q(ingredient_recipe__ingredient__in=(
+                    self.ingredient_ids
+                ))
+            ),
+            size=Count('ingredient_recipe')
+        ).filter(matched__gt=0).annotate(
+            coverage=Cast('matched', FloatField()) / F('size')
+        ).order_by('-coverage', '-matched', '-id').values_list(
+            'id', flat=True
+        )[:COOKABLE_LIMIT])
+
+    def run(self, name, scenario, options):
+        for iteration in range(options['warmup']):
+            self.check_response(name, scenario(iteration))
+        latencies = []
+        queries = []
+        recorder = None
+        for iteration in range(options['iterations']):
+            if not options['warm']:
+                bump_version(Tag, Ingredient, Recipe, CustomUser)
+            recorder = QueryRecorder()
+            with connection.execute_wrapper(recorder):
+                started = time.perf_counter()
+                response = scenario(iteration)
+                if hasattr(response, 'streaming_content'):
+                    for _ in response.streaming_content:
+                        pass
+                latencies.append((time.perf_counter() - started) * 1000)
+            self.check_response(name, response)
+            queries.append(recorder.count)
+
+        latencies.sort()
+        result = {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'queries': max(queries),
+            'queries_mean': round(statistics.mean(queries), 1),
+        }
+        self.stdout.write(
+            '{0}: p50 {1} мс, p95 {2} мс, p99 {3} мс, '
+            'запросов {4}'.format(
+                name, result['p50'], result['p95'], result['p99'],
+                result['queries']
+            )
+        )
+        if options['explain'] and recorder.slowest[1] is not None:
+            self.explain(*recorder.slowest[1:])
+        return result
+
+    def check_response(self, name, response):
+        if response is not None and response.status_code >= 400:
+            raise CommandError('{0}: ответ {1} {2}'.format(
+                name, response.status_code,
+                getattr(response, 'data', '')
+            ))
+
+    def explain(self, sql, params):
+        prefix = (
+            'EXPLAIN QUERY PLAN ' if connection.vendor == 'sqlite'
+            else 'EXPLAIN '
+        )
+        with connection.cursor() as cursor:
+            cursor.execute(prefix + sql, params)
+            for row in cursor.fetchall():
+                self.stdout.write('    ' + ' '.join(map(str, row)))
+
+    def cleanup(self):
+        """Удаляем рецепты, созданные сценариями."""
+
+        if self.created:
+            Recipe.objects.filter(pk__in=self.created).delete()
+
+    def compare(self, results, options):
+        with open(options['baseline'], encoding='UTF-8') as f:
+            baseline = json.load(f)
+        regressions = []
+        for name, result in results.items():
+            base = baseline.get(name)
+            if base is None:
+                continue
+            ratio = result['p95'] / base['p95'] if base['p95'] else 1
+            self.stdout.write(
+                '{0}: p95 x{1:.2f} к базовому, запросов {2} '
+                '(было {3})'.format(
+                    name, ratio, result['queries'], base['queries']
+                )
+            )
+            if (
+                ratio > 1 + options['tolerance']
+                and result['p95'] - base['p95'] > options['min_delta']
+            ):
+                regressions.append('{0}: p95 {1} мс, было {2} мс'.format(
+                    name, result['p95'], base['p95']
+                ))
+            if result['queries'] > base['queries']:
+                regressions.append('{0}: запросов {1}, было {2}'.format(
+                    name, result['queries'], base['queries']
+                ))
+        if regressions:
+            raise CommandError(
+                'Регрессии производительности:\n' + '\n'.join(regressions)
+            )
+        self.stdout.write(self.style.SUCCESS('Регрессий нет.'))
@@ -0,0 +1,53 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from recipes.models import Recipe, RecipeImageUpload
+
+
+class Command(BaseCommand):
+    help = (
+        'Удаление загруженных изображений, которые не привязали '
+        'к рецепту за RECIPE_IMAGE_UPLOAD_TTL секунд, вместе с файлами. '
+        'Запускать по расписанию.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Сколько загрузок удалять за одну транзакцию.'
+        )
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(
+            seconds=settings.RECIPE_IMAGE_UPLOAD_TTL
+        )
+        storage = RecipeImageUpload._meta.get_field('image').storage
+        uploads = files = 0
+        while True:
+            # Загрузку, которую сейчас забирает рецепт, пропускаем:
+            # её строка заблокирована, а потом будет удалена.
+            with transaction.atomic():
+                expired = dict(RecipeImageUpload.objects.filter(
+                    created__lt=cutoff
+                ).select_for_update(skip_locked=True).values_list(
+                    'pk', 'image'
+                )[:options['batch_size']])
+                RecipeImageUpload.objects.filter(pk__in=expired).delete()
+            if not expired:
+                break
+            names = set(expired.values()) - set(Recipe.objects.filter(
+                image__in=expired.values()
+            ).values_list('image', flat=True))
+            for name in names:
+                storage.delete(name)
+            uploads += len(expired)
+            files += len(names)
+        self.stdout.write(self.style.SUCCESS(
+            'Удалено загрузок: {0}, файлов: {1}.'.format(uploads, files)
+        ))
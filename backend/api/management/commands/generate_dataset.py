@@ -0,0 +1,347 @@
+import bisect
+import itertools
+import random
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from rest_framework.authtoken.models import Token
+
+from api.cache import bump_version
+from recipes.indexes import ingredient_index, recipe_ingredient_index
+from recipes.models import (
+    FeedEntry,
+    Favorite,
+    Ingredient,
+    IngredientRecipe,
+    Recipe,
+    RecipeTag,
+    ShoppingCart,
+    Tag
+)
+from users.models import CustomUser, Subscribe
+
+DISHES = (
+    'Суп', 'Салат', 'Пирог', 'Омлет', 'Рагу', 'Плов', 'Каша', 'Запеканка',
+    'Паста', 'Котлеты', 'Блины', 'Борщ', 'Жаркое', 'Кекс', 'Соус', 'Гуляш',
+)
+KINDS = (
+    'домашний', 'быстрый', 'постный', 'летний', 'зимний', 'пряный',
+    'сырный', 'грибной', 'овощной', 'рыбный', 'мясной', 'сладкий',
+)
+UNITS = ('г', 'кг', 'мл', 'л', 'шт.', 'ст. л.', 'ч. л.', 'по вкусу')
+TAG_COLORS = (
+    '#E26C2D', '#49B64E', '#8775D2', '#F5B700', '#3D9BE9', '#D64550',
+)
+
+
+class Sampler:
+    """
+    Выбор из списка с весами по закону Ципфа: первые элементы
+    популярны, хвост длинный - как авторы, рецепты и ингредиенты.
+    """
+
+    def __init__(self, rng, items, exponent):
+        self.rng = rng
+        self.items = list(items)
+        rng.shuffle(self.items)
+        self.cum_weights = list(itertools.accumulate(
+            1 / (rank ** exponent) for rank in range(1, len(self.items) + 1)
+        ))
+
+    def one(self):
+        point = self.rng.random() * self.cum_weights[-1]
+        return self.items[bisect.bisect(self.cum_weights, point)]
+
+    def unique(self, count, exclude=None):
+        """count разных элементов (или сколько есть), кроме exclude."""
+
+        count = min(count, len(self.items) - (exclude is not None))
+        chosen = set()
+        attempts = 0
+        while len(chosen) < count and attempts < count * 20:
+            item = self.one()
+            if item != exclude:
+                chosen.add(item)
+            attempts += 1
+        if len(chosen) < count:
+            chosen.update(self.rng.sample(
+                [item for item in self.items if item not in chosen
+                 and item != exclude],
+                count - len(chosen)
+            ))
+        return chosen
+
+
+class Command(BaseCommand):
+    help = (
+        'Синтетические данные для нагрузочных тестов и benchmark: '
+        'пользователи, рецепты с ингредиентами и тегами, избранное, '
+        'корзины и подписки с популярными авторами (закон Ципфа). '
+        'Пользователь <prefix>0 подписан на --heavy-follows авторов '
+        'и получает токен для benchmark. Результат воспроизводим по --seed.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--users', type=int, default=1000,
+            help='Число пользователей.'
+        )
+        parser.add_argument(
+            '--recipes', type=int, default=5000,
+            help='Число рецептов.'
+        )
+        parser.add_argument(
+            '--ingredients-per-recipe', type=int, default=8,
+            help='Среднее число ингредиентов в рецепте.'
+        )
+        parser.add_argument(
+            '--tags', type=int, default=8,
+            help='Число тегов.'
+        )
+        parser.add_argument(
+            '--favorites', type=int, default=15,
+            help='Среднее число рецептов в избранном пользователя.'
+        )
+        parser.add_argument(
+            '--cart', type=int, default=4,
+            help='Среднее число рецептов в корзине пользователя.'
+        )
+        parser.add_argument(
+            '--follows', type=int, default=10,
+            help='Среднее число подписок пользователя.'
+        )
+        parser.add_argument(
+            '--heavy-follows', type=int, default=1000,
+            help='Число подписок пользователя <prefix>0.'
+        )
+        parser.add_argument(
+            '--exponent', type=float, default=1.1,
+            help='Показатель закона Ципфа для популярности.'
+        )
+        parser.add_argument(
+            '--prefix', default='bench',
+            help='Префикс имён пользователей и slug тегов.'
+        )
+        parser.add_argument(
+            '--seed', type=int, default=42,
+            help='Зерно генератора случайных чисел.'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=2000,
+            help='Количество строк в одном INSERT.'
+        )
+        parser.add_argument(
+            '--clear', action='store_true',
+            help='Удалить данные прошлого запуска с тем же префиксом.'
+        )
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options['seed'])
+        self.batch_size = options['batch_size']
+        prefix = options['prefix']
+        started = time.monotonic()
+
+        existing = CustomUser.objects.filter(
+            username__startswith=prefix
+        )
+        if options['clear']:
+            deleted, _ = existing.delete()
+            self.stdout.write('Удалено объектов: {0}.'.format(deleted))
+        elif existing.exists():
+            raise CommandError(
+                'Данные с префиксом {0} уже есть, '
+                'запустите с --clear.'.format(prefix)
+            )
+
+        with transaction.atomic():
+            ingredient_ids = self.ensure_ingredients()
+            tag_ids = self.ensure_tags(prefix, options['tags'])
+            user_ids = self.create_users(prefix, options['users'])
+            recipes = self.create_recipes(
+                user_ids, options['recipes'], options['exponent']
+            )
+            self.create_recipe_relations(
+                recipes, ingredient_ids, tag_ids, options
+            )
+            recipe_sampler = Sampler(
+                self.rng, [pk for pk, _ in recipes], options['exponent']
+            )
+            self.create_links(
+                Favorite, 'recipe', user_ids, recipe_sampler,
+                options['favorites']
+            )
+            self.create_links(
+                ShoppingCart, 'recipe', user_ids, recipe_sampler,
+                options['cart']
+            )
+            follows = self.create_follows(user_ids, options)
+            self.create_feed(recipes, follows)
+            Token.objects.get_or_create(user_id=user_ids[0])
+
+        call_command('rebuild_shopping_cart_totals')
+        call_command('reconcile_counters')
+        call_command('update_search_vectors')
+        ingredient_index.invalidate()
+        recipe_ingredient_index.invalidate()
+        bump_version(Tag, Ingredient, Recipe, CustomUser)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Готово за {0:.1f} с: пользователей {1}, рецептов {2}, '
+            'токен {3}0: {4}'.format(
+                time.monotonic() - started, len(user_ids), len(recipes),
+                prefix, Token.objects.get(user_id=user_ids[0]).key
+            )
+        ))
+
+    def count(self, mean):
+        """Число связей у объекта: экспоненциальное, с длинным хвостом."""
+
+        return int(self.rng.expovariate(1 / mean)) if mean > 0 else 0
+
+    def bulk_create(self, model, objects):
+        objects = model.objects.bulk_create(
+            objects, batch_size=self.batch_size
+        )
+        self.stdout.write('{0}: {1}'.format(
+            model._meta.verbose_name_plural, len(objects)
+        ))
+        return objects
+
+    def ensure_ingredients(self):
+        """Берём загруженные ингредиенты, если их нет - создаём."""
+
+        ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+        if not ingredient_ids:
+            self.bulk_create(Ingredient, [
+                Ingredient(
+                    name='Ингредиент {0}'.format(number),
+                    measurement_unit=self.rng.choice(UNITS)
+                )
+                for number in range(2000)
+            ])
+            ingredient_ids = list(
+                Ingredient.objects.values_list('id', flat=True)
+            )
+        return ingredient_ids
+
+    def ensure_tags(self, prefix, count):
+        tag_ids = []
+        for number in range(count):
+            tag, _ = Tag.objects.get_or_create(
+                slug='{0}-{1}'.format(prefix, number),
+                defaults={
+                    'name': '{0} {1}'.format(
+                        self.rng.choice(KINDS).capitalize(), number
+                    ),
+                    'color': TAG_COLORS[number % len(TAG_COLORS)],
+                }
+            )
+            tag_ids.append(tag.id)
+        return tag_ids
+
+    def create_users(self, prefix, count):
+        password = make_password(prefix)
+        users = self.bulk_create(CustomUser, [
+            CustomUser(
+                username='{0}{1}'.format(prefix, number),
+                email='{0}{1}@example.com'.format(prefix, number),
+                first_name='Имя{0}'.format(number),
+                last_name='Фамилия{0}'.format(number),
+                password=password
+            )
+            for number in range(count)
+        ])
+        return [user.id for user in users]
+
+    def create_recipes(self, user_ids, count, exponent):
+        """Рецепты авторов по популярности: (id, id автора)."""
+
+        authors = Sampler(self.rng, user_ids, exponent)
+        recipes = self.bulk_create(Recipe, [
+            Recipe(
+                author_id=authors.one(),
+                name='{0} {1} №{2}'.format(
+                    self.rng.choice(DISHES),
+                    self.rng.choice(KINDS),
+                    number
+                ),
+                text=' '.join(self.rng.choices(KINDS + DISHES, k=20)),
+                cooking_time=self.rng.randint(5, 180),
+                image='recipes/benchmark.png'
+            )
+            for number in range(count)
+        ])
+        return [(recipe.id, recipe.author_id) for recipe in recipes]
+
+    def create_recipe_relations(self, recipes, ingredient_ids, tag_ids,
+                                options):
+        ingredients = Sampler(self.rng, ingredient_ids, options['exponent'])
+        mean = options['ingredients_per_recipe']
+        self.bulk_create(IngredientRecipe, [
+            IngredientRecipe(
+                recipe_id=recipe_id,
+                ingredient_id=ingredient_id,
+                amount=self.rng.randint(1, 500)
+            )
+            for recipe_id, _ in recipes
+            for ingredient_id in ingredients.unique(
+                max(1, round(self.rng.gauss(mean, mean / 3)))
+            )
+        ])
+        self.bulk_create(RecipeTag, [
+            RecipeTag(recipe_id=recipe_id, tag_id=tag_id)
+            for recipe_id, _ in recipes
+            for tag_id in self.rng.sample(
+                tag_ids, min(len(tag_ids), self.rng.randint(1, 3))
+            )
+        ])
+
+    def create_links(self, model, field_name, user_ids, sampler, mean):
+        self.bulk_create(model, [
+            model(**{'user_id': user_id, field_name + '_id': target_id})
+            for user_id in user_ids
+            for target_id in sampler.unique(self.count(mean))
+        ])
+
+    def create_follows(self, user_ids, options):
+        """Подписки: популярные авторы собирают большую часть."""
+
+        authors = Sampler(self.rng, user_ids, options['exponent'])
+        follows = []
+        for user_id in user_ids:
+            count = (
+                options['heavy_follows'] if user_id == user_ids[0]
+                else self.count(options['follows'])
+            )
+            follows.extend(
+                (user_id, author_id)
+                for author_id in authors.unique(count, exclude=user_id)
+            )
+        self.bulk_create(Subscribe, [
+            Subscribe(user_id=user_id, author_id=author_id)
+            for user_id, author_id in follows
+        ])
+        return follows
+
+    def create_feed(self, recipes, follows):
+        """
+        Ленты подписок, как после раскладки рецептов: последние
+        FEED_BACKFILL рецептов каждого автора, кроме популярных.
+        """
+
+        followers = Counter(author_id for _, author_id in follows)
+        by_author = defaultdict(list)
+        for recipe_id, author_id in reversed(recipes):
+            if len(by_author[author_id]) < settings.FEED_BACKFILL:
+                by_author[author_id].append(recipe_id)
+        self.bulk_create(FeedEntry, (
+            FeedEntry(user_id=user_id, recipe_id=recipe_id)
+            for user_id, author_id in follows
+            if followers[author_id] <= settings.FEED_FANOUT_LIMIT
+            for recipe_id in by_author[author_id]
+        ))
@@ -1,29 +1,244 @@
-import os
+import csv
 import json
+import os
+import time
 
+from django.core import serializers
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import IntegrityError, connection, transaction
+
+from api.cache import bump_version
+from recipes.indexes import ingredient_index, recipe_ingredient_index
+from recipes.models import Ingredient, IngredientRecipe
+
+
+def read_json_array(file, chunk_size=64 * 1024):
+    """
+    Потоково читаем элементы JSON-массива,
+    не загружая весь файл в память.
+    """
+
+    decoder = json.JSONDecoder()
+    buffer = ''
+    started = False
+    for chunk in iter(lambda: file.read(chunk_size), ''):
+        buffer += chunk
+        position = 0
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if not started and position < len(buffer):
+                if buffer[position] != '[':
+                    raise CommandError('Файл должен содержать JSON-массив.')
+                started = True
+                position += 1
+                continue
+            if position < len(buffer) and buffer[position] == ']':
+                return
+            try:
+                item, position = decoder.raw_decode(buffer, position)
+            except ValueError:
+                break
+            yield item
+        buffer = buffer[position:]
+    if buffer.strip():
+        raise CommandError('Файл с данными обрезан или повреждён.')
 
-from recipes.models import Ingredient
+
+def read_csv(file):
+    """Строки CSV вида: название,единица измерения."""
+
+    for row in csv.reader(file):
+        if row:
+            yield {'name': row[0], 'measurement_unit': row[1]}
+
+
+def batched(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 class Command(BaseCommand):
-    help = 'Команда для импорта данных в базу данных проекта.'
+    help = (
+        'Команда для импорта данных в базу данных проекта. '
+        'Принимает ингредиенты в JSON или CSV, а также дампы '
+        'manage.py dumpdata (теги, пользователи, рецепты). '
+        'Повторный импорт не создаёт дубликатов: ингредиенты '
+        'пропускаются, объекты дампа обновляются по id. После дампа '
+        'пересчитываются счётчики, поисковые векторы, корзины и ленты.'
+    )
 
     def add_arguments(self, parser):
-        parser.add_argument('file', type=str, help='Путь до json-файла.')
+        parser.add_argument(
+            'file', type=str, help='Путь до json- или csv-файла.'
+        )
+        parser.add_argument(
+            '--format',
+            choices=('json', 'csv'),
+            help='Формат файла, по умолчанию - по расширению.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Количество строк в одном INSERT.'
+        )
 
     def handle(self, *args, **options):
-        json_file_path = options['file']
+        file_path = options['file']
 
-        if not os.path.exists(json_file_path):
+        if not os.path.exists(file_path):
             raise CommandError('Неверно передан путь до файла с данными.')
 
-        with open(json_file_path, 'r', encoding='UTF-8') as f:
-            data = json.load(f)
+        file_format = options['format'] or (
+            'csv' if file_path.lower().endswith('.csv') else 'json'
+        )
+        batch_size = options['batch_size']
+        self.verbosity = options['verbosity']
+        started = time.monotonic()
 
-            for item in data:
-                ingredients = Ingredient(
-                    name=item['name'],
-                    measurement_unit=item['measurement_unit']
+        with open(file_path, 'r', encoding='UTF-8', newline='') as f:
+            if file_format == 'csv':
+                items = read_csv(f)
+            else:
+                items = read_json_array(f)
+            try:
+                with transaction.atomic():
+                    total, models = self.import_items(items, batch_size)
+                    self.reset_sequences(models)
+            except IntegrityError as error:
+                raise CommandError(
+                    'Данные конфликтуют с уже существующими строками '
+                    '(другой id при том же уникальном значении): '
+                    '{0}'.format(error)
                 )
-                ingredients.save()
+
+        if Ingredient in models:
+            ingredient_index.invalidate()
+        if IngredientRecipe in models:
+            recipe_ingredient_index.invalidate()
+        elapsed = time.monotonic() - started
+        if models - {Ingredient}:
+            self.rebuild_derived()
+        bump_version(*models)
+
+        self.stdout.write(self.style.SUCCESS(
+            'Обработано строк: {0} за {1:.1f} с ({2:.0f} строк/с).'.format(
+                total, elapsed, total / elapsed if elapsed else total
+            )
+        ))
+
+    def import_items(self, items, batch_size):
+        """
+        Пишем данные пачками. Элементы с ключом model считаются
+        объектами дампа, остальные - ингредиентами.
+        """
+
+        total = 0
+        models = set()
+        for batch in batched(items, batch_size):
+            ingredients = []
+            objects = []
+            for item in batch:
+                if 'model' in item:
+                    objects.extend(serializers.deserialize(
+                        'python', [item], ignorenonexistent=True
+                    ))
+                else:
+                    ingredients.append(Ingredient(
+                        name=item['name'],
+                        measurement_unit=item['measurement_unit']
+                    ))
+            if ingredients:
+                Ingredient.objects.bulk_create(
+                    ingredients, ignore_conflicts=True
+                )
+                models.add(Ingredient)
+            models.update(self.save_objects(objects))
+            total += len(batch)
+            if self.verbosity > 1:
+                self.stdout.write('Записано строк: {0}'.format(total))
+        return total, models
+
+    def save_objects(self, objects):
+        """
+        Объекты дампа: bulk_create по моделям с обновлением строк
+        с теми же id (ON CONFLICT DO UPDATE), затем связи M2M.
+        """
+
+        by_model = {}
+        for deserialized in objects:
+            by_model.setdefault(
+                type(deserialized.object), []
+            ).append(deserialized)
+        for model, group in by_model.items():
+            update_fields = [
+                field.name for field in model._meta.concrete_fields
+                if not field.primary_key
+            ]
+            model.objects.bulk_create(
+                [deserialized.object for deserialized in group],
+                **(
+                    {
+                        'update_conflicts': True,
+                        'unique_fields': [model._meta.pk.name],
+                        'update_fields': update_fields,
+                    } if update_fields else {'ignore_conflicts': True}
+                )
+            )
+            for field in model._meta.many_to_many:
+                through = field.remote_field.through
+                source = field.m2m_field_name()
+                target = field.m2m_reverse_field_name()
+                if {
+                    through_field.name
+                    for through_field in through._meta.concrete_fields
+                } != {through._meta.pk.name, source, target}:
+                    continue
+                through.objects.bulk_create(
+                    [
+                        through(**{
+                            source + '_id': deserialized.object.pk,
+                            target + '_id': related_pk,
+                        })
+                        for deserialized in group
+                        for related_pk in deserialized.m2m_data.get(
+                            field.name, ()
+                        )
+                    ],
+                    ignore_conflicts=True
+                )
+        return by_model.keys()
+
+    def rebuild_derived(self):
+        """
+        bulk_create не отправляет сигналы, поэтому производные данные
+        после загрузки дампа пересчитываем теми же командами.
+        """
+
+        for name, *args in (
+            ('reconcile_counters',),
+            ('update_search_vectors',),
+            ('rebuild_shopping_cart_totals',),
+            ('backfill_feed', '--all'),
+        ):
+            call_command(
+                name, *args, stdout=self.stdout, verbosity=self.verbosity
+            )
+
+    def reset_sequences(self, models):
+        """После вставки объектов с явными id сдвигаем счётчики id."""
+
+        statements = connection.ops.sequence_reset_sql(no_style(), models)
+        if statements:
+            with connection.cursor() as cursor:
+                for sql in statements:
+                    cursor.execute(sql)
@@ -0,0 +1,178 @@
+import json
+import statistics
+import time
+import urllib.error
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.management.base import BaseCommand, CommandError
+
+DEFAULT_PATHS = (
+    '/api/recipes/',
+    '/api/recipes/?limit=20',
+    '/api/tags/',
+    '/api/ingredients/?name=%D1%81%D0%BE',
+)
+AUTH_PATHS = (
+    '/api/recipes/download_shopping_cart/',
+    '/api/users/subscriptions/',
+)
+
+
+def percentile(values, percent):
+    if len(values) < 2:
+        return values[0] if values else 0
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+class Command(BaseCommand):
+    help = (
+        'Нагрузочный прогон запущенного сервера: одни и те же запросы '
+        'для сравнения режимов WSGI и ASGI на одной базе. Печатает '
+        'запросы в секунду, p50/p95/p99, ошибки и коды ответов по '
+        'каждому адресу. С несколькими --method запросы чередуются: '
+        '--method POST --method DELETE - гонка переключателей.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            default='http://127.0.0.1:8000',
+            help='Адрес сервера.'
+        )
+        parser.add_argument(
+            '--path',
+            action='append',
+            dest='paths',
+            help='Адрес запроса, можно несколько раз.'
+        )
+        parser.add_argument(
+            '--token',
+            help=(
+                'Токен пользователя: добавляет запросы с авторизацией, '
+                'адреса из --path тоже запрашиваются с ним.'
+            )
+        )
+        parser.add_argument(
+            '--method',
+            action='append',
+            dest='methods',
+            choices=('GET', 'POST', 'DELETE'),
+            help='Метод запросов, можно несколько раз (по умолчанию GET).'
+        )
+        parser.add_argument(
+            '--data',
+            help='Тело запросов POST и DELETE в JSON.'
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=50,
+            help='Число одновременных запросов.'
+        )
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=1000,
+            help='Запросов на каждый адрес.'
+        )
+        parser.add_argument(
+            '--output',
+            help='Сохранить результаты в JSON.'
+        )
+        parser.add_argument(
+            '--baseline',
+            help='JSON прошлого прогона для сравнения.'
+        )
+
+    def request(self, url, headers, method='GET', data=None):
+        started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(
+                urllib.request.Request(
+                    url, data=data, headers=headers, method=method
+                ),
+                timeout=30
+            ) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as error:
+            status = error.code
+        except OSError:
+            status = None
+        return status, time.perf_counter() - started
+
+    def run_path(self, path, options, authorized):
+        headers = {}
+        if authorized:
+            headers['Authorization'] = 'Token {0}'.format(options['token'])
+        methods = options['methods'] or ['GET']
+        data = None
+        if options['data'] is not None:
+            data = options['data'].encode()
+            headers['Content-Type'] = 'application/json'
+        url = options['url'].rstrip('/') + path
+
+        def send(number):
+            method = methods[number % len(methods)]
+            return self.request(
+                url, headers, method, None if method == 'GET' else data
+            )
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(options['concurrency']) as executor:
+            results = list(executor.map(send, range(options['requests'])))
+        elapsed = time.perf_counter() - started
+        latencies = sorted(latency * 1000 for _, latency in results)
+        return {
+            'rps': round(len(results) / elapsed, 1),
+            'p50': round(percentile(latencies, 50), 1),
+            'p95': round(percentile(latencies, 95), 1),
+            'p99': round(percentile(latencies, 99), 1),
+            'errors': sum(
+                1 for status, _ in results
+                if status is None or status >= 500
+            ),
+            'statuses': dict(sorted(
+                Counter(str(status) for status, _ in results).items()
+            )),
+        }
+
+    def handle(self, *args, **options):
+        token = bool(options['token'])
+        if options['paths']:
+            paths = [(path, token) for path in options['paths']]
+        else:
+            paths = [(path, False) for path in DEFAULT_PATHS]
+            if token:
+                paths += [(path, True) for path in AUTH_PATHS]
+        baseline = {}
+        if options['baseline']:
+            with open(options['baseline'], encoding='UTF-8') as f:
+                baseline = json.load(f)
+
+        results = {}
+        for path, authorized in paths:
+            result = results[path] = self.run_path(path, options, authorized)
+            line = (
+                '{0}: {1} зап/с, p50 {2} мс, p95 {3} мс, '
+                'p99 {4} мс, ошибок {5}, коды {6}'.format(
+                    path, result['rps'], result['p50'], result['p95'],
+                    result['p99'], result['errors'], ' '.join(
+                        '{0}:{1}'.format(status, count)
+                        for status, count in result['statuses'].items()
+                    )
+                )
+            )
+            if path in baseline and baseline[path]['rps']:
+                line += ' (x{0:.2f} к базовому)'.format(
+                    result['rps'] / baseline[path]['rps']
+                )
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w', encoding='UTF-8') as f:
+                json.dump(results, f, ensure_ascii=False, indent=2)
+        if any(result['errors'] for result in results.values()):
+            raise CommandError('Были ответы 5xx или обрывы соединения.')
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Count
+
+from recipes.images import (
+    VARIANT_FORMATS,
+    VARIANT_SIZES,
+    process_recipe_image
+)
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = (
+        'Создание вариантов изображений для рецептов, у которых '
+        'их ещё нет (или для всех рецептов с флагом --all).'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--all',
+            action='store_true',
+            help='Пересоздать варианты для всех рецептов.'
+        )
+
+    def handle(self, *args, **options):
+        recipes = Recipe.objects.all()
+        if not options['all']:
+            recipes = recipes.annotate(
+                variants=Count('images')
+            ).filter(
+                variants__lt=len(VARIANT_SIZES) * len(VARIANT_FORMATS)
+            )
+        recipe_ids = list(recipes.values_list('id', flat=True))
+        for recipe_id in recipe_ids:
+            process_recipe_image(recipe_id)
+        self.stdout.write(self.style.SUCCESS(
+            'Обработано рецептов: {0}.'.format(len(recipe_ids))
+        ))
@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from recipes.models import (
+    IngredientRecipe,
+    ShoppingCart,
+    ShoppingCartIngredient
+)
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчёт (или проверка) суммарных количеств ингредиентов '
+        'в корзинах покупок по текущим корзинам и рецептам.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Только сравнить таблицу с живыми данными.'
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Размер пачки при записи.'
+        )
+
+    def lock_sources(self):
+        """
+        Запрещаем менять корзины и состав рецептов до конца
+        транзакции: изменения, закоммиченные между подсчётом
+        и перезаписью таблицы, иначе потерялись бы.
+        """
+
+        if connection.vendor != 'postgresql':
+            return
+        qn = connection.ops.quote_name
+        with connection.cursor() as cursor:
+            cursor.execute('LOCK TABLE {0}, {1} IN SHARE MODE'.format(
+                qn(ShoppingCart._meta.db_table),
+                qn(IngredientRecipe._meta.db_table)
+            ))
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            self.lock_sources()
+            live = {
+                (user_id, ingredient_id): total
+                for user_id, ingredient_id, total
+                in ShoppingCartIngredient.objects.live_totals().iterator()
+            }
+            if options['verify']:
+                self.verify(live)
+                return
+            ShoppingCartIngredient.objects.all().delete()
+            ShoppingCartIngredient.objects.bulk_create(
+                (
+                    ShoppingCartIngredient(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        amount=total
+                    )
+                    for (user_id, ingredient_id), total in live.items()
+                ),
+                batch_size=options['batch_size']
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Пересчитано строк: {0}.'.format(len(live))
+        ))
+
+    def verify(self, live):
+        stored = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount
+            in ShoppingCartIngredient.objects.values_list(
+                'user_id', 'ingredient_id', 'amount'
+            ).iterator()
+        }
+        mismatches = [
+            key for key in {*live, *stored}
+            if live.get(key) != stored.get(key)
+        ]
+        if mismatches:
+            raise CommandError(
+                'Расхождений: {0} из {1} строк.'.format(
+                    len(mismatches), len(live)
+                )
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Расхождений нет, строк: {0}.'.format(len(live))
+        ))
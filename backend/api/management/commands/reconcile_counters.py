@@ -0,0 +1,72 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+from recipes.counters import start_reconcile
+from recipes.models import Favorite, Recipe, ShoppingCart
+from users.models import CustomUser, Subscribe
+
+# Счётчик -> модель, строки которой он считает, и поле связи.
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (Recipe, 'carts_count', ShoppingCart, 'recipe'),
+    (CustomUser, 'followers_count', Subscribe, 'author'),
+    (CustomUser, 'recipes_count', Recipe, 'author'),
+)
+
+
+def live_count(source, relation):
+    return Coalesce(
+        Subquery(
+            source.objects.filter(**{relation: OuterRef('pk')}).order_by(
+            ).values(relation).annotate(total=Count('pk')).values('total')
+        ),
+        Value(0)
+    )
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчёт (или проверка) счётчиков избранного, корзин, '
+        'подписчиков и рецептов по живым данным. Приращения, ещё не '
+        'записанные воркерами, отбрасываются по эпохе пересчёта в общем '
+        'кэше. С кэшем в памяти процесса (locmem) эпоху воркеры не видят: '
+        'тогда перед пересчётом их нужно остановить.'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify',
+            action='store_true',
+            help='Только найти расхождения.'
+        )
+
+    def handle(self, *args, **options):
+        if not options['verify']:
+            start_reconcile()
+        mismatches = 0
+        for model, field, source, relation in COUNTERS:
+            drifted = model.objects.annotate(
+                live=live_count(source, relation)
+            ).exclude(live=F(field))
+            if options['verify']:
+                count = drifted.count()
+            else:
+                with transaction.atomic():
+                    count = model.objects.filter(
+                        pk__in=drifted.values('pk')
+                    ).update(**{field: live_count(source, relation)})
+            mismatches += count
+            self.stdout.write('{0}.{1}: {2}'.format(
+                model._meta.label, field, count
+            ))
+
+        if options['verify'] and mismatches:
+            raise CommandError(
+                'Расхождений: {0}.'.format(mismatches)
+            )
+        self.stdout.write(self.style.SUCCESS(
+            'Исправлено расхождений: {0}.'.format(mismatches)
+            if not options['verify'] else 'Расхождений нет.'
+        ))
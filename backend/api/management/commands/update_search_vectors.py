@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe
+from recipes.search import update_search_vectors
+
+
+class Command(BaseCommand):
+    help = (
+        'Пересчёт поисковых векторов всех рецептов '
+        '(например, после массового импорта).'
+    )
+
+    def handle(self, *args, **options):
+        update_search_vectors(Recipe.objects.all())
+        self.stdout.write(self.style.SUCCESS('Поисковые векторы обновлены.'))
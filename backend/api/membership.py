@@ -0,0 +1,95 @@
+import time
+from array import array
+
+from django.core.cache import cache
+from django.db import transaction
+
+from recipes.models import Favorite, ShoppingCart
+from users.models import Subscribe
+from .metrics import count_cache
+
+MEMBERSHIP_TIMEOUT = 60 * 60 * 24
+
+
+class UserMembership:
+    """
+    Id рецептов в избранном и в корзине пользователя
+    и id авторов, на которых он подписан.
+    """
+
+    __slots__ = ('favorites', 'shopping_cart', 'subscriptions')
+
+    def __init__(self, favorites, shopping_cart, subscriptions):
+        self.favorites = favorites
+        self.shopping_cart = shopping_cart
+        self.subscriptions = subscriptions
+
+
+def version_key(user_id):
+    return 'membership-version:{0}'.format(user_id)
+
+
+def get_version(user_id):
+    """
+    Начальная версия - текущее время, чтобы после вытеснения ключа
+    версии из кэша не прочитать старые множества с прежней версией.
+    """
+
+    version = cache.get(version_key(user_id))
+    if version is None:
+        version = time.time_ns()
+        cache.add(version_key(user_id), version, timeout=None)
+        version = cache.get(version_key(user_id), version)
+    return version
+
+
+def pack_ids(queryset, field):
+    """Отсортированный массив int64 в байтах - компактно для кэша."""
+
+    return array('q', sorted(
+        queryset.values_list(field, flat=True)
+    )).tobytes()
+
+
+def load_membership(user):
+    """
+    Читаем множества из общего кэша по ключу с версией,
+    при промахе - тремя запросами из базы.
+    """
+
+    version = get_version(user.id)
+    key = 'membership:{0}:{1}'.format(user.id, version)
+    packed = cache.get(key)
+    count_cache('membership', packed is not None)
+    if packed is None:
+        packed = (
+            pack_ids(Favorite.objects.filter(user=user), 'recipe_id'),
+            pack_ids(ShoppingCart.objects.filter(user=user), 'recipe_id'),
+            pack_ids(Subscribe.objects.filter(user=user), 'author_id'),
+        )
+        cache.set(key, packed, MEMBERSHIP_TIMEOUT)
+    return UserMembership(*(
+        frozenset(array('q', ids)) for ids in packed
+    ))
+
+
+def get_membership(request):
+    """Множества текущего пользователя, загружаются один раз за запрос."""
+
+    membership = getattr(request, '_membership', None)
+    if membership is None:
+        membership = load_membership(request.user)
+        request._membership = membership
+    return membership
+
+
+def bump_membership(user_id):
+    """После коммита помечаем закэшированные множества устаревшими."""
+
+    def bump():
+        try:
+            cache.incr(version_key(user_id))
+        except ValueError:
+            cache.set(version_key(user_id), time.time_ns(), timeout=None)
+
+    transaction.on_commit(bump)
@@ -0,0 +1,81 @@
+import os
+
+from django.http import HttpResponse
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess
+)
+
+from .profiling import view_name
+
+# Каждое наблюдение пишется один раз за ответ, а не на каждый
+# SQL-запрос: в режиме нескольких процессов значения лежат в mmap-файлах
+# под общей блокировкой процесса, и держим её как можно реже.
+
+REQUEST_LATENCY = Histogram(
+    'foodgram_http_request_duration_seconds',
+    'Время ответа API по представлениям.',
+    ['view', 'method', 'status'],
+    buckets=(
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10
+    )
+)
+REQUEST_QUERIES = Histogram(
+    'foodgram_http_request_db_queries',
+    'SQL-запросов на один ответ.',
+    ['view'],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89)
+)
+REQUEST_DB_TIME = Histogram(
+    'foodgram_http_request_db_seconds',
+    'Время SQL-запросов на один ответ.',
+    ['view'],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+)
+CACHE_REQUESTS = Counter(
+    'foodgram_cache_requests',
+    'Обращения к кэшам: попадания и промахи.',
+    ['cache', 'result']
+)
+USER_ACTIONS = Counter(
+    'foodgram_user_actions',
+    'Добавления и удаления избранного, корзины и подписок.',
+    ['kind', 'action']
+)
+
+
+def observe_request(request, response, duration, profile):
+    view = view_name(request) or 'unresolved'
+    REQUEST_LATENCY.labels(
+        view, request.method, '{0}xx'.format(response.status_code // 100)
+    ).observe(duration)
+    REQUEST_QUERIES.labels(view).observe(profile.queries)
+    REQUEST_DB_TIME.labels(view).observe(profile.db_time)
+
+
+def count_cache(name, hit):
+    CACHE_REQUESTS.labels(name, 'hit' if hit else 'miss').inc()
+
+
+def count_user_action(kind, action):
+    USER_ACTIONS.labels(kind, action).inc()
+
+
+def metrics_view(request):
+    """
+    Метрики в формате Prometheus. Под gunicorn значения собираются
+    из файлов всех воркеров (PROMETHEUS_MULTIPROC_DIR).
+    """
+
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return HttpResponse(
+        generate_latest(registry), content_type=CONTENT_TYPE_LATEST
+    )
@@ -0,0 +1,178 @@
+import json
+import logging
+import random
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db.backends.signals import connection_created
+
+from .metrics import observe_request
+from .profiling import (
+    RequestProfile,
+    current_profile,
+    install_query_profiler,
+    view_name
+)
+
+logger = logging.getLogger('api.performance')
+
+
+class PerformanceMiddleware:
+    """
+    Профилирование запросов: число и время SQL-запросов, повторы
+    запросов (N+1), время сериализации и рендера. Замеры отдаются
+    в заголовке Server-Timing, медленные запросы пишутся в лог
+    api.performance одной строкой JSON.
+    Профилируется доля PERFORMANCE_SAMPLE_RATE запросов, при
+    PERFORMANCE_PROFILING=False middleware не подключается вовсе.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.PERFORMANCE_PROFILING:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+            # Иначе обработчик ASGI вызывал бы хук через sync_to_async.
+            self.process_template_response = self.aprocess_template_response
+        connection_created.connect(
+            install_query_profiler, dispatch_uid='api.performance'
+        )
+
+    def sample(self):
+        return random.random() < settings.PERFORMANCE_SAMPLE_RATE
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        if not self.sample():
+            return self.get_response(request)
+        token = current_profile.set(RequestProfile())
+        try:
+            response = self.get_response(request)
+            return self.finish(request, response, current_profile.get())
+        finally:
+            current_profile.reset(token)
+
+    async def __acall__(self, request):
+        if not self.sample():
+            return await self.get_response(request)
+        token = current_profile.set(RequestProfile())
+        try:
+            response = await self.get_response(request)
+            return self.finish(request, response, current_profile.get())
+        finally:
+            current_profile.reset(token)
+
+    def process_template_response(self, request, response):
+        return self.time_render(response)
+
+    async def aprocess_template_response(self, request, response):
+        return self.time_render(response)
+
+    def time_render(self, response):
+        profile = current_profile.get()
+        if profile is not None:
+            profile.start_render()
+            response.add_post_render_callback(profile.finish_render)
+        return response
+
+    def finish(self, request, response, profile):
+        total = (time.perf_counter() - profile.started) * 1000
+        db_time = profile.db_time * 1000
+        duplicates = profile.duplicates(
+            settings.PERFORMANCE_DUPLICATE_QUERIES
+        )
+        response['Server-Timing'] = ', '.join((
+            'db;dur={0:.1f};desc="{1} queries, {2} repeated"'.format(
+                db_time, profile.queries, len(duplicates)
+            ),
+            'serializer;dur={0:.1f}'.format(profile.serializer_time * 1000),
+            'render;dur={0:.1f}'.format(profile.render_time * 1000),
+            'total;dur={0:.1f}'.format(total),
+        ))
+        if (
+            total >= settings.PERFORMANCE_SLOW_REQUEST_MS
+            or profile.queries >= settings.PERFORMANCE_SLOW_QUERY_COUNT
+            or duplicates
+        ):
+            logger.warning(json.dumps({
+                'method': request.method,
+                'path': request.get_full_path(),
+                'view': view_name(request),
+                'status': response.status_code,
+                'total_ms': round(total, 1),
+                'db_ms': round(db_time, 1),
+                'queries': profile.queries,
+                'serializer_ms': round(profile.serializer_time * 1000, 1),
+                'render_ms': round(profile.render_time * 1000, 1),
+                'repeated_queries': [
+                    {'sql': sql, 'count': count}
+                    for sql, count in duplicates[:5]
+                ],
+            }, ensure_ascii=False))
+        return response
+
+
+class MetricsMiddleware:
+    """
+    Время ответа, число и время SQL-запросов по представлениям
+    для /metrics. Если запрос уже профилирует PerformanceMiddleware,
+    берём его замеры, иначе считаем только запросы, без отпечатков.
+    При METRICS_ENABLED=False не подключается.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not settings.METRICS_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        self.async_mode = iscoroutinefunction(get_response)
+        if self.async_mode:
+            markcoroutinefunction(self)
+        connection_created.connect(
+            install_query_profiler, dispatch_uid='api.performance'
+        )
+
+    def start(self):
+        if current_profile.get() is not None:
+            return None
+        return current_profile.set(RequestProfile(fingerprints=False))
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        token = self.start()
+        started = time.perf_counter()
+        try:
+            response = self.get_response(request)
+            observe_request(
+                request, response, time.perf_counter() - started,
+                current_profile.get()
+            )
+            return response
+        finally:
+            if token is not None:
+                current_profile.reset(token)
+
+    async def __acall__(self, request):
+        token = self.start()
+        started = time.perf_counter()
+        try:
+            response = await self.get_response(request)
+            observe_request(
+                request, response, time.perf_counter() - started,
+                current_profile.get()
+            )
+            return response
+        finally:
+            if token is not None:
+                current_profile.reset(token)
@@ -1,7 +1,40 @@
+from collections import OrderedDict
+
 from rest_framework import pagination
+from rest_framework.response import Response
 
 
 class CustomPagination(pagination.PageNumberPagination):
     """Кастомный класс пагинации на 6 записей."""
 
     page_size_query_param = 'limit'
+
+
+class RecipeCursorPagination(pagination.CursorPagination):
+    """
+    Курсорная пагинация ленты рецептов по (pub_date, id).
+    Не делает OFFSET и COUNT(*): общее число записей считается
+    только по запросу с параметром count=true.
+    """
+
+    ordering = ('-pub_date', '-id')
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'true':
+            self.count = queryset.count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = OrderedDict([
+            ('next', self.get_next_link()),
+            ('previous', self.get_previous_link()),
+            ('results', data),
+        ])
+        if self.count is not None:
+            response['count'] = self.count
+            response.move_to_end('count', last=False)
+        return Response(response)
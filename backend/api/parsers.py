@@ -0,0 +1,16 @@
+from rest_framework import parsers
+
+
+class RawImageParser(parsers.FileUploadParser):
+    """
+    Изображение телом запроса (Content-Type: image/*).
+    Django пишет такие файлы на диск частями,
+    имя файла из Content-Disposition необязательно.
+    """
+
+    media_type = 'image/*'
+
+    def get_filename(self, stream, media_type, parser_context):
+        return super().get_filename(
+            stream, media_type, parser_context
+        ) or 'upload.{0}'.format(media_type.split('/')[-1].split(';')[0])
@@ -0,0 +1,256 @@
+import zlib
+from functools import lru_cache
+from io import BytesIO
+
+from fontTools import subset
+from fontTools.ttLib import TTFont
+
+# Страница A4 в пунктах.
+PAGE_WIDTH = 595
+PAGE_HEIGHT = 842
+MARGIN = 50
+FONT_SIZE = 11
+LEADING = 16
+
+
+@lru_cache(maxsize=None)
+def load_font(path):
+    """
+    Файл TrueType-шрифта и всё, что нужно для набора: символ -> глиф,
+    ширины глифов в тысячных долях кегля, габариты и имя шрифта.
+    """
+
+    with open(path, 'rb') as f:
+        data = f.read()
+    font = TTFont(BytesIO(data))
+    scale = 1000 / font['head'].unitsPerEm
+    glyph_ids = font.getReverseGlyphMap()
+    cmap = {
+        code: glyph_ids[name] for code, name in font.getBestCmap().items()
+    }
+    widths = {
+        glyph_ids[name]: round(advance * scale)
+        for name, (advance, _) in font['hmtx'].metrics.items()
+    }
+    head, hhea = font['head'], font['hhea']
+    metrics = {
+        'bbox': [
+            round(value * scale)
+            for value in (head.xMin, head.yMin, head.xMax, head.yMax)
+        ],
+        'ascent': round(hhea.ascent * scale),
+        'descent': round(hhea.descent * scale),
+    }
+    name = font['name'].getDebugName(6) or 'Font'
+    return data, cmap, widths, metrics, name
+
+
+class StreamingPDF:
+    """
+    PDF, который отдаётся по частям. Страница пишется, как только
+    заполнится; смещения объектов запоминаются, а дерево страниц,
+    шрифт и таблица xref идут в конце файла. Из шрифта встраиваются
+    только использованные глифы, их номера при этом не меняются,
+    поэтому уже отправленные страницы остаются верными.
+    """
+
+    CATALOG, PAGES, FONT = 1, 2, 3
+
+    def __init__(self, font_path):
+        (
+            self.font_data, self.cmap, self.widths, self.metrics,
+            self.font_name
+        ) = load_font(font_path)
+        self.offset = 0
+        self.offsets = {}
+        self.next_number = self.FONT + 1
+        self.pages = []
+        self.lines = []
+        self.used = {}
+        self.lines_per_page = (PAGE_HEIGHT - 2 * MARGIN) // LEADING
+
+    def number(self):
+        number = self.next_number
+        self.next_number += 1
+        return number
+
+    def object(self, number, body):
+        chunk = b'%d 0 obj\n%s\nendobj\n' % (number, body)
+        self.offsets[number] = self.offset
+        self.offset += len(chunk)
+        return chunk
+
+    def stream(self, number, data, extra=b''):
+        data = zlib.compress(data)
+        return self.object(number, (
+            b'<< /Length %d /Filter /FlateDecode%s >>\n'
+            b'stream\n%s\nendstream'
+        ) % (len(data), extra, data))
+
+    def start(self):
+        header = b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n'
+        self.offset = len(header)
+        return header + self.object(
+            self.CATALOG, b'<< /Type /Catalog /Pages %d 0 R >>' % self.PAGES
+        )
+
+    def text_width(self, text):
+        return sum(
+            self.widths.get(self.cmap.get(ord(char), 0), 0) for char in text
+        )
+
+    def wrap(self, text):
+        """Строки по словам, чтобы помещались в ширину страницы."""
+
+        limit = (PAGE_WIDTH - 2 * MARGIN) * 1000 / FONT_SIZE
+        space = self.text_width(' ')
+        line, width = '', 0
+        for word in text.split(' '):
+            word_width = self.text_width(word)
+            if line and width + space + word_width > limit:
+                yield line
+                line, width = word, word_width
+            elif line:
+                line += ' ' + word
+                width += space + word_width
+            else:
+                line, width = word, word_width
+        yield line
+
+    def encode(self, text):
+        glyphs = []
+        for char in text:
+            glyph = self.cmap.get(ord(char), 0)
+            self.used.setdefault(glyph, char)
+            glyphs.append('%04X' % glyph)
+        return ''.join(glyphs).encode()
+
+    def write(self, text):
+        """Добавляем строку; возвращает готовые страницы (или b'')."""
+
+        chunk = b''
+        for line in self.wrap(text):
+            if len(self.lines) == self.lines_per_page:
+                chunk += self.page()
+            self.lines.append(self.encode(line))
+        return chunk
+
+    def page(self):
+        content = [b'BT /F1 %d Tf %d TL %d %d Td' % (
+            FONT_SIZE, LEADING, MARGIN, PAGE_HEIGHT - MARGIN - FONT_SIZE
+        )]
+        content.extend(b'<%s> Tj T*' % line for line in self.lines)
+        content.append(b'ET')
+        self.lines = []
+        contents, page = self.number(), self.number()
+        self.pages.append(page)
+        return self.stream(contents, b'\n'.join(content)) + self.object(
+            page,
+            b'<< /Type /Page /Parent %d 0 R /MediaBox [0 0 %d %d] '
+            b'/Resources << /Font << /F1 %d 0 R >> >> /Contents %d 0 R >>' % (
+                self.PAGES, PAGE_WIDTH, PAGE_HEIGHT, self.FONT, contents
+            )
+        )
+
+    def finish(self):
+        """Последняя страница, шрифт, дерево страниц и таблица xref."""
+
+        chunk = self.page() if self.lines or not self.pages else b''
+        chunk += self.object(
+            self.PAGES, b'<< /Type /Pages /Kids [%s] /Count %d >>' % (
+                b' '.join(b'%d 0 R' % page for page in self.pages),
+                len(self.pages)
+            )
+        )
+        chunk += self.font()
+        xref = self.offset
+        chunk += b'xref\n0 %d\n0000000000 65535 f \n' % self.next_number
+        chunk += b''.join(
+            b'%010d 00000 n \n' % self.offsets[number]
+            for number in range(1, self.next_number)
+        )
+        return chunk + (
+            b'trailer\n<< /Size %d /Root %d 0 R >>\n'
+            b'startxref\n%d\n%%%%EOF\n'
+        ) % (self.next_number, self.CATALOG, xref)
+
+    def subset(self):
+        font = TTFont(BytesIO(self.font_data))
+        options = subset.Options()
+        options.retain_gids = True
+        options.notdef_outline = True
+        options.layout_features = []
+        options.drop_tables += ['FFTM']
+        subsetter = subset.Subsetter(options)
+        subsetter.populate(gids=sorted(set(self.used) | {0}))
+        subsetter.subset(font)
+        output = BytesIO()
+        font.save(output)
+        return output.getvalue()
+
+    def to_unicode(self):
+        glyphs = sorted(
+            (glyph, char) for glyph, char in self.used.items() if glyph
+        )
+        blocks = []
+        for start in range(0, len(glyphs), 100):
+            block = glyphs[start:start + 100]
+            blocks.append('{0} beginbfchar\n{1}\nendbfchar'.format(
+                len(block), '\n'.join(
+                    '<{0:04X}> <{1}>'.format(
+                        glyph, char.encode('utf-16-be').hex().upper()
+                    )
+                    for glyph, char in block
+                )
+            ))
+        return '\n'.join((
+            '/CIDInit /ProcSet findresource begin',
+            '12 dict begin',
+            'begincmap',
+            '/CIDSystemInfo << /Registry (Adobe) /Ordering (UCS) '
+            '/Supplement 0 >> def',
+            '/CMapName /Adobe-Identity-UCS def',
+            '/CMapType 2 def',
+            '1 begincodespacerange',
+            '<0000> <FFFF>',
+            'endcodespacerange',
+            *blocks,
+            'endcmap',
+            'CMapName currentdict /CMap defineresource pop',
+            'end',
+            'end',
+        )).encode()
+
+    def font(self):
+        cid_font, descriptor, font_file, to_unicode = (
+            self.number() for _ in range(4)
+        )
+        name = ('/AAAAAA+' + self.font_name).encode()
+        data = self.subset()
+        widths = b' '.join(
+            b'%d [%d]' % (glyph, self.widths.get(glyph, 0))
+            for glyph in sorted(self.used)
+        )
+        return b''.join((
+            self.object(self.FONT, (
+                b'<< /Type /Font /Subtype /Type0 /BaseFont %s '
+                b'/Encoding /Identity-H /DescendantFonts [%d 0 R] '
+                b'/ToUnicode %d 0 R >>'
+            ) % (name, cid_font, to_unicode)),
+            self.object(cid_font, (
+                b'<< /Type /Font /Subtype /CIDFontType2 /BaseFont %s '
+                b'/CIDSystemInfo << /Registry (Adobe) /Ordering (Identity) '
+                b'/Supplement 0 >> /FontDescriptor %d 0 R '
+                b'/CIDToGIDMap /Identity /W [%s] >>'
+            ) % (name, descriptor, widths)),
+            self.object(descriptor, (
+                b'<< /Type /FontDescriptor /FontName %s /Flags 32 '
+                b'/FontBBox [%d %d %d %d] /ItalicAngle 0 /Ascent %d '
+                b'/Descent %d /CapHeight %d /StemV 80 /FontFile2 %d 0 R >>'
+            ) % (
+                name, *self.metrics['bbox'], self.metrics['ascent'],
+                self.metrics['descent'], self.metrics['ascent'], font_file
+            )),
+            self.stream(font_file, data, b' /Length1 %d' % len(data)),
+            self.stream(to_unicode, self.to_unicode()),
+        ))
@@ -0,0 +1,138 @@
+import re
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+current_profile = ContextVar('current_profile', default=None)
+
+IN_LIST = re.compile(r'\((?:\s*%s\s*,)+\s*%s\s*\)')
+LITERAL = re.compile(r"'(?:[^']|'')*'|\b\d+\b")
+
+
+def fingerprint(sql):
+    """Текст запроса без значений: IN (%s, %s, ...) и числа свёрнуты."""
+
+    return LITERAL.sub('?', IN_LIST.sub('(...)', sql))
+
+
+class RequestProfile:
+    """Замеры одного запроса: SQL, сериализация и рендер."""
+
+    __slots__ = (
+        'started',
+        'queries',
+        'db_time',
+        'fingerprints',
+        'serializer_time',
+        'serializing',
+        'render_started',
+        'render_time',
+    )
+
+    def __init__(self, fingerprints=True):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.fingerprints = Counter() if fingerprints else None
+        self.serializer_time = 0.0
+        self.serializing = False
+        self.render_started = None
+        self.render_time = 0.0
+
+    def duplicates(self, threshold):
+        return [
+            (sql, count)
+            for sql, count in self.fingerprints.most_common()
+            if count >= threshold
+        ]
+
+    def start_render(self):
+        self.render_started = time.perf_counter()
+
+    def finish_render(self, response):
+        if self.render_started is not None:
+            self.render_time += time.perf_counter() - self.render_started
+            self.render_started = None
+
+
+def profile_queries(execute, sql, params, many, context):
+    """
+    Обёртка execute_wrapper, постоянно стоящая на соединениях:
+    считает запрос, только если текущий запрос профилируется.
+    """
+
+    profile = current_profile.get()
+    if profile is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        profile.db_time += time.perf_counter() - started
+        profile.queries += 1
+        if profile.fingerprints is not None:
+            profile.fingerprints[fingerprint(sql)] += 1
+
+
+def install_query_profiler(sender, connection, **kwargs):
+    # В начало списка: execute_wrapper() снимает последнюю обёртку.
+    if profile_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, profile_queries)
+
+
+@contextmanager
+def timed(name):
+    """Добавляем время блока к полю профиля, например render_time."""
+
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        setattr(
+            profile, name,
+            getattr(profile, name) + time.perf_counter() - started
+        )
+
+
+class ProfiledSerializerMixin:
+    """
+    Время сериализации в профиль запроса. Учитывается только
+    внешний сериализатор, вложенные входят в его время,
+    как и запросы к базе, которые он вызвал.
+    """
+
+    def to_representation(self, instance):
+        profile = current_profile.get()
+        if profile is None or profile.serializing:
+            return super().to_representation(instance)
+        profile.serializing = True
+        started = time.perf_counter()
+        try:
+            return super().to_representation(instance)
+        finally:
+            profile.serializer_time += time.perf_counter() - started
+            profile.serializing = False
+
+
+def view_name(request):
+    """
+    Имя представления для логов и метрик: ViewSet.action
+    для DRF, иначе путь функции.
+    """
+
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    func = match.func
+    cls = getattr(func, 'cls', None)
+    if cls is None:
+        return match._func_path
+    action = getattr(func, 'actions', {}).get(request.method.lower())
+    if action is None:
+        return cls.__name__
+    return '{0}.{1}'.format(cls.__name__, action)
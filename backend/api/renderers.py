@@ -0,0 +1,150 @@
+import csv
+
+from django.conf import settings
+from django.http import Http404, StreamingHttpResponse
+from rest_framework import negotiation, renderers
+
+from .pdf import StreamingPDF
+
+
+class Echo:
+    """Псевдо-буфер для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+class ShoppingListRenderer(renderers.BaseRenderer):
+    """
+    Базовый рендерер списка покупок.
+    Строки выгружаются по одной через render_rows,
+    render используется только для ответов с ошибками.
+    """
+
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict):
+            data = '\n'.join(
+                '{0}: {1}'.format(key, value) for key, value in data.items()
+            )
+        return str(data).encode(self.charset or 'utf-8')
+
+    def render_header(self):
+        return None
+
+    def render_footer(self):
+        return None
+
+    def render_row(self, name, measurement_unit, amount):
+        raise NotImplementedError
+
+    def render_rows(self, rows):
+        """Принимает кортежи (название, единица, количество)."""
+
+        header = self.render_header()
+        if header is not None:
+            yield header
+        for row in rows:
+            chunk = self.render_row(*row)
+            if chunk:
+                yield chunk
+        footer = self.render_footer()
+        if footer is not None:
+            yield footer
+
+    async def arender_rows(self, rows):
+        """То же для асинхронного итератора строк."""
+
+        header = self.render_header()
+        if header is not None:
+            yield header
+        async for row in rows:
+            chunk = self.render_row(*row)
+            if chunk:
+                yield chunk
+        footer = self.render_footer()
+        if footer is not None:
+            yield footer
+
+    def streaming_response(self, content):
+        content_type = self.media_type
+        if self.charset:
+            content_type += '; charset={0}'.format(self.charset)
+        response = StreamingHttpResponse(content, content_type=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename=shopping-list.{0}'.format(self.format)
+        )
+        return response
+
+
+class ShoppingListTextRenderer(ShoppingListRenderer):
+    """Список покупок в текстовом формате."""
+
+    media_type = 'text/plain'
+    format = 'txt'
+
+    def render_row(self, name, measurement_unit, amount):
+        return 'Игрединет: {0}. Количество: {1} {2}.\n'.format(
+            name, amount, measurement_unit
+        )
+
+
+class ShoppingListCSVRenderer(ShoppingListRenderer):
+    """Список покупок в формате CSV."""
+
+    media_type = 'text/csv'
+    format = 'csv'
+
+    def __init__(self):
+        self.writer = csv.writer(Echo())
+
+    def render_header(self):
+        return self.writer.writerow(('Ингредиент', 'Количество', 'Единица'))
+
+    def render_row(self, name, measurement_unit, amount):
+        return self.writer.writerow((name, amount, measurement_unit))
+
+
+class ShoppingListPDFRenderer(ShoppingListRenderer):
+    """
+    Список покупок в PDF. Страницы уходят клиенту по мере
+    заполнения, шрифт и таблица объектов - в конце файла (api.pdf).
+    """
+
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+
+    def render_header(self):
+        self.document = StreamingPDF(settings.SHOPPING_LIST_PDF_FONT)
+        return (
+            self.document.start()
+            + self.document.write('Список покупок')
+            + self.document.write('')
+        )
+
+    def render_row(self, name, measurement_unit, amount):
+        return self.document.write('{0} - {1} {2}'.format(
+            name, amount, measurement_unit
+        ))
+
+    def render_footer(self):
+        return self.document.finish()
+
+
+class FormatParameterNegotiation(negotiation.DefaultContentNegotiation):
+    """
+    Выбираем рендерер только по параметру format,
+    без учёта заголовка Accept. По умолчанию - первый рендерер.
+    """
+
+    def select_renderer(self, request, renderers, format_suffix=None):
+        format_query_param = self.settings.URL_FORMAT_OVERRIDE
+        format = format_suffix or request.query_params.get(format_query_param)
+        for renderer in renderers:
+            if format is None or renderer.format == format:
+                return (renderer, renderer.media_type)
+        raise Http404
@@ -1,19 +1,33 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import prefetch_related_objects
+from django.utils import timezone
 from djoser.serializers import UserCreateSerializer, UserSerializer
 from drf_extra_fields.fields import Base64ImageField
 from rest_framework import serializers
 
+from recipes.counters import update_counter
+from recipes.feed import fan_out_recipes
+from recipes.images import schedule_image_processing
+from recipes.indexes import ingredient_id_index, recipe_ingredient_index
 from recipes.models import (
     Tag,
     Ingredient,
     Recipe,
+    RecipeImage,
+    RecipeImageUpload,
+    RecipeTag,
     IngredientRecipe,
-    Favorite,
-    ShoppingCart
-)
-from users.models import (
-    CustomUser,
-    Subscribe
+    ShoppingCartIngredient
 )
+from recipes.search import update_search_vectors
+from users.models import CustomUser
+from .cache import bump_version
+from .fields import RecipeImageField
+from .membership import get_membership
+from .profiling import ProfiledSerializerMixin
 
 
 class CreateCustomUserSerializer(UserCreateSerializer):
@@ -33,7 +47,7 @@ class CreateCustomUserSerializer(UserCreateSerializer):
         extra_kwargs = {"password": {"write_only": True}}
 
 
-class CustomUserSerializer(UserSerializer):
+class CustomUserSerializer(ProfiledSerializerMixin, UserSerializer):
     """Сериализатор модели CustomUser."""
 
     is_subscribed = serializers.SerializerMethodField()
@@ -52,18 +66,23 @@ class CustomUserSerializer(UserSerializer):
     def get_is_subscribed(self, obj):
         """Проверяем есть ли у пользователя подписки."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request.user.is_anonymous:
             return False
-        return Subscribe.objects.filter(user=user, author=obj).exists()
+        return obj.id in get_membership(request).subscriptions
 
 
-class RecipeShowSerializer(serializers.ModelSerializer):
+class RecipeShowSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     """
     Короткая модель рецепта для корректного отображения в разделе подписок.
     """
 
-    image = Base64ImageField()
+    image = RecipeImageField(kind=RecipeImage.THUMBNAIL)
+    image_jpeg = RecipeImageField(
+        kind=RecipeImage.THUMBNAIL, image_format=RecipeImage.JPEG
+    )
 
     class Meta:
         model = Recipe
@@ -71,6 +90,7 @@ class RecipeShowSerializer(serializers.ModelSerializer):
             'id',
             'name',
             'image',
+            'image_jpeg',
             'cooking_time',
         )
 
@@ -100,12 +120,10 @@ class SubscribeSerializer(CustomUserSerializer):
     def get_is_subscribed(self, obj):
         """Проверяем существование подписок."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request.user.is_anonymous:
             return False
-        return Subscribe.objects.filter(
-            user=user, author=obj
-        ).exists()
+        return obj.id in get_membership(request).subscriptions
 
     def get_recipes(self, obj):
         """
@@ -117,22 +135,23 @@ class SubscribeSerializer(CustomUserSerializer):
         recipes_limit = request.GET.get('recipes_limit')
         if request.user.is_anonymous:
             return False
-        recipes = Recipe.objects.filter(
-            author=obj
-        )
-        if recipes_limit:
-            recipes = recipes[:int(recipes_limit)]
+        if hasattr(obj, 'recipes_preview'):
+            recipes = obj.recipes_preview
+        else:
+            recipes = Recipe.objects.filter(
+                author=obj
+            ).prefetch_related('images')
+            if recipes_limit:
+                recipes = recipes[:int(recipes_limit)]
         return RecipeShowSerializer(recipes, many=True).data
 
     def get_recipes_count(self, obj):
-        """Считаем количество рецептов от автора."""
+        """Количество рецептов автора - счётчик в модели."""
 
-        return Recipe.objects.filter(
-            author=obj
-        ).count()
+        return obj.recipes_count
 
 
-class TagSerializer(serializers.ModelSerializer):
+class TagSerializer(ProfiledSerializerMixin, serializers.ModelSerializer):
     """Сериализатор модели Tag."""
 
     class Meta:
@@ -140,7 +159,9 @@ class TagSerializer(serializers.ModelSerializer):
         fields = '__all__'
 
 
-class IngredientSerializer(serializers.ModelSerializer):
+class IngredientSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     """Сериализатор модели Ingredient."""
 
     class Meta:
@@ -169,7 +190,9 @@ class IngredientRecipeGetSerializer(serializers.ModelSerializer):
         fields = ('id', 'name', 'amount', 'measurement_unit',)
 
 
-class RecipeGetSerializer(serializers.ModelSerializer):
+class RecipeGetSerializer(
+    ProfiledSerializerMixin, serializers.ModelSerializer
+):
     """
     Сериализатор для обработки GET запросов модели Recipe.
     """
@@ -183,7 +206,8 @@ class RecipeGetSerializer(serializers.ModelSerializer):
     )
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
-    image = Base64ImageField()
+    image = RecipeImageField()
+    image_jpeg = RecipeImageField(image_format=RecipeImage.JPEG)
 
     class Meta:
         model = Recipe
@@ -196,6 +220,7 @@ class RecipeGetSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_jpeg',
             'text',
             'cooking_time'
         )
@@ -208,6 +233,7 @@ class RecipeGetSerializer(serializers.ModelSerializer):
             'is_in_shopping_cart',
             'name',
             'image',
+            'image_jpeg',
             'text',
             'cooking_time'
         )
@@ -215,22 +241,103 @@ class RecipeGetSerializer(serializers.ModelSerializer):
     def get_is_favorited(self, obj):
         """Ищем объект в модели Favorite."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request.user.is_anonymous:
             return False
-        return Favorite.objects.filter(
-            user=user, recipe=obj
-        ).exists()
+        return obj.id in get_membership(request).favorites
 
     def get_is_in_shopping_cart(self, obj):
         """Ищем объект в модели ShoppingCart."""
 
-        user = self.context.get('request').user
-        if user.is_anonymous:
+        request = self.context.get('request')
+        if request.user.is_anonymous:
             return False
-        return ShoppingCart.objects.filter(
-            user=user, recipe=obj
-        ).exists()
+        return obj.id in get_membership(request).shopping_cart
+
+
+class RecipeCookableSerializer(RecipeGetSerializer):
+    """
+    Рецепт из подбора по ингредиентам: доля ингредиентов,
+    которые уже есть, и список недостающих.
+    """
+
+    coverage = serializers.SerializerMethodField()
+    missing_ingredients = serializers.SerializerMethodField()
+
+    class Meta(RecipeGetSerializer.Meta):
+        fields = RecipeGetSerializer.Meta.fields + (
+            'coverage',
+            'missing_ingredients',
+        )
+
+    def get_missing(self, obj):
+        available = self.context['available_ingredients']
+        return [
+            ingredient for ingredient in obj.ingredient_recipe.all()
+            if ingredient.ingredient_id not in available
+        ]
+
+    def get_coverage(self, obj):
+        total = len(obj.ingredient_recipe.all())
+        if not total:
+            return 0
+        return round(1 - len(self.get_missing(obj)) / total, 2)
+
+    def get_missing_ingredients(self, obj):
+        return IngredientRecipeGetSerializer(
+            self.get_missing(obj), many=True
+        ).data
+
+
+class RecipeImageUploadSerializer(serializers.ModelSerializer):
+    """
+    Сериализатор загрузки изображения рецепта файлом.
+    Файл проверяется Pillow с диска, а не из тела JSON.
+    """
+
+    image = serializers.ImageField(write_only=True)
+
+    class Meta:
+        model = RecipeImageUpload
+        fields = ('token', 'image')
+        read_only_fields = ('token',)
+
+    def validate_image(self, value):
+        """Ограничиваем размер файла."""
+
+        if value.size > settings.RECIPE_IMAGE_MAX_SIZE:
+            raise serializers.ValidationError(
+                'Размер изображения не может превышать {0} байт.'.format(
+                    settings.RECIPE_IMAGE_MAX_SIZE
+                )
+            )
+        return value
+
+
+class ShoppingCartBulkSerializer(serializers.Serializer):
+    """Список id рецептов для массового изменения корзины."""
+
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=100
+    )
+
+    def validate_recipes(self, value):
+        """Проверяем существование всех рецептов одним запросом."""
+
+        value = list(dict.fromkeys(value))
+        found = set(
+            Recipe.objects.filter(pk__in=value).values_list('pk', flat=True)
+        )
+        missing = [pk for pk in value if pk not in found]
+        if missing:
+            raise serializers.ValidationError(
+                'Рецепты не найдены: {0}.'.format(
+                    ', '.join(map(str, missing))
+                )
+            )
+        return value
 
 
 class IngredientRecipePostSerializer(serializers.ModelSerializer):
@@ -246,6 +353,15 @@ class IngredientRecipePostSerializer(serializers.ModelSerializer):
         fields = ('id', 'amount')
 
 
+def claim_upload(upload):
+    """Забираем предварительную загрузку, если её не удалила очистка."""
+
+    if upload is not None and not upload.claim():
+        raise serializers.ValidationError(
+            {'image_token': 'Загруженное изображение не найдено.'}
+        )
+
+
 class RecipePostSerializer(serializers.ModelSerializer):
     """
     Сериализатор модели Recipe - POST и PATCH методы.
@@ -260,7 +376,10 @@ class RecipePostSerializer(serializers.ModelSerializer):
     ingredients = IngredientRecipePostSerializer(
         many=True
     )
-    image = Base64ImageField()
+    image = Base64ImageField(required=False)
+    image_token = serializers.UUIDField(
+        write_only=True, required=False
+    )
 
     class Meta:
         model = Recipe
@@ -269,11 +388,39 @@ class RecipePostSerializer(serializers.ModelSerializer):
             'author',
             'ingredients',
             'image',
+            'image_token',
             'name',
             'text',
             'cooking_time'
         )
 
+    def validate(self, data):
+        """
+        Изображение передаётся либо в base64 (image),
+        либо токеном предварительной загрузки (image_token).
+        """
+
+        token = data.pop('image_token', None)
+        if token is not None:
+            upload = RecipeImageUpload.objects.filter(
+                token=token,
+                user=self.context.get('request').user,
+                created__gte=timezone.now() - timedelta(
+                    seconds=settings.RECIPE_IMAGE_UPLOAD_TTL
+                )
+            ).first()
+            if upload is None:
+                raise serializers.ValidationError(
+                    {'image_token': 'Загруженное изображение не найдено.'}
+                )
+            data['image'] = upload.image.name
+            data['image_upload'] = upload
+        elif self.instance is None and 'image' not in data:
+            raise serializers.ValidationError(
+                {'image': 'Обязательное поле.'}
+            )
+        return data
+
     def validate_tags(self, value):
         """Валидируем наличие тега."""
 
@@ -291,17 +438,27 @@ class RecipePostSerializer(serializers.ModelSerializer):
                 "Нужно передать как минимум 1 ингредиент."
             )
 
-        ingredient_list = []
+        seen = set()
         for ingredient in value:
             if ingredient['amount'] <= 0:
                 raise serializers.ValidationError(
                     'Количество ингредиента не может быть меньше 1.'
                 )
-            if ingredient['id'] in ingredient_list:
+            if ingredient['id'] in seen:
                 raise serializers.ValidationError(
                     "Добавить можно только уникальные ингедиенты."
                 )
-            ingredient_list.append(ingredient['id'])
+            seen.add(ingredient['id'])
+
+        missing = ingredient_id_index.missing(
+            [ingredient['id'] for ingredient in value]
+        )
+        if missing:
+            raise serializers.ValidationError(
+                'Ингредиентов нет в базе: {0}.'.format(
+                    ', '.join(map(str, missing))
+                )
+            )
         return value
 
     def add_ingredients(self, ingredients, recipe):
@@ -324,33 +481,181 @@ class RecipePostSerializer(serializers.ModelSerializer):
 
         tags = validated_data.pop('tags')
         ingredients = validated_data.pop('ingredients')
+        image_upload = validated_data.pop('image_upload', None)
+        claim_upload(image_upload)
         recipe = Recipe.objects.create(**validated_data)
         recipe.tags.set(tags)
         self.add_ingredients(ingredients, recipe)
+        schedule_image_processing(recipe)
+        transaction.on_commit(
+            lambda: recipe_ingredient_index.changed([recipe.pk])
+        )
 
         return recipe
 
+    def update_tags(self, recipe, tags):
+        """Добавляем новые теги и убираем снятые, остальные не трогаем."""
+
+        new_ids = {tag.id for tag in tags}
+        old_ids = set(RecipeTag.objects.filter(
+            recipe=recipe
+        ).values_list('tag_id', flat=True))
+        if old_ids - new_ids:
+            RecipeTag.objects.filter(
+                recipe=recipe, tag_id__in=old_ids - new_ids
+            ).delete()
+        if new_ids - old_ids:
+            RecipeTag.objects.bulk_create([
+                RecipeTag(recipe=recipe, tag_id=tag_id)
+                for tag_id in new_ids - old_ids
+            ])
+
+    def update_ingredients(self, recipe, ingredients):
+        """
+        Правим только различия: новые и изменившиеся количества
+        одним INSERT ... ON CONFLICT DO UPDATE, убранные - одним DELETE.
+        Корзины с рецептом получают те же изменения.
+        """
+
+        old_amounts = ShoppingCartIngredient.objects.recipe_amounts(recipe)
+        new_amounts = {
+            ingredient['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        removed = old_amounts.keys() - new_amounts.keys()
+        changed = {
+            ingredient_id: amount
+            for ingredient_id, amount in new_amounts.items()
+            if old_amounts.get(ingredient_id) != amount
+        }
+        if not removed and not changed:
+            return
+        if removed:
+            IngredientRecipe.objects.filter(
+                recipe=recipe, ingredient_id__in=removed
+            ).delete()
+        if changed:
+            IngredientRecipe.objects.bulk_create(
+                [
+                    IngredientRecipe(
+                        recipe=recipe,
+                        ingredient_id=ingredient_id,
+                        amount=amount
+                    )
+                    for ingredient_id, amount in changed.items()
+                ],
+                update_conflicts=True,
+                unique_fields=('recipe', 'ingredient'),
+                update_fields=('amount',)
+            )
+        ShoppingCartIngredient.objects.update_recipe(
+            recipe, old_amounts, new_amounts
+        )
+        transaction.on_commit(
+            lambda: recipe_ingredient_index.changed([recipe.pk])
+        )
+
+    @transaction.atomic
     def update(self, instance, validated_data):
         """
-        Очищаем старые поля от исходных данных и
-        с помощью метода super() записываем новые данные.
+        Рецепт блокируется до конца транзакции, затем меняются только
+        переданные связи и только в том, что отличается.
+        В PATCH без tags или ingredients эти связи не трогаются.
+        Счётчики перечитываются под блокировкой, а save() их не пишет.
         """
 
-        tags = validated_data.pop('tags')
-        ingredients = validated_data.pop('ingredients')
-        instance.tags.set(tags)
-        instance.ingredient_recipe.all().delete()
-        self.add_ingredients(ingredients, instance)
+        counters = Recipe.objects.select_for_update().values(
+            *Recipe.counter_fields
+        ).get(pk=instance.pk)
+        for field, value in counters.items():
+            setattr(instance, field, value)
+        tags = validated_data.pop('tags', None)
+        ingredients = validated_data.pop('ingredients', None)
+        claim_upload(validated_data.pop('image_upload', None))
+        if tags is not None:
+            self.update_tags(instance, tags)
+        if ingredients is not None:
+            self.update_ingredients(instance, ingredients)
+        recipe = super().update(instance, validated_data)
+        if 'image' in validated_data:
+            schedule_image_processing(recipe)
 
-        return super().update(instance, validated_data)
+        return recipe
 
     def to_representation(self, instance):
         """
         Переопределяем метод to_representation
         для корретного отбражения JSON`а
         после POST или PATCH запроса.
+        Связи загружаются заново одним запросом на каждую.
         """
 
+        prefetch_related_objects(
+            [instance], 'tags', 'ingredient_recipe__ingredient', 'images'
+        )
         request = self.context.get('request')
         context = {'request': request}
         return RecipeGetSerializer(instance, context=context).data
+
+
+class RecipeBatchSerializer(serializers.Serializer):
+    """
+    Массовое создание рецептов для импорта: {"recipes": [...]},
+    каждый рецепт - как в POST /api/recipes/.
+    """
+
+    recipes = RecipePostSerializer(
+        many=True,
+        allow_empty=False,
+        max_length=settings.RECIPE_BATCH_LIMIT
+    )
+
+    def create(self, validated_data):
+        """
+        Рецепты, теги и ингредиенты вставляются тремя запросами.
+        bulk_create не шлёт сигналов, поэтому счётчик рецептов,
+        ленты, поисковые векторы и кэши обновляем здесь.
+        """
+
+        author = validated_data['author']
+        items = validated_data['recipes']
+        for item in items:
+            claim_upload(item.get('image_upload'))
+        recipes = Recipe.objects.bulk_create([
+            Recipe(
+                author=author,
+                name=item['name'],
+                text=item['text'],
+                cooking_time=item['cooking_time'],
+                image=item['image']
+            )
+            for item in items
+        ])
+        RecipeTag.objects.bulk_create([
+            RecipeTag(recipe=recipe, tag=tag)
+            for recipe, item in zip(recipes, items)
+            for tag in item['tags']
+        ])
+        IngredientRecipe.objects.bulk_create([
+            IngredientRecipe(
+                recipe=recipe,
+                ingredient_id=ingredient['id'],
+                amount=ingredient['amount']
+            )
+            for recipe, item in zip(recipes, items)
+            for ingredient in item['ingredients']
+        ])
+        update_counter(CustomUser, 'recipes_count', author.pk, len(recipes))
+        for recipe in recipes:
+            schedule_image_processing(recipe)
+
+        recipe_ids = [recipe.pk for recipe in recipes]
+        transaction.on_commit(lambda: fan_out_recipes(author.pk, recipe_ids))
+        transaction.on_commit(lambda: update_search_vectors(
+            Recipe.objects.filter(pk__in=recipe_ids)
+        ))
+        transaction.on_commit(
+            lambda: recipe_ingredient_index.changed(recipe_ids)
+        )
+        transaction.on_commit(lambda: bump_version(Recipe, CustomUser))
+        return recipes
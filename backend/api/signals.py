@@ -0,0 +1,88 @@
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.models import (
+    Favorite,
+    Ingredient,
+    IngredientRecipe,
+    Recipe,
+    RecipeImage,
+    ShoppingCart,
+    Tag
+)
+from users.models import CustomUser, Subscribe
+
+from .authentication import invalidate_tokens
+from .cache import bump_version
+from .membership import bump_membership
+from .metrics import count_user_action
+
+USER_ACTION_KINDS = {
+    Favorite: 'favorite',
+    ShoppingCart: 'shopping_cart',
+    Subscribe: 'subscription',
+}
+
+
+def bump_on_commit(*models):
+    transaction.on_commit(lambda: bump_version(*models))
+
+
+@receiver((post_save, post_delete), sender=Tag)
+@receiver((post_save, post_delete), sender=Ingredient)
+@receiver((post_save, post_delete), sender=Recipe)
+def invalidate_catalog(sender, **kwargs):
+    bump_on_commit(sender)
+
+
+@receiver((post_save, post_delete), sender=IngredientRecipe)
+@receiver((post_save, post_delete), sender=RecipeImage)
+@receiver(m2m_changed, sender=Recipe.tags.through)
+def invalidate_recipe_relations(sender, **kwargs):
+    bump_on_commit(Recipe)
+
+
+@receiver((post_save, post_delete), sender=CustomUser)
+def invalidate_authors(sender, update_fields=None, **kwargs):
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    bump_on_commit(CustomUser)
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_tokens(sender, instance, update_fields=None, **kwargs):
+    """Смена пароля, блокировка и другие правки пользователя."""
+
+    if update_fields and set(update_fields) <= {'last_login'}:
+        return
+    invalidate_tokens(*Token.objects.filter(
+        user=instance
+    ).values_list('key', flat=True))
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    invalidate_tokens(instance.key)
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+@receiver((post_save, post_delete), sender=ShoppingCart)
+@receiver((post_save, post_delete), sender=Subscribe)
+def invalidate_membership(sender, instance, **kwargs):
+    bump_membership(instance.user_id)
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+@receiver((post_save, post_delete), sender=ShoppingCart)
+@receiver((post_save, post_delete), sender=Subscribe)
+def count_user_actions(sender, signal, created=True, **kwargs):
+    """Счётчики для /metrics, только для закоммиченных изменений."""
+
+    if not created:
+        return
+    action = 'add' if signal is post_save else 'remove'
+    transaction.on_commit(
+        lambda: count_user_action(USER_ACTION_KINDS[sender], action)
+    )
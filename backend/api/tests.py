@@ -0,0 +1,627 @@
+import os
+import re
+import tempfile
+from datetime import timedelta
+from io import BytesIO, StringIO
+from unittest import skipUnless
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes import counters, feed
+from recipes.feed import feed_filter
+from recipes.images import process_recipe_image
+from recipes.indexes import ingredient_index, recipe_ingredient_index
+from recipes.models import (
+    Favorite,
+    FeedEntry,
+    Ingredient,
+    IngredientRecipe,
+    Recipe,
+    RecipeImage,
+    RecipeImageUpload,
+    RecipeTag,
+    ShoppingCart,
+    Tag
+)
+from users.models import CustomUser, Subscribe
+from .authentication import token_key, token_version
+from .filters import RecipeFilter
+
+AUTHORS = 510
+
+
+class CatalogMixin:
+    """
+    Общие данные: AUTHORS авторов по одному рецепту с тегами
+    и ингредиентами; пользователь подписан на всех, часть рецептов
+    у него в избранном и в корзине.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create(
+            username='reader', email='reader@example.com'
+        )
+        cls.authors = CustomUser.objects.bulk_create([
+            CustomUser(
+                username='author{0}'.format(number),
+                email='author{0}@example.com'.format(number)
+            )
+            for number in range(AUTHORS)
+        ])
+        cls.tags = Tag.objects.bulk_create([
+            Tag(name='Тег {0}'.format(number), slug='tag-{0}'.format(number))
+            for number in range(3)
+        ])
+        ingredients = Ingredient.objects.bulk_create([
+            Ingredient(name='Ингредиент {0}'.format(number),
+                       measurement_unit='г')
+            for number in range(5)
+        ])
+        cls.recipes = Recipe.objects.bulk_create([
+            Recipe(
+                author=author,
+                name='Рецепт {0}'.format(number),
+                text='Описание',
+                cooking_time=10,
+                image='recipes/test.png'
+            )
+            for number, author in enumerate(cls.authors)
+        ])
+        RecipeTag.objects.bulk_create([
+            RecipeTag(recipe=recipe, tag=tag)
+            for number, recipe in enumerate(cls.recipes)
+            for tag in cls.tags[:number % 3 + 1]
+        ])
+        IngredientRecipe.objects.bulk_create([
+            IngredientRecipe(recipe=recipe, ingredient=ingredient, amount=1)
+            for recipe in cls.recipes
+            for ingredient in ingredients[:3]
+        ])
+        Subscribe.objects.bulk_create([
+            Subscribe(user=cls.user, author=author) for author in cls.authors
+        ])
+        Favorite.objects.bulk_create([
+            Favorite(user=cls.user, recipe=recipe)
+            for recipe in cls.recipes[::2]
+        ])
+        ShoppingCart.objects.bulk_create([
+            ShoppingCart(user=cls.user, recipe=recipe)
+            for recipe in cls.recipes[::3]
+        ])
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+
+class QueryCountTests(CatalogMixin, TestCase):
+    """
+    Число запросов не зависит от размера страницы. Множества избранного,
+    корзины и подписок (api.membership) прогреваются первым запросом:
+    на холодном кэше к каждому ответу добавляется по запросу на множество.
+    """
+
+    PAGE_SIZES = (6, 50, 500)
+
+    def assert_constant_queries(self, url, queries):
+        for limit in self.PAGE_SIZES:
+            with self.subTest(limit=limit):
+                cache.clear()
+                self.client.get(url, {'limit': 1})
+                with self.assertNumQueries(queries):
+                    response = self.client.get(url, {'limit': limit})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.data['results']), limit)
+
+    def test_recipe_list(self):
+        self.assert_constant_queries('/api/recipes/', 6)
+
+    def test_recipe_list_flags(self):
+        response = self.client.get('/api/recipes/', {'limit': 500})
+        favorited = {recipe.pk for recipe in self.recipes[::2]}
+        in_cart = {recipe.pk for recipe in self.recipes[::3]}
+        for recipe in response.data['results']:
+            self.assertEqual(
+                recipe['is_favorited'], recipe['id'] in favorited
+            )
+            self.assertEqual(
+                recipe['is_in_shopping_cart'], recipe['id'] in in_cart
+            )
+            self.assertTrue(recipe['author']['is_subscribed'])
+
+    def test_recipe_detail(self):
+        url = '/api/recipes/{0}/'.format(self.recipes[0].pk)
+        self.client.get(url)
+        with self.assertNumQueries(5):
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['ingredients']), 3)
+
+    def test_subscriptions(self):
+        self.assert_constant_queries('/api/users/subscriptions/', 4)
+
+
+@override_settings(CACHES={
+    'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'}
+})
+class ResponseCacheTests(CatalogMixin, TestCase):
+    """Кэш ответов каталога и анонимного списка рецептов (api.cache)."""
+
+    def setUp(self):
+        super().setUp()
+        self.anonymous = APIClient()
+
+    def test_etag_and_not_modified(self):
+        response = self.anonymous.get('/api/tags/')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('ETag', response)
+        self.assertIn('Last-Modified', response)
+        with self.assertNumQueries(0):
+            cached = self.anonymous.get('/api/tags/')
+            not_modified = self.anonymous.get(
+                '/api/tags/', HTTP_IF_NONE_MATCH=response['ETag']
+            )
+            not_modified_since = self.anonymous.get(
+                '/api/tags/',
+                HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+            )
+        self.assertEqual(cached.content, response.content)
+        self.assertEqual(cached['ETag'], response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        self.assertEqual(not_modified_since.status_code, 200)
+
+    def test_change_within_same_second(self):
+        response = self.anonymous.get('/api/tags/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Новый', slug='new-tag')
+        updated = self.anonymous.get(
+            '/api/tags/', HTTP_IF_MODIFIED_SINCE=response['Last-Modified']
+        )
+        self.assertEqual(updated.status_code, 200)
+        self.assertIn('new-tag', {tag['slug'] for tag in updated.json()})
+
+    def test_write_bumps_version(self):
+        response = self.anonymous.get('/api/tags/')
+        with self.captureOnCommitCallbacks(execute=True):
+            Tag.objects.create(name='Новый', slug='new-tag')
+        updated = self.anonymous.get(
+            '/api/tags/', HTTP_IF_NONE_MATCH=response['ETag']
+        )
+        self.assertEqual(updated.status_code, 200)
+        self.assertNotEqual(updated['ETag'], response['ETag'])
+        self.assertIn('new-tag', {tag['slug'] for tag in updated.json()})
+
+    def test_recipe_write_bumps_version(self):
+        recipe = self.recipes[-1]
+        url = '/api/recipes/{0}/'.format(recipe.pk)
+        response = self.anonymous.get(url)
+        recipe.name = 'Переименованный'
+        with self.captureOnCommitCallbacks(execute=True):
+            recipe.save()
+        updated = self.anonymous.get(url)
+        self.assertNotEqual(updated['ETag'], response['ETag'])
+        self.assertEqual(updated.json()['name'], 'Переименованный')
+
+    def test_popular_ordering_follows_counters(self):
+        params = {'ordering': 'popular', 'limit': 1}
+        first = self.anonymous.get('/api/recipes/', params)
+        recipe = self.recipes[0]
+        self.assertNotEqual(first.json()['results'][0]['id'], recipe.pk)
+        counters.update_counter(Recipe, 'favorites_count', recipe.pk, 1000)
+        response = self.anonymous.get('/api/recipes/', params)
+        self.assertEqual(response.json()['results'][0]['id'], recipe.pk)
+
+    def test_anonymous_and_authenticated_separated(self):
+        anonymous = self.anonymous.get('/api/recipes/', {'limit': 6})
+        favorited = {recipe.pk for recipe in self.recipes[::2]}
+
+        response = self.client.get('/api/recipes/', {'limit': 6})
+        self.assertNotIn('ETag', response)
+        for recipe in response.data['results']:
+            self.assertEqual(
+                recipe['is_favorited'], recipe['id'] in favorited
+            )
+        self.assertTrue(any(
+            recipe['is_favorited'] for recipe in response.data['results']
+        ))
+
+        with self.assertNumQueries(0):
+            cached = self.anonymous.get('/api/recipes/', {'limit': 6})
+        self.assertEqual(cached.content, anonymous.content)
+        self.assertFalse(any(
+            recipe['is_favorited'] for recipe in cached.json()['results']
+        ))
+
+
+class FeedTests(CatalogMixin, TestCase):
+
+    def test_backfill_when_author_stops_being_popular(self):
+        author = self.authors[0]
+        CustomUser.objects.filter(pk=author.pk).update(followers_count=1)
+        with self.settings(FEED_FANOUT_LIMIT=0):
+            self.assertIn(author.pk, feed.popular_author_ids())
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe = Recipe.objects.create(
+                    author=author,
+                    name='Рецепт популярного автора',
+                    text='Описание',
+                    cooking_time=10,
+                    image='recipes/test.png'
+                )
+        self.assertFalse(FeedEntry.objects.filter(recipe=recipe).exists())
+
+        cache.delete(feed.POPULAR_AUTHORS_KEY)
+        self.assertNotIn(author.pk, feed.popular_author_ids())
+        self.assertFalse(FeedEntry.objects.filter(recipe=recipe).exists())
+        call_command('backfill_feed', stdout=StringIO())
+        self.assertTrue(FeedEntry.objects.filter(
+            user=self.user, recipe=recipe
+        ).exists())
+        self.assertEqual(feed.backfill_pending(), 0)
+
+    def test_recompute_is_locked(self):
+        cache.set(feed.PREVIOUS_POPULAR_AUTHORS_KEY, frozenset({0}), None)
+        with feed.popular_authors_lock(wait=False) as locked:
+            self.assertTrue(locked)
+            with self.assertNumQueries(0):
+                self.assertEqual(feed.popular_author_ids(), {0})
+        with self.assertNumQueries(1):
+            self.assertEqual(feed.popular_author_ids(), frozenset())
+
+
+class IngredientIndexTests(TestCase):
+
+    def test_prefix_then_infix_by_position(self):
+        Ingredient.objects.bulk_create([
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('Морская соль', 'соль', 'Фасоль', 'сода', 'мёд')
+        ])
+        data = ingredient_index.build()
+
+        def names(query, limit=20):
+            return [
+                item['name']
+                for item in ingredient_index.match(data, query, limit)
+            ]
+
+        self.assertEqual(
+            names('со'), ['сода', 'соль', 'Фасоль', 'Морская соль']
+        )
+        self.assertEqual(names('оль'), ['соль', 'Фасоль', 'Морская соль'])
+        self.assertEqual(names('ская с'), ['Морская соль'])
+        self.assertEqual(names('со', limit=3), ['сода', 'соль', 'Фасоль'])
+        self.assertEqual(names('ъ'), [])
+
+
+class RecipeIngredientIndexTests(CatalogMixin, TestCase):
+
+    def test_update_does_not_touch_previous_version(self):
+        recipe = self.recipes[0]
+        recipe_ingredient_index.invalidate()
+        postings, recipes = recipe_ingredient_index.get()
+        ingredient_id = next(iter(recipes[recipe.pk]))
+        before = (
+            {key: list(value) for key, value in postings.items()},
+            dict(recipes)
+        )
+
+        IngredientRecipe.objects.filter(
+            recipe=recipe, ingredient_id=ingredient_id
+        ).delete()
+        recipe_ingredient_index.changed([recipe.pk])
+        new_postings, new_recipes = recipe_ingredient_index.get()
+
+        self.assertNotIn(recipe.pk, new_postings[ingredient_id])
+        self.assertNotIn(ingredient_id, new_recipes[recipe.pk])
+        self.assertEqual(
+            {key: list(value) for key, value in postings.items()}, before[0]
+        )
+        self.assertEqual(recipes, before[1])
+
+
+class RecipeImageTests(CatalogMixin, TestCase):
+
+    def test_webp_and_jpeg_variants(self):
+        recipe = self.recipes[0]
+        buffer = BytesIO()
+        Image.new('RGBA', (800, 400), (255, 0, 0, 128)).save(
+            buffer, format='PNG'
+        )
+        with tempfile.TemporaryDirectory() as media:
+            with self.settings(MEDIA_ROOT=media):
+                recipe.image.save(
+                    'source.png', ContentFile(buffer.getvalue()), save=False
+                )
+                Recipe.objects.filter(pk=recipe.pk).update(
+                    image=recipe.image.name
+                )
+                process_recipe_image(recipe.pk)
+                variants = {
+                    (variant.kind, variant.format): variant
+                    for variant in RecipeImage.objects.filter(recipe=recipe)
+                }
+                card = variants[(RecipeImage.CARD, RecipeImage.JPEG)]
+                with Image.open(card.image.path) as image:
+                    jpeg = (image.format, image.mode, image.size)
+                response = self.client.get(
+                    '/api/recipes/{0}/'.format(recipe.pk)
+                )
+
+        self.assertEqual(len(variants), 6)
+        self.assertEqual(jpeg, ('JPEG', 'RGB', (640, 320)))
+        self.assertTrue(response.data['image'].endswith('-full.webp'))
+        self.assertTrue(response.data['image_jpeg'].endswith('-full.jpg'))
+
+    def test_cleanup_expired_uploads(self):
+        with tempfile.TemporaryDirectory() as media:
+            with self.settings(MEDIA_ROOT=media):
+                expired, fresh = [
+                    RecipeImageUpload.objects.create(
+                        user=self.user,
+                        image=ContentFile(b'image', name='upload.png')
+                    )
+                    for _ in range(2)
+                ]
+                RecipeImageUpload.objects.filter(pk=expired.pk).update(
+                    created=timezone.now() - timedelta(
+                        seconds=settings.RECIPE_IMAGE_UPLOAD_TTL + 1
+                    )
+                )
+                call_command('cleanup_image_uploads', stdout=StringIO())
+                exists = [
+                    os.path.exists(upload.image.path)
+                    for upload in (expired, fresh)
+                ]
+
+        self.assertEqual(exists, [False, True])
+        self.assertQuerysetEqual(
+            RecipeImageUpload.objects.all(), [fresh]
+        )
+        self.assertFalse(expired.claim())
+
+
+class TokenAuthenticationTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.user = CustomUser.objects.create(
+            username='reader', email='reader@example.com'
+        )
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + self.token.key)
+
+    def test_logout(self):
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post('/api/auth/token/logout/')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 401)
+
+    def test_stale_cache_write_after_logout(self):
+        """Запрос, прочитавший токен до выхода, пишет в кэш после него."""
+
+        version = token_version()
+        with self.captureOnCommitCallbacks(execute=True):
+            self.token.delete()
+        cache.set(token_key(self.token.key, version), self.user)
+        self.assertEqual(self.client.get('/api/users/me/').status_code, 401)
+
+
+class CounterTests(CatalogMixin, TestCase):
+
+    def test_reconcile_drops_buffered_deltas(self):
+        recipe = self.recipes[0]
+        counters.add(Recipe, 'favorites_count', recipe.pk, 1)
+        call_command('reconcile_counters', stdout=StringIO())
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+
+        counters.flush()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+
+        counters.add(Recipe, 'favorites_count', recipe.pk, 1)
+        counters.flush()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 2)
+
+    def test_decrement_flushed_before_increment(self):
+        """Удаление из избранного записал процесс, не видевший добавления."""
+
+        recipe = self.recipes[1]
+        counters.add(Recipe, 'favorites_count', recipe.pk, -1)
+        counters.flush()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+
+        counters.add(Recipe, 'favorites_count', recipe.pk, 1)
+        counters.flush()
+        recipe.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 0)
+
+
+@skipUnless(
+    os.path.exists(settings.SHOPPING_LIST_PDF_FONT), 'Нет шрифта для PDF.'
+)
+class ShoppingListPDFTests(CatalogMixin, TestCase):
+
+    def test_pdf(self):
+        call_command('rebuild_shopping_cart_totals', stdout=StringIO())
+        response = self.client.get(
+            '/api/recipes/download_shopping_cart/', {'format': 'pdf'}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'application/pdf')
+        content = b''.join(response.streaming_content)
+        self.assertTrue(content.startswith(b'%PDF-1.4'))
+        self.assertTrue(content.endswith(b'%%EOF\n'))
+
+        xref = int(re.search(rb'startxref\n(\d+)', content).group(1))
+        self.assertEqual(content[xref:xref + 4], b'xref')
+        offsets = re.findall(rb'(\d{10}) 00000 n ', content[xref:])
+        for number, offset in enumerate(offsets, start=1):
+            self.assertEqual(
+                content[int(offset):].split(b'\n', 1)[0],
+                b'%d 0 obj' % number
+            )
+        self.assertIn(b'/FontFile2', content)
+
+
+class RecipeFilterTests(CatalogMixin, TestCase):
+
+    def test_ordering_keeps_order_with_cursor_pagination(self):
+        popular = self.recipes[-3:]
+        for count, recipe in enumerate(popular, start=1):
+            Recipe.objects.filter(pk=recipe.pk).update(favorites_count=count)
+            FeedEntry.objects.create(user=self.user, recipe=recipe)
+        expected = [recipe.pk for recipe in reversed(popular)]
+        for url, params in (
+            ('/api/recipes/', {'pagination': 'cursor'}),
+            ('/api/recipes/feed/', {}),
+        ):
+            with self.subTest(url=url):
+                response = self.client.get(
+                    url, dict(params, ordering='popular', limit=3)
+                )
+                self.assertEqual(response.status_code, 200)
+                self.assertIn('count', response.data)
+                self.assertEqual(
+                    [recipe['id'] for recipe in response.data['results']],
+                    expected
+                )
+
+    def test_tags_without_duplicates(self):
+        response = self.client.get('/api/recipes/', {
+            'tags': ['tag-0', 'tag-1', 'tag-2'],
+            'is_favorited': 1,
+            'is_in_shopping_cart': 1,
+            'limit': 500,
+        })
+        ids = [recipe['id'] for recipe in response.data['results']]
+        self.assertEqual(len(ids), len(set(ids)))
+        self.assertEqual(
+            set(ids), {recipe.pk for recipe in self.recipes[::6]}
+        )
+        self.assertEqual(response.data['count'], len(ids))
+
+
+@skipUnless(
+    connection.vendor == 'postgresql', 'Векторы только для PostgreSQL.'
+)
+class SearchVectorTests(CatalogMixin, TestCase):
+
+    def rename(self, recipe, name):
+        recipe.name = name
+        recipe.save()
+
+    def assert_found(self, recipe, query):
+        self.assertTrue(Recipe.objects.filter(
+            pk=recipe.pk, search_vector=SearchQuery(
+                query, config=settings.SEARCH_CONFIG
+            )
+        ).exists())
+
+    def test_one_update_per_transaction(self):
+        recipe, other = self.recipes[:2]
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.rename(recipe, 'борщ')
+                self.rename(other, 'солянка')
+        self.assertEqual(len([
+            query for query in queries.captured_queries
+            if query['sql'].startswith('UPDATE')
+            and '"search_vector"' in query['sql']
+        ]), 1)
+        self.assert_found(recipe, 'борщ')
+        self.assert_found(other, 'солянка')
+
+    def test_after_rollback(self):
+        recipe = self.recipes[0]
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(ValueError):
+                with transaction.atomic():
+                    self.rename(recipe, 'окрошка')
+                    raise ValueError
+        self.assertEqual(callbacks, [])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.rename(recipe, 'борщ')
+        self.assert_found(recipe, 'борщ')
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Планы только для PostgreSQL.')
+class QueryPlanTests(CatalogMixin, TestCase):
+    """
+    Запросы списка, фильтров и ленты используют свои индексы.
+    Данных в тесте мало, поэтому последовательное чтение выключено:
+    план показывает, подходит ли индекс запросу вообще. Статистику
+    собираем сразу: без неё оценки зависят от того, успел ли autovacuum.
+    """
+
+    def explain(self, queryset):
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return queryset.explain()
+
+    def assert_uses_index(self, queryset, index):
+        self.assertIn(index, self.explain(queryset))
+
+    def assert_no_seq_scan(self, queryset, model):
+        self.assertNotIn(
+            'Seq Scan on {0}'.format(model._meta.db_table),
+            self.explain(queryset)
+        )
+
+    def filtered(self, **params):
+        request = RequestFactory().get('/api/recipes/', params)
+        request.user = self.user
+        return RecipeFilter(
+            request.GET, queryset=Recipe.objects.all(), request=request
+        ).qs[:6]
+
+    def test_list(self):
+        self.assert_uses_index(
+            Recipe.objects.all()[:6], 'recipe_pub_date_id_idx'
+        )
+
+    def test_filter_tags(self):
+        self.assert_no_seq_scan(
+            self.filtered(tags=['tag-0', 'tag-1']), RecipeTag
+        )
+
+    def test_filter_favorited(self):
+        self.assert_no_seq_scan(self.filtered(is_favorited=1), Favorite)
+
+    def test_filter_shopping_cart(self):
+        self.assert_no_seq_scan(
+            self.filtered(is_in_shopping_cart=1), ShoppingCart
+        )
+
+    def test_ordering_popular(self):
+        self.assert_uses_index(
+            self.filtered(ordering='popular'), 'recipe_popular_idx'
+        )
+
+    def test_search(self):
+        self.assert_uses_index(
+            self.filtered(search='рецепт'), 'recipe_search_vector_idx'
+        )
+
+    def test_feed(self):
+        self.assert_no_seq_scan(
+            Recipe.objects.filter(feed_filter(self.user))[:6], FeedEntry
+        )
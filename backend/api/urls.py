@@ -1,4 +1,5 @@
-from django.urls import include, path
+from django.conf import settings
+from django.urls import include, path, re_path
 from rest_framework import routers
 
 from .views import (
@@ -6,6 +7,7 @@ from .views import (
     TagViewSet,
     IngredientViewSet,
     RecipeViewSet,
+    health,
 )
 
 app_name = 'api'
@@ -20,4 +22,19 @@ router.register(r'recipes', RecipeViewSet)
 urlpatterns = [
     path('', include(router.urls)),
     path('auth/', include('djoser.urls.authtoken')),
+    path('health/', health),
 ]
+
+if settings.ASYNC_VIEWS:
+    from . import async_views
+
+    urlpatterns = [
+        path('recipes/', async_views.recipe_list),
+        path(
+            'recipes/download_shopping_cart/',
+            async_views.download_shopping_cart
+        ),
+        re_path(r'^recipes/(?P<pk>\d+)/$', async_views.recipe_detail),
+        path('tags/', async_views.tag_list),
+        path('ingredients/', async_views.ingredient_list),
+    ] + urlpatterns
@@ -1,32 +1,51 @@
-from django.http import HttpResponse
-from django.db.models import Sum
+from django.db.models import (
+    F,
+    Window,
+    prefetch_related_objects
+)
+from django.db.models.functions import RowNumber
+from django.db import DatabaseError, connection, transaction
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.response import Response
 from rest_framework import (
+    parsers,
     viewsets,
     permissions,
     decorators,
     status,
-    filters
+    filters,
+    exceptions
 )
 from djoser.views import UserViewSet
 
+from .cache import CachedResponseMixin
 from .filters import (
     IngredientFilter,
     RecipeFilter
 )
+from .links import delete_links, insert_links
+from .pagination import RecipeCursorPagination
+from .parsers import RawImageParser
 from .permissions import (
     IsAuthorOrAdminOrReadOnly
 )
+from .renderers import (
+    FormatParameterNegotiation,
+    ShoppingListCSVRenderer,
+    ShoppingListPDFRenderer,
+    ShoppingListTextRenderer
+)
 from recipes.models import (
     Tag,
     Ingredient,
     Recipe,
-    IngredientRecipe,
     Favorite,
-    ShoppingCart
+    ShoppingCart,
+    ShoppingCartIngredient
 )
+from recipes.feed import feed_filter
+from recipes.indexes import ingredient_index, recipe_ingredient_index
 from users.models import (
     CustomUser,
     Subscribe
@@ -36,12 +55,19 @@ from .serializers import (
     SubscribeSerializer,
     TagSerializer,
     IngredientSerializer,
+    RecipeCookableSerializer,
     RecipeGetSerializer,
+    RecipeBatchSerializer,
+    RecipeImageUploadSerializer,
     RecipePostSerializer,
-    RecipeShowSerializer
+    RecipeShowSerializer,
+    ShoppingCartBulkSerializer
 )
 
 
+SHOPPING_LIST_CHUNK_SIZE = 2000
+
+
 class CustomUserViewSet(UserViewSet):
     queryset = CustomUser.objects.all()
     serializer_class = CustomUserSerializer
@@ -54,13 +80,52 @@ class CustomUserViewSet(UserViewSet):
     )
     def subscriptions(self, request):
         user = request.user
-        queryset = CustomUser.objects.filter(following__user=user)
+        queryset = CustomUser.objects.filter(
+            following__user=user
+        )
         page = self.paginate_queryset(queryset)
+        self.add_recipes_preview(page, request.GET.get('recipes_limit'))
         serializer = SubscribeSerializer(
             page, context={'request': request}, many=True,
         )
         return self.get_paginated_response(serializer.data)
 
+    def add_recipes_preview(self, authors, recipes_limit):
+        """
+        Одним запросом получаем последние рецепты всех авторов страницы:
+        ROW_NUMBER() по каждому автору отсекает лишние рецепты в базе.
+        """
+
+        if not authors:
+            return
+        recipes = Recipe.objects.filter(
+            author__in=authors
+        ).only(
+            'id', 'name', 'image', 'cooking_time', 'author_id'
+        )
+        if recipes_limit:
+            windowed = recipes.annotate(
+                row_number=Window(
+                    expression=RowNumber(),
+                    partition_by=[F('author_id')],
+                    order_by=[F('pub_date').desc(), F('id').desc()]
+                )
+            )
+            sql, params = windowed.query.sql_with_params()
+            recipes = Recipe.objects.raw(
+                'SELECT * FROM ({0}) recipes_preview '
+                'WHERE row_number <= %s '
+                'ORDER BY author_id, row_number'.format(sql),
+                (*params, int(recipes_limit))
+            )
+        recipes = list(recipes)
+        prefetch_related_objects(recipes, 'images')
+        previews = {author.id: [] for author in authors}
+        for recipe in recipes:
+            previews[recipe.author_id].append(recipe)
+        for author in authors:
+            author.recipes_preview = previews[author.id]
+
     @decorators.action(
         detail=True,
         methods=['POST', 'DELETE'],
@@ -68,37 +133,35 @@ class CustomUserViewSet(UserViewSet):
     )
     def subscribe(self, request, id):
         user = request.user
-        author = get_object_or_404(CustomUser, id=id)
 
         if request.method == 'POST':
-
+            author = get_object_or_404(CustomUser, id=id)
             if user.id == author.id:
                 return Response(status=status.HTTP_400_BAD_REQUEST)
-            if Subscribe.objects.filter(user=user, author=author).exists():
+            if not insert_links(Subscribe, user.id, 'author', [author.id]):
                 return Response(status=status.HTTP_400_BAD_REQUEST)
-            Subscribe.objects.create(user=user, author=author)
             serializer = SubscribeSerializer(
                 author, context={'request': request}
             )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        if not Subscribe.objects.filter(user=user, author=author).exists():
+        if not delete_links(Subscribe, user.id, 'author', [id]):
+            get_object_or_404(CustomUser, id=id)
             return Response(status=status.HTTP_400_BAD_REQUEST)
-        subsctiption = get_object_or_404(
-            Subscribe, user=user, author=author
-        )
-        subsctiption.delete()
         return Response(status=status.HTTP_204_NO_CONTENT)
 
 
-class TagViewSet(viewsets.ReadOnlyModelViewSet):
+class TagViewSet(CachedResponseMixin, viewsets.ReadOnlyModelViewSet):
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
     permission_classes = (permissions.AllowAny,)
     pagination_class = None
+    cache_models = (Tag,)
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(
+    CachedResponseMixin, viewsets.ReadOnlyModelViewSet
+):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     permission_classes = (permissions.AllowAny,)
@@ -106,42 +169,233 @@ class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
     filterset_class = IngredientFilter
     search_fields = ('name',)
     pagination_class = None
+    cache_models = (Ingredient,)
+    autocomplete_limit = 20
+
+    def list(self, request, *args, **kwargs):
+        """
+        Поиск по названию обслуживаем из индекса в памяти:
+        сначала совпадения по началу названия, затем по вхождению.
+        """
+
+        name = request.query_params.get('name')
+        if name is None:
+            return super().list(request, *args, **kwargs)
+        return Response(
+            ingredient_index.search(name, self.autocomplete_limit)
+        )
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     permission_classes = (IsAuthorOrAdminOrReadOnly,)
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeFilter
+    cache_models = (Recipe, Tag, Ingredient, CustomUser)
+
+    def is_cacheable(self, request):
+        """
+        Порядок ordering=popular зависит от счётчиков избранного,
+        а они пишутся без смены версии модели: такие ответы не кэшируем.
+        """
+
+        return (
+            request.user.is_anonymous
+            and 'ordering' not in request.query_params
+            and super().is_cacheable(request)
+        )
+
+    @property
+    def paginator(self):
+        """
+        Курсорная пагинация включается в списке параметром
+        pagination=cursor (в ленте подписок - всегда),
+        по умолчанию остаётся постраничная. Курсор умеет только
+        порядок (pub_date, id), поэтому с search и ordering
+        используется постраничная: она сохраняет их порядок.
+        """
+
+        if not hasattr(self, '_paginator'):
+            params = self.request.query_params
+            reordered = any(
+                params.get(name) for name in ('search', 'ordering')
+            )
+            if not reordered and (
+                self.action == 'feed' or (
+                    self.action == 'list'
+                    and params.get('pagination') == 'cursor'
+                )
+            ):
+                self._paginator = RecipeCursorPagination()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
+
+    def get_queryset(self):
+        """
+        Подгружаем связанные объекты заранее, чтобы число запросов
+        не зависело от размера страницы. Флаги избранного, корзины
+        и подписок берутся из множеств пользователя (api.membership).
+        Изменение и удаление перечитывают связи сами.
+        """
+
+        queryset = Recipe.objects.select_related('author')
+        if self.action in ('update', 'partial_update', 'destroy'):
+            return queryset
+        return queryset.prefetch_related(
+            'tags', 'ingredient_recipe__ingredient', 'images'
+        )
 
     def get_serializer_class(self):
         if self.request.method == 'GET':
             return RecipeGetSerializer
         return RecipePostSerializer
 
+    @transaction.atomic
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
 
+    @transaction.atomic
+    def perform_update(self, serializer):
+        serializer.save()
+
+    @transaction.atomic
+    def perform_destroy(self, instance):
+        instance.delete()
+
     def post_delete_action(self, request, pk, model):
+        """
+        Добавление и удаление одним запросом к связующей таблице:
+        повторное или одновременное добавление даёт 400, а не 500.
+        """
+
         user = self.request.user
-        recipe = get_object_or_404(Recipe, pk=pk)
 
         if self.request.method == 'POST':
-
-            if model.objects.filter(user=user, recipe=recipe).exists():
-                return Response(status=status.HTTP_400_BAD_REQUEST)
-            model.objects.create(user=user, recipe=recipe)
+            recipe = get_object_or_404(Recipe, pk=pk)
+            with transaction.atomic():
+                if not insert_links(model, user.id, 'recipe', [recipe.pk]):
+                    return Response(status=status.HTTP_400_BAD_REQUEST)
+                if model is ShoppingCart:
+                    ShoppingCartIngredient.objects.add_recipe(user, recipe)
             serializer = RecipeShowSerializer(
                 recipe, context={'request': request}
             )
             return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-        if not model.objects.filter(user=user, recipe=recipe).exists():
-            return Response(status=status.HTTP_400_BAD_REQUEST)
-        model_instance = model.objects.get(user=user, recipe=recipe)
-        model_instance.delete()
+        with transaction.atomic():
+            if not delete_links(model, user.id, 'recipe', [pk]):
+                get_object_or_404(Recipe, pk=pk)
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            if model is ShoppingCart:
+                ShoppingCartIngredient.objects.remove_recipe(user, pk)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    @decorators.action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=(permissions.IsAuthenticated,)
+    )
+    def feed(self, request):
+        """Рецепты авторов, на которых подписан пользователь."""
+
+        queryset = self.filter_queryset(
+            self.get_queryset().filter(feed_filter(request.user))
+        )
+        page = self.paginate_queryset(queryset)
+        serializer = self.get_serializer(page, many=True)
+        return self.get_paginated_response(serializer.data)
+
+    @decorators.action(
+        detail=False,
+        methods=['GET']
+    )
+    def cookable(self, request):
+        """
+        Что можно приготовить из ингредиентов (параметр ingredients,
+        id через запятую): рецепты по убыванию доли имеющихся
+        ингредиентов, с недостающими. Подбор - по индексу в памяти.
+        """
+
+        try:
+            ingredient_ids = {
+                int(value)
+                for values in request.query_params.getlist('ingredients')
+                for value in values.split(',') if value
+            }
+        except ValueError:
+            raise exceptions.ValidationError(
+                {'ingredients': 'Укажите id ингредиентов через запятую.'}
+            )
+        page = self.paginate_queryset(
+            recipe_ingredient_index.search(ingredient_ids)
+        )
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for recipe_id, _ in page]
+        )
+        serializer = RecipeCookableSerializer(
+            [
+                recipes[recipe_id] for recipe_id, _ in page
+                if recipe_id in recipes
+            ],
+            many=True,
+            context={
+                **self.get_serializer_context(),
+                'available_ingredients': ingredient_ids
+            }
+        )
+        return self.get_paginated_response(serializer.data)
+
+    @decorators.action(
+        detail=False,
+        methods=['POST'],
+        permission_classes=(permissions.IsAuthenticated,),
+        parser_classes=(parsers.MultiPartParser, RawImageParser),
+        url_path='images'
+    )
+    def upload_image(self, request):
+        """
+        Загрузка изображения файлом (multipart, поле image)
+        или телом запроса. Возвращает токен для поля image_token.
+        """
+
+        serializer = RecipeImageUploadSerializer(
+            data={
+                'image': request.FILES.get('image')
+                or request.FILES.get('file')
+            },
+            context={'request': request}
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save(user=request.user)
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    @decorators.action(
+        detail=False,
+        methods=['POST'],
+        permission_classes=(permissions.IsAuthenticated,)
+    )
+    def batch(self, request):
+        """
+        Создание нескольких рецептов одной транзакцией:
+        {"recipes": [рецепт, ...]}, не больше RECIPE_BATCH_LIMIT.
+        Ошибка в любом рецепте - 400, не создаётся ни один.
+        """
+
+        serializer = RecipeBatchSerializer(
+            data=request.data, context=self.get_serializer_context()
+        )
+        serializer.is_valid(raise_exception=True)
+        with transaction.atomic():
+            recipes = serializer.save(author=request.user)
+        prefetch_related_objects(
+            recipes, 'tags', 'ingredient_recipe__ingredient', 'images'
+        )
+        serializer = RecipeGetSerializer(
+            recipes, many=True, context={'request': request}
+        )
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
     @decorators.action(
         detail=True,
         methods=['POST', 'DELETE'],
@@ -168,29 +422,86 @@ class RecipeViewSet(viewsets.ModelViewSet):
 
     @decorators.action(
         detail=False,
-        methods=['GET'],
-        permission_classes=(permissions.IsAuthenticated,)
+        methods=['POST', 'DELETE'],
+        permission_classes=(permissions.IsAuthenticated,),
+        url_path='shopping_cart'
     )
-    def download_shopping_cart(self, request):
-        file_name = 'shopping-list.txt'
-        user = self.request.user
-        ingredients = IngredientRecipe.objects.filter(
-            recipe__in_shopping_cart__user=user
-        ).values_list(
-            'ingredient__name', 'ingredient__measurement_unit'
-        ).annotate(Sum('amount'))
-        lines = []
-        for ingredient in ingredients:
-            lines.append(
-                'Игрединет: {0}. Количество: {1} {2}.'.format(
-                    ingredient[0], ingredient[2], ingredient[1]
+    def shopping_cart_bulk(self, request):
+        """
+        Добавление в корзину или удаление из неё нескольких рецептов
+        сразу: {"recipes": [id, ...]}. Уже добавленные (или уже
+        удалённые) рецепты пропускаются; если не изменилось ничего - 400.
+        """
+
+        serializer = ShoppingCartBulkSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        recipe_ids = serializer.validated_data['recipes']
+        user = request.user
+
+        if request.method == 'POST':
+            with transaction.atomic():
+                links = insert_links(
+                    ShoppingCart, user.id, 'recipe', recipe_ids
                 )
+                if not links:
+                    return Response(status=status.HTTP_400_BAD_REQUEST)
+                added = [link.recipe_id for link in links]
+                ShoppingCartIngredient.objects.add_recipes(user, added)
+            serializer = RecipeShowSerializer(
+                Recipe.objects.filter(pk__in=added).prefetch_related(
+                    'images'
+                ),
+                many=True,
+                context={'request': request}
             )
-        file_content = '\n'.join(lines)
-        response = HttpResponse(
-            file_content, content_type="text/plain,charset=utf8"
-        )
-        response['Content-Disposition'] = 'attachment; filename={0}'.format(
-            file_name
+            return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+        with transaction.atomic():
+            links = delete_links(ShoppingCart, user.id, 'recipe', recipe_ids)
+            if not links:
+                return Response(status=status.HTTP_400_BAD_REQUEST)
+            ShoppingCartIngredient.objects.remove_recipes(
+                user, [link.recipe_id for link in links]
+            )
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+    @decorators.action(
+        detail=False,
+        methods=['GET'],
+        permission_classes=(permissions.IsAuthenticated,),
+        renderer_classes=(
+            ShoppingListTextRenderer,
+            ShoppingListCSVRenderer,
+            ShoppingListPDFRenderer
+        ),
+        content_negotiation_class=FormatParameterNegotiation
+    )
+    def download_shopping_cart(self, request):
+        """
+        Потоково отдаём список покупок из заранее посчитанных сумм,
+        формат выбирается параметром format.
+        """
+
+        renderer = request.accepted_renderer
+        return renderer.streaming_response(renderer.render_rows(
+            ShoppingCartIngredient.objects.shopping_list(
+                request.user
+            ).iterator(chunk_size=SHOPPING_LIST_CHUNK_SIZE)
+        ))
+
+
+@decorators.api_view(['GET'])
+@decorators.authentication_classes([])
+@decorators.permission_classes([permissions.AllowAny])
+def health(request):
+    """Для healthcheck: процесс отвечает и база доступна."""
+
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute('SELECT 1')
+    except DatabaseError:
+        return Response(
+            {'status': 'unavailable'},
+            status=status.HTTP_503_SERVICE_UNAVAILABLE
         )
-        return response
+    return Response({'status': 'ok'})
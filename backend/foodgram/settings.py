@@ -22,6 +22,7 @@ INSTALLED_APPS = [
     'django.contrib.sessions',
     'django.contrib.messages',
     'django.contrib.staticfiles',
+    'django.contrib.postgres',
     'api.apps.ApiConfig',
     'recipes.apps.RecipesConfig',
     'users.apps.UsersConfig',
@@ -33,6 +34,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'api.middleware.PerformanceMiddleware',
+    'api.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -64,6 +67,11 @@ WSGI_APPLICATION = 'foodgram.wsgi.application'
 
 
 # Database
+# Соединение живёт DB_CONN_MAX_AGE секунд и переиспользуется запросами
+# воркера, перед повторным использованием проверяется (CONN_HEALTH_CHECKS).
+# Под ASGI постоянные соединения выключены (foodgram/asgi.py):
+# там соединения держит PgBouncer. В режиме пула transaction
+# серверные курсоры не работают - DB_DISABLE_SERVER_SIDE_CURSORS=True.
 
 DATABASES = {
     'default': {
@@ -72,7 +80,29 @@ DATABASES = {
         'USER': os.getenv('POSTGRES_USER', 'foodgram_user'),
         'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
         'HOST': os.getenv('DB_HOST', ''),
-        'PORT': os.getenv('DB_PORT', 5432)
+        'PORT': os.getenv('DB_PORT', 5432),
+        'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 60)),
+        'CONN_HEALTH_CHECKS': True,
+        'DISABLE_SERVER_SIDE_CURSORS': os.getenv(
+            'DB_DISABLE_SERVER_SIDE_CURSORS', 'False'
+        ) == 'True',
+    }
+}
+
+
+# Cache
+# Общий кэш ответов каталога и версий индексов в памяти.
+# С несколькими воркерами нужен общий для процессов бэкенд, иначе сброс
+# версий, токенов и индексов виден только одному процессу. В docker-compose
+# это django.core.cache.backends.redis.RedisCache (LOCATION redis://...);
+# gunicorn с кэшем в памяти процесса запускает один воркер.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+        ),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
     }
 }
 
@@ -103,8 +133,6 @@ TIME_ZONE = 'UTC'
 
 USE_I18N = True
 
-USE_L10N = True
-
 USE_TZ = True
 
 
@@ -116,6 +144,104 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'static_backend')
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Фоновая обработка изображений рецептов
+
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+IMAGE_QUALITY = int(os.getenv('IMAGE_QUALITY', 80))
+
+# Файлы больше FILE_UPLOAD_MAX_MEMORY_SIZE Django пишет во временный
+# файл на диске частями, поэтому память на загрузку ограничена.
+
+RECIPE_IMAGE_MAX_SIZE = int(
+    os.getenv('RECIPE_IMAGE_MAX_SIZE', 10 * 1024 * 1024)
+)
+
+# Загрузка, не привязанная к рецепту за RECIPE_IMAGE_UPLOAD_TTL секунд,
+# больше не принимается; команда cleanup_image_uploads удаляет её файл.
+
+RECIPE_IMAGE_UPLOAD_TTL = int(
+    os.getenv('RECIPE_IMAGE_UPLOAD_TTL', 24 * 60 * 60)
+)
+
+# Лента подписок: рецепты авторов, у которых подписчиков больше
+# FEED_FANOUT_LIMIT, не раскладываются по лентам, а читаются напрямую.
+
+FEED_FANOUT_LIMIT = int(os.getenv('FEED_FANOUT_LIMIT', 5000))
+FEED_BACKFILL = int(os.getenv('FEED_BACKFILL', 100))
+
+# Массовое создание рецептов (POST /api/recipes/batch/):
+# не больше RECIPE_BATCH_LIMIT рецептов в одной транзакции.
+
+RECIPE_BATCH_LIMIT = int(os.getenv('RECIPE_BATCH_LIMIT', 100))
+
+# Счётчики избранного, корзин и подписчиков копятся в памяти процесса
+# и пишутся пачкой; расхождения исправляет reconcile_counters.
+# Пока база недоступна, в буфере держится не больше COUNTER_BUFFER_LIMIT
+# строк, остальные приращения отбрасываются с записью в лог.
+
+COUNTER_FLUSH_INTERVAL = float(os.getenv('COUNTER_FLUSH_INTERVAL', 5))
+COUNTER_FLUSH_SIZE = int(os.getenv('COUNTER_FLUSH_SIZE', 500))
+COUNTER_BUFFER_LIMIT = int(os.getenv('COUNTER_BUFFER_LIMIT', 50000))
+
+# Асинхронные представления для горячих GET-запросов.
+# Включаются в foodgram/asgi.py, под WSGI не нужны.
+
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', 'False') == 'True'
+
+# Профилирование запросов (api.middleware.PerformanceMiddleware):
+# доля профилируемых запросов и пороги записи в лог api.performance -
+# время ответа (мс), число SQL-запросов и повторы одного запроса.
+
+PERFORMANCE_PROFILING = os.getenv('PERFORMANCE_PROFILING', 'False') == 'True'
+PERFORMANCE_SAMPLE_RATE = float(os.getenv('PERFORMANCE_SAMPLE_RATE', 1))
+PERFORMANCE_SLOW_REQUEST_MS = int(
+    os.getenv('PERFORMANCE_SLOW_REQUEST_MS', 500)
+)
+PERFORMANCE_SLOW_QUERY_COUNT = int(
+    os.getenv('PERFORMANCE_SLOW_QUERY_COUNT', 30)
+)
+PERFORMANCE_DUPLICATE_QUERIES = int(
+    os.getenv('PERFORMANCE_DUPLICATE_QUERIES', 5)
+)
+
+# Метрики Prometheus на /metrics (api.metrics). Под gunicorn
+# значения воркеров собираются через PROMETHEUS_MULTIPROC_DIR.
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'api.performance': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
+
+# Кэш токенов: в памяти процесса (размер и время жизни записи, с)
+# и в общем кэше. Сбрасывается при выходе и изменении пользователя.
+
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10000))
+AUTH_TOKEN_CACHE_TTL = int(os.getenv('AUTH_TOKEN_CACHE_TTL', 60))
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 600))
+
+# TrueType-шрифт с кириллицей для списка покупок в PDF
+# (в образе - пакет fonts-dejavu-core).
+
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT', '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf'
+)
+
+# Конфигурация полнотекстового поиска PostgreSQL (стемминг).
+
+SEARCH_CONFIG = 'russian'
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 # Custom User model
@@ -129,7 +255,7 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated',
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PAGINATION_CLASS': 'api.pagination.CustomPagination',
     'PAGE_SIZE': 6,
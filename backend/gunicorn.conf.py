@@ -0,0 +1,47 @@
+import os
+import shutil
+
+# SERVER_MODE=asgi - воркеры uvicorn и асинхронные представления,
+# по умолчанию - синхронные воркеры WSGI.
+if os.getenv('SERVER_MODE') == 'asgi':
+    wsgi_app = 'foodgram.asgi:application'
+    worker_class = 'uvicorn.workers.UvicornWorker'
+else:
+    wsgi_app = 'foodgram.wsgi:application'
+
+bind = '0:8000'
+workers = int(os.getenv('GUNICORN_WORKERS', 2))
+
+# Метрики воркеров пишутся в файлы общего каталога, /metrics
+# собирает их вместе. Каталог очищается при старте мастера.
+prometheus_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', '/tmp/foodgram_metrics'
+)
+
+# Кэши, которые не видны другим процессам: версии ответов, токенов
+# и индексов в них сбрасываются только у одного воркера.
+PROCESS_LOCAL_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_dir, ignore_errors=True)
+    os.makedirs(prometheus_dir)
+    cache_backend = os.getenv(
+        'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'
+    )
+    if server.num_workers > 1 and cache_backend in PROCESS_LOCAL_CACHES:
+        server.log.warning(
+            'Кэш %s не общий для процессов: запускаем один воркер '
+            'вместо %s. Для нескольких воркеров нужен Redis.',
+            cache_backend, server.num_workers
+        )
+        server.num_workers = 1
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
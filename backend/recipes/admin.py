@@ -6,8 +6,10 @@ from .models import (
     Recipe,
     IngredientRecipe,
     Favorite,
-    ShoppingCart
+    ShoppingCart,
+    ShoppingCartIngredient
 )
+from .search import search_recipes, uses_postgres
 
 
 @admin.register(Tag)
@@ -50,7 +52,9 @@ class RecipeAdmin(admin.ModelAdmin):
         'name',
         'text',
         'cooking_time',
-        'image'
+        'image',
+        'favorites_count',
+        'carts_count'
     )
     list_filter = (
         'author',
@@ -63,6 +67,13 @@ class RecipeAdmin(admin.ModelAdmin):
         'text'
     )
 
+    def get_search_results(self, request, queryset, search_term):
+        """В PostgreSQL ищем по индексированному tsvector."""
+
+        if search_term and uses_postgres():
+            return search_recipes(queryset, search_term), False
+        return super().get_search_results(request, queryset, search_term)
+
 
 @admin.register(IngredientRecipe)
 class IngredientRecipeAdmin(admin.ModelAdmin):
@@ -111,3 +122,19 @@ class ShoppingCartAdmin(admin.ModelAdmin):
         'user',
         'recipe'
     )
+
+
+@admin.register(ShoppingCartIngredient)
+class ShoppingCartIngredientAdmin(admin.ModelAdmin):
+    list_display = (
+        'user',
+        'ingredient',
+        'amount'
+    )
+    list_filter = (
+        'user',
+    )
+    search_fields = (
+        'user__username',
+        'ingredient__name'
+    )
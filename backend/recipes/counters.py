@@ -0,0 +1,235 @@
+import atexit
+import logging
+import math
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.db.models import Case, F, IntegerField, Value, When
+from django.db.models.functions import Greatest
+
+logger = logging.getLogger(__name__)
+
+_pending = defaultdict(int)
+_lock = threading.Lock()
+_timer = None
+_failures = 0
+_retry_at = 0.0
+
+# Предел паузы между повторами, пока база недоступна.
+MAX_BACKOFF = 60
+
+RECONCILE_EPOCH_KEY = 'counters-reconcile-epoch'
+
+
+class CounterFieldsMixin:
+    """
+    Счётчики пишутся только через F() (update_counter, flush),
+    поля из derived_fields вычисляет сама база (UPDATE ... SET).
+    Полное сохранение загруженного объекта их не трогает, иначе
+    значение из памяти затёрло бы изменения других запросов.
+    """
+
+    counter_fields = ()
+    derived_fields = ()
+
+    def save(self, *args, **kwargs):
+        if (
+            not args and not self._state.adding
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+        ):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields
+                and field.name not in self.derived_fields
+            ]
+        super().save(*args, **kwargs)
+
+
+def update_counter(model, field, pk, delta):
+    """Сразу меняем счётчик в текущей транзакции."""
+
+    model.objects.filter(pk=pk).update(**{
+        field: Greatest(F(field) + delta, 0)
+    })
+
+
+def increment(model, field, pk, delta=1):
+    """
+    Приращение счётчика популярных строк: после коммита копится
+    в памяти процесса и пишется пачкой раз в COUNTER_FLUSH_INTERVAL
+    секунд или при COUNTER_FLUSH_SIZE изменённых строк.
+    Приращение помечается секундой, в которую попало в буфер:
+    так flush узнаёт, учтено ли оно пересчётом (start_reconcile).
+    """
+
+    transaction.on_commit(lambda: add(model, field, pk, delta))
+
+
+def add(model, field, pk, delta):
+    with _lock:
+        if not put_back(model, field, {(pk, int(time.time())): delta}):
+            logger.error(
+                'Буфер счётчиков полон, приращение %s.%s[%s]=%s отброшено',
+                model._meta.label, field, pk, delta
+            )
+            return
+        full = (
+            len(_pending) >= settings.COUNTER_FLUSH_SIZE
+            and time.monotonic() >= _retry_at
+        )
+        if not full:
+            schedule(settings.COUNTER_FLUSH_INTERVAL)
+    if full:
+        flush()
+
+
+def put_back(model, field, deltas):
+    """
+    Добавляем приращения {(pk, секунда): delta} в буфер (под _lock).
+    Новые строки сверх COUNTER_BUFFER_LIMIT не берём: возвращаем,
+    сколько принято.
+    """
+
+    dropped = 0
+    for (pk, second), delta in deltas.items():
+        key = (model, field, pk, second)
+        if (
+            key not in _pending
+            and len(_pending) >= settings.COUNTER_BUFFER_LIMIT
+        ):
+            dropped += 1
+            continue
+        _pending[key] += delta
+    return len(deltas) - dropped
+
+
+def schedule(delay):
+    """Запускаем таймер записи, если он ещё не запущен (под _lock)."""
+
+    global _timer
+    if _timer is None:
+        _timer = threading.Timer(delay, flush_in_thread)
+        _timer.daemon = True
+        _timer.start()
+
+
+def start_reconcile():
+    """
+    Начинаем пересчёт счётчиков по живым данным. Приращения, попавшие
+    в буферы процессов раньше эпохи, уже есть в живых данных, и flush
+    их отбрасывает, иначе они легли бы поверх пересчитанных значений.
+    Эпоха - целая секунда (как метки приращений), её начала дожидаемся.
+    Работает только с общим для процессов кэшем (Redis).
+    """
+
+    epoch = math.floor(time.time()) + 1
+    cache.set(RECONCILE_EPOCH_KEY, epoch, None)
+    time.sleep(max(0, epoch - time.time()))
+
+
+def flush():
+    """
+    Записываем накопленные приращения: по одному UPDATE на счётчик.
+    Строки блокируются по порядку id, чтобы процессы не ждали
+    друг друга по кругу. Эпоха пересчёта читается уже под блокировкой:
+    пересчёт, начатый раньше, к этому моменту закоммичен. Уменьшение
+    может опередить увеличение из буфера другого процесса: счётчик
+    тогда опускается до нуля, а остаток ждёт в буфере. Если запись
+    не удалась, приращения возвращаются в буфер без новой записи,
+    а следующая попытка откладывается вдвое дольше, до MAX_BACKOFF секунд.
+    """
+
+    global _timer, _failures, _retry_at
+    with _lock:
+        pending = dict(_pending)
+        _pending.clear()
+        if _timer is not None:
+            _timer.cancel()
+            _timer = None
+
+    grouped = defaultdict(dict)
+    for (model, field, pk, second), delta in pending.items():
+        if delta:
+            grouped[(model, field)][(pk, second)] = delta
+    failed = []
+    carried = []
+    for (model, field), entries in grouped.items():
+        try:
+            with transaction.atomic():
+                rows = model.objects.filter(
+                    pk__in={pk for pk, second in entries}
+                )
+                current = dict(rows.select_for_update().order_by(
+                    'pk'
+                ).values_list('pk', field))
+                epoch = cache.get(RECONCILE_EPOCH_KEY, 0)
+                deltas = defaultdict(int)
+                seconds = {}
+                for (pk, second), delta in entries.items():
+                    if second >= epoch and pk in current:
+                        deltas[pk] += delta
+                        seconds[pk] = max(second, seconds.get(pk, second))
+                rest = {}
+                for pk, delta in deltas.items():
+                    if current[pk] + delta < 0:
+                        rest[(pk, seconds[pk])] = current[pk] + delta
+                        deltas[pk] = -current[pk]
+                deltas = {pk: delta for pk, delta in deltas.items() if delta}
+                if deltas:
+                    rows.filter(pk__in=deltas).update(**{
+                        field: F(field) + Case(
+                            *[
+                                When(pk=pk, then=Value(delta))
+                                for pk, delta in deltas.items()
+                            ],
+                            default=Value(0),
+                            output_field=IntegerField()
+                        )
+                    })
+            if rest:
+                carried.append((model, field, rest))
+        except Exception:
+            logger.exception(
+                'Не удалось записать счётчики %s.%s',
+                model._meta.label, field
+            )
+            failed.append((model, field, entries))
+
+    with _lock:
+        for model, field, rest in carried:
+            put_back(model, field, rest)
+        if carried:
+            schedule(settings.COUNTER_FLUSH_INTERVAL)
+        if not failed:
+            _failures = 0
+            _retry_at = 0.0
+            return
+        for model, field, entries in failed:
+            kept = put_back(model, field, entries)
+            if kept < len(entries):
+                logger.error(
+                    'Буфер счётчиков полон, отброшено приращений %s.%s: %s',
+                    model._meta.label, field, len(entries) - kept
+                )
+        _failures += 1
+        delay = min(
+            settings.COUNTER_FLUSH_INTERVAL * 2 ** _failures, MAX_BACKOFF
+        )
+        _retry_at = time.monotonic() + delay
+        schedule(delay)
+
+
+def flush_in_thread():
+    try:
+        flush()
+    finally:
+        connection.close()
+
+
+atexit.register(flush)
@@ -0,0 +1,185 @@
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Q
+
+from users.models import CustomUser, Subscribe
+
+from .models import FeedEntry, Recipe
+
+POPULAR_AUTHORS_KEY = 'feed-popular-authors'
+POPULAR_AUTHORS_TIMEOUT = 60 * 5
+PREVIOUS_POPULAR_AUTHORS_KEY = 'feed-popular-authors-previous'
+POPULAR_AUTHORS_LOCK_KEY = 'feed-popular-authors-lock'
+POPULAR_AUTHORS_LOCK_TIMEOUT = 30
+BACKFILL_PENDING_KEY = 'feed-backfill-pending'
+
+
+def load_popular_author_ids():
+    return frozenset(
+        CustomUser.objects.filter(
+            followers_count__gt=settings.FEED_FANOUT_LIMIT
+        ).values_list('id', flat=True)
+    )
+
+
+@contextmanager
+def popular_authors_lock(wait):
+    """
+    Блокировка пересчёта в кэше (cache.add). Без ожидания
+    отдаёт False, если её уже держит другой процесс.
+    """
+
+    while not cache.add(
+        POPULAR_AUTHORS_LOCK_KEY, True, POPULAR_AUTHORS_LOCK_TIMEOUT
+    ):
+        if not wait:
+            yield False
+            return
+        time.sleep(0.01)
+    try:
+        yield True
+    finally:
+        cache.delete(POPULAR_AUTHORS_LOCK_KEY)
+
+
+def popular_author_ids():
+    """
+    Авторы, у которых подписчиков больше FEED_FANOUT_LIMIT.
+    Их рецепты не раскладываются по лентам, а подмешиваются при чтении.
+    Пересчитывает один процесс, остальные тем временем получают
+    прошлое множество. Авторы, выпавшие из множества, только
+    запоминаются: их рецепты раскладывает команда backfill_feed.
+    """
+
+    author_ids = cache.get(POPULAR_AUTHORS_KEY)
+    if author_ids is not None:
+        return author_ids
+    with popular_authors_lock(wait=False) as locked:
+        if not locked:
+            previous = cache.get(PREVIOUS_POPULAR_AUTHORS_KEY)
+            return (
+                previous if previous is not None
+                else load_popular_author_ids()
+            )
+        author_ids = load_popular_author_ids()
+        dropped = cache.get(
+            PREVIOUS_POPULAR_AUTHORS_KEY, frozenset()
+        ) - author_ids
+        if dropped:
+            cache.set(
+                BACKFILL_PENDING_KEY,
+                cache.get(BACKFILL_PENDING_KEY, frozenset()) | dropped,
+                None
+            )
+        cache.set(PREVIOUS_POPULAR_AUTHORS_KEY, author_ids, None)
+        cache.set(POPULAR_AUTHORS_KEY, author_ids, POPULAR_AUTHORS_TIMEOUT)
+    return author_ids
+
+
+def backfill_pending():
+    """
+    Раскладываем рецепты авторов, выпавших из популярных, и убираем
+    их из очереди. Возвращает число обработанных авторов.
+    """
+
+    pending = cache.get(BACKFILL_PENDING_KEY, frozenset())
+    for author_id in pending:
+        backfill_followers(author_id)
+    if pending:
+        with popular_authors_lock(wait=True):
+            cache.set(
+                BACKFILL_PENDING_KEY,
+                cache.get(BACKFILL_PENDING_KEY, frozenset()) - pending,
+                None
+            )
+    return len(pending)
+
+
+def backfill_followers(author_id):
+    """
+    Последние FEED_BACKFILL рецептов автора в ленты всех подписчиков,
+    как при новой подписке. Уже разложенные записи пропускаются.
+    """
+
+    recipe_ids = list(Recipe.objects.filter(
+        author_id=author_id
+    ).values_list('id', flat=True)[:settings.FEED_BACKFILL])
+    follower_ids = Subscribe.objects.filter(
+        author_id=author_id
+    ).values_list('user_id', flat=True)
+    FeedEntry.objects.bulk_create(
+        (
+            FeedEntry(user_id=user_id, recipe_id=recipe_id)
+            for user_id in follower_ids.iterator()
+            for recipe_id in recipe_ids
+        ),
+        batch_size=1000,
+        ignore_conflicts=True
+    )
+
+
+def fan_out_recipe(recipe):
+    """Раскладываем новый рецепт по лентам подписчиков автора."""
+
+    fan_out_recipes(recipe.author_id, [recipe.pk])
+
+
+def fan_out_recipes(author_id, recipe_ids):
+    """Раскладываем новые рецепты автора одним проходом по подписчикам."""
+
+    if author_id in popular_author_ids():
+        return
+    follower_ids = Subscribe.objects.filter(
+        author_id=author_id
+    ).values_list('user_id', flat=True)
+    FeedEntry.objects.bulk_create(
+        (
+            FeedEntry(user_id=user_id, recipe_id=recipe_id)
+            for user_id in follower_ids.iterator()
+            for recipe_id in recipe_ids
+        ),
+        batch_size=1000,
+        ignore_conflicts=True
+    )
+
+
+def follow(user_id, author_id):
+    """Добавляем в ленту последние рецепты нового автора."""
+
+    recipe_ids = Recipe.objects.filter(
+        author_id=author_id
+    ).values_list('id', flat=True)[:settings.FEED_BACKFILL]
+    FeedEntry.objects.bulk_create(
+        [
+            FeedEntry(user_id=user_id, recipe_id=recipe_id)
+            for recipe_id in recipe_ids
+        ],
+        ignore_conflicts=True
+    )
+
+
+def unfollow(user_id, author_id):
+    FeedEntry.objects.filter(
+        user_id=user_id, recipe__author_id=author_id
+    ).delete()
+
+
+def feed_filter(user):
+    """
+    Условие на рецепты ленты: записи из таблицы ленты
+    плюс рецепты популярных авторов, на которых подписан пользователь.
+    """
+
+    condition = Q(pk__in=FeedEntry.objects.filter(
+        user=user
+    ).values('recipe_id'))
+    popular = popular_author_ids()
+    if popular:
+        followed = Subscribe.objects.filter(
+            user=user, author__in=popular
+        ).values_list('author_id', flat=True)
+        condition |= Q(author__in=list(followed))
+    return condition
@@ -0,0 +1,104 @@
+import io
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from PIL import Image, ImageOps
+
+from .models import Recipe, RecipeImage
+
+logger = logging.getLogger(__name__)
+
+VARIANT_SIZES = {
+    RecipeImage.THUMBNAIL: 320,
+    RecipeImage.CARD: 640,
+    RecipeImage.FULL: 1280,
+}
+# Формат варианта -> формат Pillow и расширение файла.
+VARIANT_FORMATS = {
+    RecipeImage.WEBP: ('WEBP', 'webp'),
+    RecipeImage.JPEG: ('JPEG', 'jpg'),
+}
+
+executor = ThreadPoolExecutor(
+    max_workers=settings.IMAGE_WORKERS,
+    thread_name_prefix='recipe-images'
+)
+
+
+def render_variant(source, size, image_format):
+    """
+    Уменьшаем изображение до size по большей стороне и кодируем
+    в WebP или JPEG. У JPEG нет прозрачности: кладём на белый фон.
+    Метаданные (EXIF и т.п.) не переносятся.
+    """
+
+    variant = source.copy()
+    variant.thumbnail((size, size), Image.LANCZOS)
+    if image_format == RecipeImage.JPEG and variant.mode == 'RGBA':
+        background = Image.new('RGB', variant.size, 'white')
+        background.paste(variant, mask=variant.getchannel('A'))
+        variant = background
+    buffer = io.BytesIO()
+    variant.save(
+        buffer,
+        format=VARIANT_FORMATS[image_format][0],
+        quality=settings.IMAGE_QUALITY
+    )
+    return buffer.getvalue()
+
+
+def process_recipe_image(recipe_id):
+    """Создаём (или пересоздаём) все варианты изображения рецепта."""
+
+    try:
+        recipe = Recipe.objects.filter(pk=recipe_id).first()
+        if recipe is None or not recipe.image:
+            return
+        with recipe.image.open('rb') as file:
+            source = ImageOps.exif_transpose(Image.open(file))
+            source = source.convert(
+                'RGBA' if 'A' in source.getbands() else 'RGB'
+            )
+        old_files = []
+        for kind, size in VARIANT_SIZES.items():
+            for image_format, (_, extension) in VARIANT_FORMATS.items():
+                content = ContentFile(
+                    render_variant(source, size, image_format),
+                    name='{0}-{1}.{2}'.format(recipe.pk, kind, extension)
+                )
+                variant = RecipeImage.objects.filter(
+                    recipe=recipe, kind=kind, format=image_format
+                ).first() or RecipeImage(
+                    recipe=recipe, kind=kind, format=image_format
+                )
+                if variant.image:
+                    old_files.append(variant.image.name)
+                variant.image.save(content.name, content, save=False)
+                variant.save()
+        for name in old_files:
+            RecipeImage._meta.get_field('image').storage.delete(name)
+    except Exception:
+        logger.exception(
+            'Не удалось обработать изображение рецепта %s', recipe_id
+        )
+
+
+def run_in_worker(recipe_id):
+    """Задача пула: у потока своё соединение с базой, закрываем его."""
+
+    try:
+        process_recipe_image(recipe_id)
+    finally:
+        connection.close()
+
+
+def schedule_image_processing(recipe):
+    """После коммита транзакции отдаём обработку в пул потоков."""
+
+    recipe_id = recipe.pk
+    transaction.on_commit(
+        lambda: executor.submit(run_in_worker, recipe_id)
+    )
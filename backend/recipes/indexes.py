@@ -0,0 +1,341 @@
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from collections.abc import Sequence
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+
+from .models import Ingredient, IngredientRecipe
+
+
+class VersionedIndex:
+    """
+    Неизменяемый индекс в памяти процесса.
+    Номер версии хранится в общем кэше: после invalidate() каждый
+    процесс при следующем обращении перестраивает свою копию.
+    """
+
+    version_key = None
+
+    def __init__(self):
+        self._data = None
+        self._version = None
+        self._lock = threading.Lock()
+
+    def build(self):
+        raise NotImplementedError
+
+    def update(self, data, old_version, new_version):
+        """
+        Привести копию к новой версии без полной перестройки.
+        None - обновить нельзя, индекс строится заново. Отданные
+        раньше данные читают другие потоки без блокировки, поэтому
+        менять их нельзя: возвращаются новые структуры.
+        """
+
+        return None
+
+    def get(self):
+        version = cache.get(self.version_key, 0)
+        if self._data is None or self._version != version:
+            with self._lock:
+                if self._data is None or self._version != version:
+                    data = None
+                    if self._data is not None:
+                        data = self.update(self._data, self._version, version)
+                    self._data = data if data is not None else self.build()
+                    self._version = version
+        return self._data
+
+    async def aget(self):
+        """
+        Для асинхронных представлений: актуальный индекс отдаётся
+        без перехода в поток, перестройка идёт в синхронном потоке.
+        """
+
+        version = await cache.aget(self.version_key, 0)
+        if self._data is None or self._version != version:
+            return await sync_to_async(self.get)()
+        return self._data
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            cache.set(self.version_key, 1, timeout=None)
+
+
+def gram_postings(keys, size):
+    """
+    Подстроки длиной до size -> номера ключей, где они встречаются,
+    по позиции первого вхождения, затем по порядку ключей.
+    Позиция и номер упакованы в одно число: так сортировка дешевле.
+    """
+
+    starts = defaultdict(list)
+    for index, key in enumerate(keys):
+        first = {}
+        for length in range(size, 0, -1):
+            for start in range(len(key) - length, -1, -1):
+                first[key[start:start + length]] = start
+        for gram, start in first.items():
+            starts[gram].append(start << 32 | index)
+    return {
+        gram: array('i', [packed & 0xFFFFFFFF for packed in sorted(values)])
+        for gram, values in starts.items()
+    }
+
+
+class IngredientIndex(VersionedIndex):
+    """
+    Индекс для автодополнения ингредиентов: отсортированный
+    по названию массив, поиск по префиксу - бинарный.
+    Сначала идут совпадения по началу названия, затем по вхождению.
+    Вхождения ищутся по спискам подстрок до GRAM_SIZE символов:
+    для коротких запросов список уже упорядочен по позиции,
+    для длинных - кандидаты из самого короткого списка.
+    """
+
+    version_key = 'ingredient-index-version'
+    GRAM_SIZE = 3
+
+    def build(self):
+        entries = sorted(
+            (name.casefold(), id, name, measurement_unit)
+            for id, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit'
+            ).iterator()
+        )
+        keys = [entry[0] for entry in entries]
+        return keys, entries, gram_postings(keys, self.GRAM_SIZE)
+
+    def search(self, query, limit):
+        return self.match(self.get(), query, limit)
+
+    async def asearch(self, query, limit):
+        return self.match(await self.aget(), query, limit)
+
+    def match(self, data, query, limit):
+        keys, entries, postings = data
+        query = query.strip().casefold()
+        position = bisect_left(keys, query)
+        end = position
+        last = min(len(keys), position + limit)
+        while end < last and keys[end].startswith(query):
+            end += 1
+        found = entries[position:end]
+        if len(found) < limit and query:
+            found += [
+                entries[index]
+                for index in self.infix(
+                    keys, postings, query, limit - len(found)
+                )
+            ]
+        return [
+            {'id': id, 'name': name, 'measurement_unit': measurement_unit}
+            for _, id, name, measurement_unit in found
+        ]
+
+    def infix(self, keys, postings, query, limit):
+        """Номера ключей, содержащих query не с начала."""
+
+        if len(query) <= self.GRAM_SIZE:
+            # Список уже по позиции: совпадения с начала идут первыми,
+            # их столько, сколько ключей в диапазоне префикса.
+            prefixed = bisect_left(
+                keys, query[:-1] + chr(ord(query[-1]) + 1)
+            ) - bisect_left(keys, query)
+            return postings.get(query, ())[prefixed:prefixed + limit]
+        candidates = min(
+            (
+                postings.get(query[start:start + self.GRAM_SIZE], ())
+                for start in range(len(query) - self.GRAM_SIZE + 1)
+            ),
+            key=len
+        )
+        return [
+            index for _, index in heapq.nsmallest(limit, (
+                (start, index) for start, index in (
+                    (keys[index].find(query), index) for index in candidates
+                ) if start > 0
+            ))
+        ]
+
+
+ingredient_index = IngredientIndex()
+
+
+class IngredientIdIndex(VersionedIndex):
+    """
+    Множество id ингредиентов битовой картой: бит pk выставлен,
+    если ингредиент есть. Версия общая с IngredientIndex, так что
+    сбрасывается в тех же местах.
+    """
+
+    version_key = IngredientIndex.version_key
+
+    def build(self):
+        ids = list(Ingredient.objects.values_list('id', flat=True).iterator())
+        bits = bytearray((max(ids, default=0) >> 3) + 1)
+        for pk in ids:
+            bits[pk >> 3] |= 1 << (pk & 7)
+        return bytes(bits)
+
+    def missing(self, ids):
+        """
+        Id из ids, которых нет в базе. Проверка по карте без запросов;
+        не найденные перепроверяются одним запросом, чтобы копия,
+        ещё не увидевшая новую версию, не отвергла новый ингредиент.
+        """
+
+        bits = self.get()
+        missing = [
+            pk for pk in ids
+            if pk < 0 or (pk >> 3) >= len(bits)
+            or not bits[pk >> 3] & (1 << (pk & 7))
+        ]
+        if missing:
+            found = set(Ingredient.objects.filter(
+                pk__in=missing
+            ).values_list('pk', flat=True))
+            missing = [pk for pk in missing if pk not in found]
+        return missing
+
+
+ingredient_id_index = IngredientIdIndex()
+
+
+class Ranking(Sequence):
+    """
+    Рецепты по убыванию доли имеющихся ингредиентов: пары
+    (id рецепта, совпало). Срез [:n] выбирает n лучших через
+    heapq.nlargest, не сортируя все совпадения.
+    """
+
+    def __init__(self, matched, recipes):
+        self.matched = matched
+        self.recipes = recipes
+
+    def key(self, item):
+        recipe_id, matched = item
+        # Рецепт мог исчезнуть из индекса, пока шёл поиск.
+        size = len(self.recipes.get(recipe_id, ())) or matched
+        return matched / size, matched, recipe_id
+
+    def __len__(self):
+        return len(self.matched)
+
+    def __getitem__(self, index):
+        if not isinstance(index, slice):
+            return self[index:index + 1][0]
+        stop = len(self) if index.stop is None else index.stop
+        return heapq.nlargest(
+            stop, self.matched.items(), key=self.key
+        )[index]
+
+
+class RecipeIngredientIndex(VersionedIndex):
+    """
+    Инвертированный индекс ингредиент -> отсортированный массив id
+    рецептов, в которых он есть, и ингредиенты каждого рецепта.
+    После записи рецепта changed() кладёт его id в общий кэш под
+    новой версией, и каждый процесс переносит к себе только эти
+    рецепты; полная перестройка - если записей изменений не хватает.
+    """
+
+    version_key = 'recipe-ingredient-index-version'
+    changes_key = 'recipe-ingredient-index-changes:{0}'
+    changes_timeout = 60 * 60
+    max_changes = 1000
+
+    def build(self):
+        postings = defaultdict(lambda: array('l'))
+        recipes = defaultdict(list)
+        for recipe_id, ingredient_id in IngredientRecipe.objects.values_list(
+            'recipe_id', 'ingredient_id'
+        ).order_by('recipe_id').iterator():
+            postings[ingredient_id].append(recipe_id)
+            recipes[recipe_id].append(ingredient_id)
+        return dict(postings), {
+            recipe_id: frozenset(ingredient_ids)
+            for recipe_id, ingredient_ids in recipes.items()
+        }
+
+    def changed(self, recipe_ids):
+        """Рецепты созданы, изменены или удалены (после коммита)."""
+
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            version = 1
+            cache.set(self.version_key, version, timeout=None)
+        cache.set(
+            self.changes_key.format(version), list(recipe_ids),
+            self.changes_timeout
+        )
+
+    def update(self, data, old_version, new_version):
+        if not 0 < new_version - old_version <= self.max_changes:
+            return None
+        keys = [
+            self.changes_key.format(version)
+            for version in range(old_version + 1, new_version + 1)
+        ]
+        changes = cache.get_many(keys)
+        if len(changes) < len(keys):
+            return None
+        recipe_ids = set().union(*changes.values())
+        current = defaultdict(set)
+        for recipe_id, ingredient_id in IngredientRecipe.objects.filter(
+            recipe_id__in=recipe_ids
+        ).values_list('recipe_id', 'ingredient_id'):
+            current[recipe_id].add(ingredient_id)
+
+        # Копии словарей (ссылки на те же массивы и множества), чтобы
+        # поиск в других потоках дочитал прежнюю версию целиком.
+        postings, recipes = (dict(part) for part in data)
+        removed = defaultdict(set)
+        added = defaultdict(set)
+        for recipe_id in recipe_ids:
+            old = recipes.get(recipe_id, frozenset())
+            new = frozenset(current.get(recipe_id, ()))
+            for ingredient_id in old - new:
+                removed[ingredient_id].add(recipe_id)
+            for ingredient_id in new - old:
+                added[ingredient_id].add(recipe_id)
+            if new:
+                recipes[recipe_id] = new
+            else:
+                recipes.pop(recipe_id, None)
+        for ingredient_id in removed.keys() | added.keys():
+            posting = sorted(
+                {
+                    recipe_id
+                    for recipe_id in postings.get(ingredient_id, ())
+                    if recipe_id not in removed[ingredient_id]
+                } | added[ingredient_id]
+            )
+            if posting:
+                postings[ingredient_id] = array('l', posting)
+            else:
+                postings.pop(ingredient_id, None)
+        return postings, recipes
+
+    def search(self, ingredient_ids):
+        """
+        Рецепты, где есть хотя бы один из ингредиентов, по убыванию
+        доли имеющихся ингредиентов (Ranking). Подсчёт совпадений -
+        Counter.update по массивам, он идёт в C.
+        """
+
+        postings, recipes = self.get()
+        matched = Counter()
+        for ingredient_id in set(ingredient_ids):
+            matched.update(postings.get(ingredient_id, ()))
+        return Ranking(matched, recipes)
+
+
+recipe_ingredient_index = RecipeIngredientIndex()
@@ -0,0 +1,104 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def drop_auto_unique(apps, schema_editor):
+    """
+    У автоматической таблицы связи уникальность (recipe_id, tag_id)
+    называлась по-своему, её заменяет unique_recipe_tag. SQLite
+    пересоздаёт таблицу при AlterField ниже, и старая уходит сама.
+    """
+
+    connection = schema_editor.connection
+    if connection.vendor != 'postgresql':
+        return
+    table = apps.get_model('recipes', 'RecipeTag')._meta.db_table
+    with connection.cursor() as cursor:
+        constraints = connection.introspection.get_constraints(cursor, table)
+    for name, info in constraints.items():
+        if (
+            info['unique'] and not info['primary_key']
+            and sorted(info['columns']) == ['recipe_id', 'tag_id']
+        ):
+            if info['index']:
+                sql = 'DROP INDEX {0}'
+            else:
+                sql = 'ALTER TABLE {1} DROP CONSTRAINT {0}'
+            schema_editor.execute(sql.format(
+                schema_editor.quote_name(name),
+                schema_editor.quote_name(table)
+            ))
+
+
+class Migration(migrations.Migration):
+    """
+    Теги рецепта переходят на явную модель связи RecipeTag. Таблица
+    остаётся прежней (recipes_recipe_tags), поэтому модель добавляется
+    только в состояние: AlterField с through= migrate не выполняет.
+    """
+
+    dependencies = [
+        ('recipes', '0002_initial'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.CreateModel(
+                    name='RecipeTag',
+                    fields=[
+                        ('id', models.BigAutoField(
+                            auto_created=True,
+                            primary_key=True,
+                            serialize=False,
+                            verbose_name='ID'
+                        )),
+                        ('recipe', models.ForeignKey(
+                            on_delete=django.db.models.deletion.CASCADE,
+                            to='recipes.recipe'
+                        )),
+                        ('tag', models.ForeignKey(
+                            on_delete=django.db.models.deletion.CASCADE,
+                            to='recipes.tag'
+                        )),
+                    ],
+                    options={
+                        'verbose_name': 'Тег рецепта',
+                        'verbose_name_plural': 'Теги рецептов',
+                        'db_table': 'recipes_recipe_tags',
+                    },
+                ),
+                migrations.AlterField(
+                    model_name='recipe',
+                    name='tags',
+                    field=models.ManyToManyField(
+                        related_name='recipes',
+                        through='recipes.RecipeTag',
+                        to='recipes.tag'
+                    ),
+                ),
+            ],
+        ),
+        migrations.RunPython(drop_auto_unique, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='recipetag',
+            name='tag',
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                to='recipes.tag'
+            ),
+        ),
+        migrations.AddIndex(
+            model_name='recipetag',
+            index=models.Index(
+                fields=['tag', 'recipe'], name='recipe_tag_tag_recipe_idx'
+            ),
+        ),
+        migrations.AddConstraint(
+            model_name='recipetag',
+            constraint=models.UniqueConstraint(
+                fields=('recipe', 'tag'), name='unique_recipe_tag'
+            ),
+        ),
+    ]
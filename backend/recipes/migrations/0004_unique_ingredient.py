@@ -0,0 +1,59 @@
+from django.db import migrations, models
+
+
+def merge_duplicate_ingredients(apps, schema_editor):
+    """
+    Прежний импорт создавал дубли (название, единица). Оставляем
+    ингредиент с меньшим id и переводим на него рецепты; если в рецепте
+    были оба, количества складываются.
+    """
+
+    Ingredient = apps.get_model('recipes', 'Ingredient')
+    IngredientRecipe = apps.get_model('recipes', 'IngredientRecipe')
+    duplicates = Ingredient.objects.values(
+        'name', 'measurement_unit'
+    ).annotate(
+        keep=models.Min('id'), total=models.Count('id')
+    ).filter(total__gt=1).order_by()
+    for group in list(duplicates):
+        extra = list(Ingredient.objects.filter(
+            name=group['name'], measurement_unit=group['measurement_unit']
+        ).exclude(pk=group['keep']).values_list('pk', flat=True))
+        links = IngredientRecipe.objects.filter(
+            ingredient_id__in=extra
+        ).order_by('pk')
+        for link in links:
+            kept = IngredientRecipe.objects.filter(
+                recipe_id=link.recipe_id, ingredient_id=group['keep']
+            ).first()
+            if kept is None:
+                link.ingredient_id = group['keep']
+                link.save(update_fields=['ingredient'])
+            else:
+                kept.amount += link.amount
+                kept.save(update_fields=['amount'])
+                link.delete()
+        Ingredient.objects.filter(pk__in=extra).delete()
+    if schema_editor.connection.vendor == 'postgresql':
+        # Отложенные проверки внешних ключей не дают менять таблицу
+        # в той же транзакции.
+        schema_editor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_recipe_tag_through'),
+    ]
+
+    operations = [
+        migrations.RunPython(
+            merge_duplicate_ingredients, migrations.RunPython.noop
+        ),
+        migrations.AddConstraint(
+            model_name='ingredient',
+            constraint=models.UniqueConstraint(
+                fields=('name', 'measurement_unit'), name='unique_ingredient'
+            ),
+        ),
+    ]
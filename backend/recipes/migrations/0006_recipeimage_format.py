@@ -0,0 +1,26 @@
+# Generated by Django 4.2.16 on 2026-10-18 21:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_recipe_counters_images_feed'),
+    ]
+
+    operations = [
+        migrations.RemoveConstraint(
+            model_name='recipeimage',
+            name='unique_recipe_image_kind',
+        ),
+        migrations.AddField(
+            model_name='recipeimage',
+            name='format',
+            field=models.CharField(choices=[('webp', 'WebP'), ('jpeg', 'JPEG')], default='webp', max_length=8),
+        ),
+        migrations.AddConstraint(
+            model_name='recipeimage',
+            constraint=models.UniqueConstraint(fields=('recipe', 'kind', 'format'), name='unique_recipe_image_variant'),
+        ),
+    ]
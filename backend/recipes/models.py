@@ -1,9 +1,16 @@
+import uuid
+
 from colorfield.fields import ColorField
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVectorField
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import models, transaction
+from django.db.models.functions import Greatest
 
 from users.models import CustomUser
 
+from .counters import CounterFieldsMixin
+
 
 class Tag(models.Model):
     """Модель экземпляра тегов."""
@@ -40,12 +47,18 @@ class Ingredient(models.Model):
     class Meta:
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        constraints = (
+            models.UniqueConstraint(
+                fields=['name', 'measurement_unit'],
+                name='unique_ingredient'
+            ),
+        )
 
     def __str__(self):
         return self.name
 
 
-class Recipe(models.Model):
+class Recipe(CounterFieldsMixin, models.Model):
     """Модель экземпляра рецептов."""
 
     author = models.ForeignKey(
@@ -56,6 +69,7 @@ class Recipe(models.Model):
     )
     tags = models.ManyToManyField(
         Tag,
+        through='RecipeTag',
         related_name='recipes'
     )
     ingredients = models.ManyToManyField(
@@ -74,16 +88,182 @@ class Recipe(models.Model):
     cooking_time = models.PositiveIntegerField(
         validators=[MinValueValidator(1)]
     )
+    search_vector = SearchVectorField(
+        null=True,
+        editable=False
+    )
+    favorites_count = models.PositiveIntegerField(
+        'В избранном',
+        default=0,
+        editable=False
+    )
+    carts_count = models.PositiveIntegerField(
+        'В корзинах',
+        default=0,
+        editable=False
+    )
+
+    counter_fields = ('favorites_count', 'carts_count')
+    derived_fields = ('search_vector',)
 
     class Meta:
-        ordering = ('-pub_date',)
+        ordering = ('-pub_date', '-id')
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = (
+            models.Index(
+                fields=['-pub_date', '-id'],
+                name='recipe_pub_date_id_idx'
+            ),
+            GinIndex(
+                fields=['search_vector'],
+                name='recipe_search_vector_idx'
+            ),
+            models.Index(
+                fields=['-favorites_count', '-pub_date', '-id'],
+                name='recipe_popular_idx'
+            ),
+        )
 
     def __str__(self):
         return self.name
 
 
+class RecipeImage(models.Model):
+    """
+    Уменьшенная копия изображения рецепта в WebP или JPEG
+    (для клиентов без WebP). Создаётся в фоне после сохранения рецепта.
+    """
+
+    THUMBNAIL = 'thumbnail'
+    CARD = 'card'
+    FULL = 'full'
+    KINDS = (
+        (THUMBNAIL, 'Миниатюра'),
+        (CARD, 'Карточка'),
+        (FULL, 'Полный размер'),
+    )
+    WEBP = 'webp'
+    JPEG = 'jpeg'
+    FORMATS = (
+        (WEBP, 'WebP'),
+        (JPEG, 'JPEG'),
+    )
+
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='images'
+    )
+    kind = models.CharField(
+        max_length=16,
+        choices=KINDS
+    )
+    format = models.CharField(
+        max_length=8,
+        choices=FORMATS,
+        default=WEBP
+    )
+    image = models.ImageField(
+        upload_to='recipes/variants/',
+        width_field='width',
+        height_field='height'
+    )
+    width = models.PositiveIntegerField()
+    height = models.PositiveIntegerField()
+
+    class Meta:
+        verbose_name = 'Вариант изображения'
+        verbose_name_plural = 'Варианты изображений'
+        constraints = (
+            models.UniqueConstraint(
+                fields=['recipe', 'kind', 'format'],
+                name='unique_recipe_image_variant'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.recipe} {self.kind}'
+
+
+class RecipeImageUpload(models.Model):
+    """
+    Изображение, загруженное отдельным запросом до создания рецепта.
+    Рецепт ссылается на него по одноразовому токену.
+    """
+
+    token = models.UUIDField(
+        default=uuid.uuid4,
+        unique=True,
+        editable=False
+    )
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='image_uploads'
+    )
+    image = models.ImageField(
+        upload_to='recipes/'
+    )
+    created = models.DateTimeField(
+        auto_now_add=True
+    )
+
+    class Meta:
+        verbose_name = 'Загруженное изображение'
+        verbose_name_plural = 'Загруженные изображения'
+
+    def __str__(self):
+        return f'{self.user} {self.token}'
+
+    def claim(self):
+        """
+        Забираем загрузку для рецепта: строка удаляется, файл остаётся
+        за рецептом. False - её уже удалила очистка устаревших загрузок.
+        """
+
+        deleted, _ = RecipeImageUpload.objects.filter(pk=self.pk).delete()
+        return bool(deleted)
+
+
+class RecipeTag(models.Model):
+    """
+    Связь рецептов и тегов. Таблица прежняя, от автоматической
+    модели M2M, добавлен покрывающий индекс для фильтра по тегам.
+    """
+
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE
+    )
+    # Отдельный индекс по tag не нужен: его заменяет (tag, recipe).
+    tag = models.ForeignKey(
+        Tag,
+        on_delete=models.CASCADE,
+        db_index=False
+    )
+
+    class Meta:
+        db_table = 'recipes_recipe_tags'
+        verbose_name = 'Тег рецепта'
+        verbose_name_plural = 'Теги рецептов'
+        constraints = (
+            models.UniqueConstraint(
+                fields=['recipe', 'tag'],
+                name='unique_recipe_tag'
+            ),
+        )
+        indexes = (
+            models.Index(
+                fields=['tag', 'recipe'],
+                name='recipe_tag_tag_recipe_idx'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.recipe} {self.tag}'
+
+
 class IngredientRecipe(models.Model):
     """Смежная модель ингредиентов и рецептов для корректного отображения."""
 
@@ -173,3 +353,199 @@ class ShoppingCart(models.Model):
 
     def __str__(self):
         return f'{self.user} {self.recipe}'
+
+
+class FeedEntry(models.Model):
+    """
+    Запись ленты подписок: рецепт автора, на которого подписан
+    пользователь. Создаётся при публикации рецепта (fan-out on write).
+    """
+
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='feed_entries'
+    )
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='feed_entries'
+    )
+
+    class Meta:
+        verbose_name = 'Запись ленты'
+        verbose_name_plural = 'Лента подписок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=['user', 'recipe'],
+                name='unique_feed_entry'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user} {self.recipe}'
+
+
+class ShoppingCartIngredientManager(models.Manager):
+    """
+    Инкрементальное обновление суммарных количеств ингредиентов
+    в корзинах покупок вместо пересчёта всей корзины при выгрузке.
+    """
+
+    def apply_deltas(self, user_ids, deltas):
+        """
+        Прибавляем к корзинам пользователей изменения количеств
+        {id ингредиента: изменение}, обнулившиеся строки удаляем.
+        """
+
+        deltas = {
+            ingredient_id: delta
+            for ingredient_id, delta in deltas.items() if delta
+        }
+        user_ids = list(user_ids)
+        if not deltas or not user_ids:
+            return
+        with transaction.atomic():
+            self.bulk_create(
+                [
+                    self.model(
+                        user_id=user_id,
+                        ingredient_id=ingredient_id,
+                        amount=0
+                    )
+                    for user_id in user_ids
+                    for ingredient_id, delta in deltas.items() if delta > 0
+                ],
+                ignore_conflicts=True
+            )
+            rows = self.filter(
+                user_id__in=user_ids, ingredient_id__in=deltas
+            )
+            rows.update(amount=Greatest(
+                models.F('amount') + models.Case(
+                    *[
+                        models.When(ingredient_id=ingredient_id, then=delta)
+                        for ingredient_id, delta in deltas.items()
+                    ],
+                    output_field=models.IntegerField()
+                ),
+                0
+            ))
+            rows.filter(amount=0).delete()
+
+    def recipe_amounts(self, recipe):
+        """Количества ингредиентов рецепта: {id ингредиента: количество}."""
+
+        return dict(
+            IngredientRecipe.objects.filter(
+                recipe=recipe
+            ).values_list('ingredient_id', 'amount')
+        )
+
+    def total_amounts(self, recipes):
+        """Суммарные количества ингредиентов нескольких рецептов."""
+
+        return dict(
+            IngredientRecipe.objects.filter(
+                recipe__in=recipes
+            ).values_list('ingredient_id').annotate(
+                total=models.Sum('amount')
+            ).order_by()
+        )
+
+    def add_recipes(self, user, recipes):
+        """Рецепты добавлены в корзину пользователя."""
+
+        self.apply_deltas([user.id], self.total_amounts(recipes))
+
+    def remove_recipes(self, user, recipes):
+        """Рецепты убраны из корзины пользователя."""
+
+        self.apply_deltas([user.id], {
+            ingredient_id: -amount
+            for ingredient_id, amount in self.total_amounts(recipes).items()
+        })
+
+    def add_recipe(self, user, recipe):
+        """Рецепт добавлен в корзину пользователя."""
+
+        self.add_recipes(user, [recipe])
+
+    def remove_recipe(self, user, recipe):
+        """Рецепт убран из корзины пользователя."""
+
+        self.remove_recipes(user, [recipe])
+
+    def update_recipe(self, recipe, old_amounts, new_amounts):
+        """Ингредиенты рецепта изменились - правим все корзины с ним."""
+
+        deltas = {
+            ingredient_id: (
+                new_amounts.get(ingredient_id, 0)
+                - old_amounts.get(ingredient_id, 0)
+            )
+            for ingredient_id in {*old_amounts, *new_amounts}
+        }
+        self.apply_deltas(
+            ShoppingCart.objects.filter(
+                recipe=recipe
+            ).values_list('user_id', flat=True),
+            deltas
+        )
+
+    def delete_recipe(self, recipe):
+        """Рецепт удаляется - убираем его из всех корзин."""
+
+        self.update_recipe(recipe, self.recipe_amounts(recipe), {})
+
+    def shopping_list(self, user):
+        """Строки списка покупок: (название, единица, количество)."""
+
+        return self.filter(user=user).values_list(
+            'ingredient__name', 'ingredient__measurement_unit', 'amount'
+        ).order_by('ingredient__name')
+
+    def live_totals(self):
+        """Суммы, посчитанные напрямую по корзинам и рецептам."""
+
+        return IngredientRecipe.objects.filter(
+            recipe__in_shopping_cart__isnull=False
+        ).values_list(
+            'recipe__in_shopping_cart__user_id', 'ingredient_id'
+        ).annotate(
+            total=models.Sum('amount')
+        ).order_by()
+
+
+class ShoppingCartIngredient(models.Model):
+    """
+    Суммарное количество ингредиента в корзине покупок пользователя.
+    Денормализованная таблица для выгрузки списка покупок.
+    """
+
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='shopping_cart_ingredients'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_cart_ingredients'
+    )
+    amount = models.PositiveIntegerField()
+
+    objects = ShoppingCartIngredientManager()
+
+    class Meta:
+        verbose_name = 'Ингредиент в корзине покупок'
+        verbose_name_plural = 'Ингредиенты в корзине покупок'
+        constraints = (
+            models.UniqueConstraint(
+                fields=['user', 'ingredient'],
+                name='unique_shopping_cart_ingredient'
+            ),
+        )
+
+    def __str__(self):
+        return f'{self.user} {self.ingredient} {self.amount}'
@@ -0,0 +1,181 @@
+import re
+import threading
+from collections import defaultdict
+
+from django.conf import settings
+from django.contrib.postgres.aggregates import StringAgg
+from django.contrib.postgres.search import (
+    SearchQuery,
+    SearchRank,
+    SearchVector
+)
+from django.db import connection, transaction
+from django.db.models import (
+    Case,
+    F,
+    IntegerField,
+    OuterRef,
+    Subquery,
+    Value,
+    When
+)
+
+from .indexes import VersionedIndex
+from .models import IngredientRecipe, Recipe
+
+WORD_RE = re.compile(r'\w+')
+
+# Окончания для упрощённого стемминга в запасном индексе,
+# от длинных к коротким.
+ENDINGS = sorted((
+    'иями', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя', 'ое', 'ее', 'ые', 'ие', 'ом',
+    'ем', 'ам', 'ям', 'ах', 'ях', 'ов', 'ев', 'ью', 'ую', 'юю',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True)
+
+WEIGHTS = {'name': 3, 'ingredients': 2, 'text': 1}
+
+
+def uses_postgres():
+    return connection.vendor == 'postgresql'
+
+
+def stem(word):
+    word = word.casefold().replace('ё', 'е')
+    for ending in ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def tokenize(text):
+    return [stem(word) for word in WORD_RE.findall(text)]
+
+
+class RecipeSearchIndex(VersionedIndex):
+    """
+    Запасной инвертированный индекс для баз без полнотекстового
+    поиска (SQLite в разработке и тестах): основа слова -> {id: вес}.
+    """
+
+    version_key = 'recipe-search-index-version'
+
+    def build(self):
+        ingredients = defaultdict(list)
+        for recipe_id, name in IngredientRecipe.objects.values_list(
+            'recipe_id', 'ingredient__name'
+        ).iterator():
+            ingredients[recipe_id].append(name)
+        postings = defaultdict(lambda: defaultdict(int))
+        for recipe_id, name, text in Recipe.objects.values_list(
+            'id', 'name', 'text'
+        ).iterator():
+            fields = {
+                'name': name,
+                'ingredients': ' '.join(ingredients[recipe_id]),
+                'text': text,
+            }
+            for field, value in fields.items():
+                for token in tokenize(value):
+                    postings[token][recipe_id] += WEIGHTS[field]
+        return {token: dict(scores) for token, scores in postings.items()}
+
+    def search(self, query):
+        """Id рецептов, содержащих все слова запроса, по убыванию веса."""
+
+        postings = self.get()
+        tokens = set(tokenize(query))
+        if not tokens:
+            return []
+        matches = [postings.get(token, {}) for token in tokens]
+        matches.sort(key=len)
+        found = set(matches[0]).intersection(*matches[1:])
+        return sorted(
+            found,
+            key=lambda recipe_id: (
+                -sum(scores[recipe_id] for scores in matches), -recipe_id
+            )
+        )
+
+
+recipe_search_index = RecipeSearchIndex()
+
+# Рецепты, чьи векторы ждут коммита, - у каждого потока свои.
+pending_search_vectors = threading.local()
+
+
+def update_search_vectors(queryset):
+    """
+    Пересчитываем tsvector рецептов одним UPDATE: название (вес A),
+    ингредиенты (B) и описание (C).
+    """
+
+    if not uses_postgres():
+        recipe_search_index.invalidate()
+        return
+    config = settings.SEARCH_CONFIG
+    ingredient_names = IngredientRecipe.objects.filter(
+        recipe=OuterRef('pk')
+    ).values('recipe').annotate(
+        names=StringAgg('ingredient__name', ' ')
+    ).values('names')
+    queryset.update(
+        search_vector=(
+            SearchVector('name', weight='A', config=config)
+            + SearchVector(
+                Subquery(ingredient_names), weight='B', config=config
+            )
+            + SearchVector('text', weight='C', config=config)
+        )
+    )
+
+
+def flush_search_vectors():
+    recipe_ids = getattr(pending_search_vectors, 'recipe_ids', None)
+    if recipe_ids:
+        pending_search_vectors.recipe_ids = set()
+        update_search_vectors(Recipe.objects.filter(pk__in=recipe_ids))
+
+
+def schedule_search_vector(recipe_id):
+    """
+    Пересчёт вектора рецепта после коммита, один UPDATE на транзакцию.
+    id копятся в множестве потока (у потока своё соединение). Каждое
+    сохранение регистрирует on_commit, но пересчитывает всё первый
+    сработавший обработчик, остальные застают множество пустым.
+    После отката обработчики пропадают вместе с транзакцией, а её id
+    пересчитаются со следующим коммитом: лишний пересчёт безвреден.
+    """
+
+    if not connection.in_atomic_block:
+        update_search_vectors(Recipe.objects.filter(pk=recipe_id))
+        return
+    if not hasattr(pending_search_vectors, 'recipe_ids'):
+        pending_search_vectors.recipe_ids = set()
+    pending_search_vectors.recipe_ids.add(recipe_id)
+    transaction.on_commit(flush_search_vectors)
+
+
+def search_recipes(queryset, query):
+    """Рецепты, подходящие под запрос, от более релевантных к менее."""
+
+    if uses_postgres():
+        search_query = SearchQuery(query, config=settings.SEARCH_CONFIG)
+        return queryset.filter(
+            search_vector=search_query
+        ).annotate(
+            rank=SearchRank(F('search_vector'), search_query)
+        ).order_by('-rank', '-pub_date', '-id')
+
+    recipe_ids = recipe_search_index.search(query)
+    return queryset.filter(pk__in=recipe_ids).annotate(
+        rank=Case(
+            *[
+                When(pk=recipe_id, then=Value(-position))
+                for position, recipe_id in enumerate(recipe_ids)
+            ],
+            default=Value(0),
+            output_field=IntegerField()
+        )
+    ).order_by('-rank')
@@ -0,0 +1,98 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+
+from users.models import CustomUser, Subscribe
+
+from . import feed
+from .counters import increment, update_counter
+from .indexes import ingredient_index, recipe_ingredient_index
+from .models import (
+    Favorite,
+    Ingredient,
+    IngredientRecipe,
+    Recipe,
+    ShoppingCart,
+    ShoppingCartIngredient
+)
+from .search import recipe_search_index, schedule_search_vector
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_ingredient_index(sender, **kwargs):
+    transaction.on_commit(ingredient_index.invalidate)
+
+
+@receiver(pre_delete, sender=Recipe)
+def remove_recipe_from_carts(sender, instance, **kwargs):
+    """
+    Вычитаем рецепт из сумм корзин при любом удалении: через API,
+    админку или каскадом вместе с автором. pre_delete, пока строки
+    корзин и ингредиентов рецепта ещё на месте.
+    """
+
+    ShoppingCartIngredient.objects.delete_recipe(instance)
+
+
+@receiver(post_delete, sender=Recipe)
+def update_recipe_ingredient_index(sender, instance, **kwargs):
+    recipe_id = instance.pk
+    transaction.on_commit(
+        lambda: recipe_ingredient_index.changed([recipe_id])
+    )
+
+
+@receiver(post_save, sender=Recipe)
+def fan_out_recipe(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: feed.fan_out_recipe(instance))
+
+
+@receiver(post_save, sender=Subscribe)
+def follow_author(sender, instance, created, **kwargs):
+    if created:
+        feed.follow(instance.user_id, instance.author_id)
+
+
+@receiver(post_delete, sender=Subscribe)
+def unfollow_author(sender, instance, **kwargs):
+    feed.unfollow(instance.user_id, instance.author_id)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver((post_save, post_delete), sender=IngredientRecipe)
+def update_recipe_search_vector(sender, instance, **kwargs):
+    schedule_search_vector(
+        instance.pk if sender is Recipe else instance.recipe_id
+    )
+
+
+@receiver(post_delete, sender=Recipe)
+def invalidate_recipe_search_index(sender, **kwargs):
+    transaction.on_commit(recipe_search_index.invalidate)
+
+
+@receiver(post_save, sender=Recipe)
+def count_new_recipe(sender, instance, created, **kwargs):
+    if created:
+        update_counter(CustomUser, 'recipes_count', instance.author_id, 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def count_deleted_recipe(sender, instance, **kwargs):
+    update_counter(CustomUser, 'recipes_count', instance.author_id, -1)
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+@receiver((post_save, post_delete), sender=ShoppingCart)
+@receiver((post_save, post_delete), sender=Subscribe)
+def count_membership(sender, instance, **kwargs):
+    if kwargs.get('created') is False:
+        return
+    delta = 1 if kwargs.get('created') else -1
+    if sender is Subscribe:
+        increment(CustomUser, 'followers_count', instance.author_id, delta)
+    elif sender is Favorite:
+        increment(Recipe, 'favorites_count', instance.recipe_id, delta)
+    else:
+        increment(Recipe, 'carts_count', instance.recipe_id, delta)
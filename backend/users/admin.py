@@ -11,6 +11,8 @@ class CustomUserAdmin(admin.ModelAdmin):
         'first_name',
         'last_name',
         'password',
+        'followers_count',
+        'recipes_count',
     )
     list_filter = (
         'email',
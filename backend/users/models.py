@@ -1,10 +1,12 @@
 from django.db import models
 from django.contrib.auth.models import AbstractUser
 
+from recipes.counters import CounterFieldsMixin
+
 from .validators import validate_username
 
 
-class CustomUser(AbstractUser):
+class CustomUser(CounterFieldsMixin, AbstractUser):
     """Класс экземпляра пользователя."""
 
     email = models.EmailField(
@@ -30,6 +32,18 @@ class CustomUser(AbstractUser):
         'Пароль',
         max_length=150
     )
+    followers_count = models.PositiveIntegerField(
+        'Подписчиков',
+        default=0,
+        editable=False
+    )
+    recipes_count = models.PositiveIntegerField(
+        'Рецептов',
+        default=0,
+        editable=False
+    )
+
+    counter_fields = ('followers_count', 'recipes_count')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name')